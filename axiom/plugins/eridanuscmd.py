@@ -23,6 +23,9 @@ class ConfigureService(axiomatic.AxiomaticSubCommand):
         ('nick',     'n',  None, 'Bot nickname'),
         ('channels', 'c',  None, 'Channels to join'),
         ('ignores',  'i',  None, 'Nicknames to ignore'),
+        ('schemes',  's',  None, 'URL schemes to recognise'),
+        ('burst',    None, None, 'Number of lines to send in a burst'),
+        ('interval', None, None, 'Seconds between lines after a burst'),
         ]
 
     def getStore(self):
@@ -49,6 +52,12 @@ class ConfigureService(axiomatic.AxiomaticSubCommand):
             config.channels = self.decodeCommandLine(self['channels']).split(u',')
         if self['ignores']:
             config.ignores = self.decodeCommandLine(self['ignores']).split(u',')
+        if self['schemes']:
+            config.urlSchemes = self.decodeCommandLine(self['schemes']).split(u',')
+        if self['burst']:
+            config.floodBurst = int(self['burst'])
+        if self['interval']:
+            config.floodInterval = float(self['interval'])
 
 
 
@@ -0,0 +1,71 @@
+"""
+Measure command dispatch latency as the number of installed plugins grows.
+
+Usage: python bin/benchdispatch.py [iterations]
+
+Each plugin installed on an in-memory store has a single command, the last
+installed plugin's command is dispatched via L{eridanus.plugin.command}.  The
+linear scan that L{eridanus.plugin.getPluginByName} used to perform is timed
+alongside for comparison.
+"""
+import sys
+import time
+
+from axiom.attributes import integer
+from axiom.item import Item
+from axiom.store import Store
+
+from eridanus import plugin
+from eridanus.ieridanus import IEridanusPlugin
+
+
+SIZES = [1, 10, 50, 100, 250]
+
+
+class FakeUser(object):
+    avatarId = None
+
+
+class FakeSource(object):
+    user = FakeUser()
+
+
+def makePlugin(n):
+    def cmd_ping(self, source):
+        return n
+    return type('BenchPlugin%d' % (n,), (Item, plugin.Plugin), dict(
+        __module__=__name__,
+        typeName='eridanus_bench_benchplugin%d' % (n,),
+        schemaVersion=1,
+        dummy=integer(),
+        cmd_ping=cmd_ping))
+
+
+def linearScan(store, name):
+    for p in store.powerupsFor(IEridanusPlugin):
+        if p.name == name:
+            return p
+
+
+def timeit(f, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        f()
+    return (time.time() - start) / iterations * 1000000
+
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+pluginTypes = [makePlugin(n) for n in xrange(max(SIZES))]
+source = FakeSource()
+
+print '%8s %16s %16s' % ('plugins', 'dispatch (us)', 'linear scan (us)')
+for size in SIZES:
+    store = Store()
+    for pluginType in pluginTypes[:size]:
+        plugin.powerUp(store, pluginType(store=store), IEridanusPlugin)
+    name = pluginTypes[size - 1].__name__.lower()
+    message = u'%s ping' % (name,)
+    print '%8d %16.1f %16.1f' % (
+        size,
+        timeit(lambda: plugin.command(store, source, message), iterations),
+        timeit(lambda: linearScan(store, name), iterations))
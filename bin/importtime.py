@@ -0,0 +1,60 @@
+"""
+Report the modules imported while discovering plugins at startup, in the
+style of Python 3's C{-X importtime}.
+
+Usage: python bin/importtime.py [--eager] [count]
+
+C{--eager} also loads every plugin, which is what startup used to cost before
+plugins were loaded lazily.  The C{count} slowest imports (default 20) are
+listed, with the time spent importing each module alone and including the
+modules it imported.
+"""
+import __builtin__
+import sys
+import time
+
+
+eager = '--eager' in sys.argv
+args = [arg for arg in sys.argv[1:] if arg != '--eager']
+count = int(args[0]) if args else 20
+
+timings = []
+stack = []
+realImport = __builtin__.__import__
+
+def timedImport(name, *a, **kw):
+    before = set(sys.modules)
+    stack.append(0.0)
+    start = time.time()
+    try:
+        return realImport(name, *a, **kw)
+    finally:
+        elapsed = time.time() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        if set(sys.modules) - before:
+            timings.append((elapsed - nested, elapsed, name))
+
+__builtin__.__import__ = timedImport
+start = time.time()
+modules = len(sys.modules)
+
+from eridanus import plugin
+registry = plugin.getPluginRegistry()
+if eager:
+    registry.brokenPlugins
+
+elapsed = time.time() - start
+__builtin__.__import__ = realImport
+
+print 'import time: %10s | %10s | module' % ('self [us]', 'cumulative')
+for self, cumulative, name in sorted(timings, key=lambda t: -t[1])[:count]:
+    print 'import time: %10d | %10d | %s' % (
+        self * 1000000, cumulative * 1000000, name)
+print
+print '%s: %d plugins, %d modules imported in %.3fs' % (
+    eager and 'eager' or 'lazy',
+    len(registry.plugins),
+    len(sys.modules) - modules,
+    elapsed)
@@ -10,18 +10,18 @@ from twisted.internet import reactor, error as ierror
 from twisted.internet.defer import succeed, maybeDeferred, Deferred
 from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.python import log
-from twisted.words.protocols.irc import IRCClient
+from twisted.words.protocols.irc import IRCClient, X_DELIM, split
 
 from axiom import errors as aerrors
 from axiom.attributes import (integer, inmemory, reference, bytes, text,
-    textlist)
+    textlist, ieee754_double)
 from axiom.dependency import dependsOn
 from axiom.item import Item
 from axiom.upgrade import registerUpgrader, registerAttributeCopyingUpgrader
 from axiom.userbase import LoginSystem
 
-from eridanus import util, errors, plugin, iriparse
-from eridanus.irc import IRCSource, IRCUser
+from eridanus import util, errors, plugin, outbound
+from eridanus.irc import IRCSource, IRCUser, MessageContext
 from eridanus.ieridanus import ICommand, IIRCAvatar
 from eridanus.plugin import usage, rest, SubCommand, IncrementalArguments
 from eridanus.util import encode, decode
@@ -44,6 +44,73 @@ class IRCBot(IRCClient):
         self.topicDeferreds = {}
         self.isupported = {}
         self.authenticatedUsers = {}
+        self.scheduler = outbound.OutboundScheduler(
+            self.sendLine,
+            outbound.TokenBucket(config.floodBurst, config.floodInterval))
+
+
+    def connectionLost(self, reason):
+        self.scheduler.stop()
+        return IRCClient.connectionLost(self, reason)
+
+
+    def _queueLine(self, command, user, message, length, priority, merge):
+        """
+        Queue a message to C{user} with the outbound scheduler, splitting it
+        into multiple lines as L{IRCClient.msg} does.
+
+        Messages containing CTCP messages, such as the CTCP replies made by
+        L{IRCClient.ctcpMakeReply}, are only valid as a whole and are queued
+        as a single line that is never merged.
+
+        @param merge: Whether the message may be merged with other messages
+            queued to C{user}
+        """
+        prefix = '%s %s :' % (command, user)
+        if length is None:
+            length = self._safeMaximumLineLength(prefix)
+        # Account for the line terminator.
+        minimumLength = len(prefix) + 2
+        if length <= minimumLength:
+            raise ValueError('Maximum length must exceed %d for message '
+                             'to %s' % (minimumLength, user))
+        maxLength = None
+        if X_DELIM in message:
+            lines = [message]
+        else:
+            if merge:
+                maxLength = length - 2
+            lines = split(message, length - minimumLength)
+        for line in lines:
+            self.scheduler.enqueue(user, prefix, line, priority, maxLength)
+
+
+    def msg(self, user, message, length=None):
+        """
+        Queue a message to a user or channel, ahead of any ambient notices.
+        """
+        self._queueLine(
+            'PRIVMSG', user, message, length, outbound.REPLY, merge=False)
+
+
+    def notice(self, user, message, ambient=False):
+        """
+        Queue a notice to a user or channel.
+
+        Ambient notices, such as announcements that are not a reply to a
+        command, are sent after any replies, and ambient notices to the same
+        user or channel that are still waiting to be sent are merged into
+        fewer lines where possible.
+
+        @type ambient: C{bool}
+        @param ambient: Whether the notice is ambient, rather than a reply
+        """
+        if ambient:
+            self._queueLine(
+                'NOTICE', user, message, None, outbound.AMBIENT, merge=True)
+        else:
+            self._queueLine(
+                'NOTICE', user, message, None, outbound.REPLY, merge=False)
 
 
     def maxMessageLength(self):
@@ -113,27 +180,16 @@ class IRCBot(IRCClient):
             return
 
         source = IRCSource(self, decode(channel), user)
-        message = decode(message)
-
-        directedTextSuffixes = (':', ',')
-        isDirected = False
-        for suffix in directedTextSuffixes:
-            directedText = decode(self.nickname.lower()) + suffix
-            if message.lower().startswith(directedText):
-                isDirected = True
-                break
-
-        if isDirected:
-            # Remove our nickname from the beginning of the addressed text.
-            message = message[len(directedText):].strip()
+        context = MessageContext(
+            decode(message), decode(self.nickname), self.config.urlSchemes)
 
         if source.isPrivate:
-            self.privateMessage(source, message)
+            self.privateMessage(source, context.text)
         else:
-            if isDirected:
-                self.directedPublicMessage(source, message)
+            if context.isDirected:
+                self.directedPublicMessage(source, context.text)
             else:
-                self.publicMessage(source, message)
+                self.publicMessage(source, context)
 
 
     def topic(self, channel, topic=None):
@@ -215,9 +271,14 @@ class IRCBot(IRCClient):
     privateMessage = directedPublicMessage
 
 
-    def publicMessage(self, source, message):
-        self.broadcastAmbientEvent('publicMessageReceived', source, message)
-        for url in iriparse.parseURLs(message):
+    def publicMessage(self, source, context):
+        """
+        Broadcast ambient events for an undirected public message.
+
+        @type context: L{MessageContext}
+        """
+        self.broadcastAmbientEvent('publicMessageReceived', source, context)
+        for url in context.urls:
             self.broadcastAmbientEvent('publicURLReceived', source, url)
 
 
@@ -318,18 +379,18 @@ class IRCBot(IRCClient):
         """
         Get an iterable of names of plugins that can still be installed.
         """
-        def pluginTypes(it):
-            return (type(p) for p in it)
+        def pluginNames(it):
+            return (p.pluginName for p in it)
 
-        installedPlugins = set(pluginTypes(plugin.getInstalledPlugins(self.appStore)))
+        installedPlugins = set(pluginNames(plugin.getInstalledPlugins(self.appStore)))
         avatar = self.getAvatar(nickname)
         # XXX: This is a crap way to tell the difference between authenticated
         # users and plebs.  Fix it!
         if hasattr(avatar, 'store'):
-            installedPlugins.update(pluginTypes(plugin.getInstalledPlugins(avatar.store)))
+            installedPlugins.update(pluginNames(plugin.getInstalledPlugins(avatar.store)))
 
-        allPlugins = set(plugin.getAllPlugins())
-        return (p.pluginName for p in allPlugins - installedPlugins)
+        allPlugins = set(pluginNames(plugin.getAllPlugins()))
+        return allPlugins - installedPlugins
 
 
     def getBrokenPlugins(self):
@@ -340,6 +401,17 @@ class IRCBot(IRCClient):
         return (p.pluginName for p in brokenPlugins)
 
 
+    def refreshPlugins(self):
+        """
+        Discover available plugins again, and pick up any changes made to the
+        plugins installed on the app store by other processes.
+
+        @rtype: L{eridanus.plugin.PluginRegistry}
+        """
+        plugin.invalidatePowerups(self.appStore)
+        return plugin.refreshPluginRegistry()
+
+
 
 class IRCBotFactory(ReconnectingClientFactory):
     protocol = IRCBot
@@ -376,7 +448,7 @@ class IRCBotFactoryFactory(Item):
 
 class IRCBotConfig(Item):
     typeName = 'eridanus_ircbotconfig'
-    schemaVersion = 5
+    schemaVersion = 7
 
     name = text(doc="""
     The name of the network this config is for.
@@ -406,6 +478,19 @@ class IRCBotConfig(Item):
     A string of user modes to set after successfully connecting to C{hostname}.
     """, default='B')
 
+    urlSchemes = textlist(doc="""
+    A C{list} of URL schemes to recognise in public messages.  Since schemes
+    are matched as prefixes, C{http} also recognises C{https} URLs.
+    """, default=[u'http'])
+
+    floodBurst = integer(doc="""
+    The number of lines that may be sent to the server in a burst.
+    """, default=5)
+
+    floodInterval = ieee754_double(doc="""
+    The number of seconds to wait between lines, once a burst has been sent.
+    """, default=2.0)
+
     def addChannel(self, channel):
         if channel not in self.channels:
             self.channels = self.channels + [channel]
@@ -418,20 +503,36 @@ class IRCBotConfig(Item):
         self.channels = channels
 
 
-    def isIgnored(self, mask):
-        mask = util.normalizeMask(mask)
-        for ignore in self.ignores:
-            ignore = util.normalizeMask(ignore)
-            if util.hostMatches(mask, ignore):
-                return True
+    _ignoreMatcher = inmemory(doc="""
+    L{eridanus.util.MaskMatcher} for C{ignores}.
+    """)
 
-        return False
+    def activate(self):
+        self._ignoreMatcher = None
+
+
+    def getIgnoreMatcher(self):
+        """
+        Get the L{eridanus.util.MaskMatcher} for C{ignores}.
+
+        The matcher is only rebuilt when C{ignores} is assigned a new value.
+        """
+        ignores = self.ignores
+        matcher = self._ignoreMatcher
+        if matcher is None or matcher.masks is not ignores:
+            matcher = self._ignoreMatcher = util.MaskMatcher(ignores)
+        return matcher
+
+
+    def isIgnored(self, mask):
+        return self.getIgnoreMatcher().matches(mask)
 
 
     def addIgnore(self, mask):
         mask = util.normalizeMask(mask)
         if mask not in self.ignores:
             self.ignores = self.ignores + [mask]
+            self._ignoreMatcher = None
             return mask
         return None
 
@@ -447,6 +548,7 @@ class IRCBotConfig(Item):
         newIgnores = list(removeIgnores(mask))
         diff = set(self.ignores) - set(newIgnores)
         self.ignores = newIgnores
+        self._ignoreMatcher = None
         return list(diff) or None
 
 
@@ -475,6 +577,8 @@ def ircbotconfig2to3(old):
 registerUpgrader(ircbotconfig2to3, IRCBotConfig.typeName, 2, 3)
 registerAttributeCopyingUpgrader(IRCBotConfig, 3, 4)
 registerAttributeCopyingUpgrader(IRCBotConfig, 4, 5)
+registerAttributeCopyingUpgrader(IRCBotConfig, 5, 6)
+registerAttributeCopyingUpgrader(IRCBotConfig, 6, 7)
 
 
 
@@ -560,6 +664,7 @@ class IRCBotService(Item):
 
 
     def startService(self):
+        plugin.getPluginRegistry()
         if self.connector is None:
             self.connector = self.connect()
 
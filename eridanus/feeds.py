@@ -30,9 +30,9 @@ class ChannelFeed(FeedPage):
         self.manager = manager
 
     def entryContent(self, entry):
-        initialComment = entry.initialComment
+        initialComment = entry.initialCommentText
         if initialComment is not None:
-            initialComment = E('span')[u' \u2013 \u201c%s\u201d' % (entry.initialComment.comment,)]
+            initialComment = E('span')[u' \u2013 \u201c%s\u201d' % (initialComment,)]
 
         comments = entry.comments
         if comments is not None:
@@ -60,7 +60,8 @@ class ChannelFeed(FeedPage):
                      content=Content(content, type='xhtml'))
 
     def getFeed(self):
-        entries = list(self.manager.getEntries(limit=self.maxItems))
+        entries = list(self.manager.getEntries(limit=self.maxItems,
+                                               prefetch=True))
         atomEntries = (self.entryFromEntry(e) for e in entries)
 
         title = u'%s links' % (self.manager.channel,)
@@ -117,7 +117,8 @@ class IAmbientEventObserver(Interface):
         """
         A public message occured.
 
-        @type message: C{unicode}
+        @type message: C{unicode}, or L{eridanus.irc.MessageContext} if this
+            method is decorated with L{eridanus.plugin.contextual}
         """
 
 
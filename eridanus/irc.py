@@ -1,3 +1,6 @@
+from nevow.url import URL
+
+from eridanus import iriparse
 from eridanus.util import encode
 
 
@@ -82,11 +85,17 @@ class IRCSource(object):
 
         return None
 
-    def notice(self, text):
+    def notice(self, text, ambient=False):
         """
         Notice C{text} to the current channel.
+
+        @type ambient: C{bool}
+        @param ambient: Whether the notice is ambient, such as an
+            announcement, rather than a reply to a command, see
+            L{eridanus.bot.IRCBot.notice}
         """
-        self.protocol.notice(encode(self.channel), encode(text))
+        self.protocol.notice(
+            encode(self.channel), encode(text), ambient=ambient)
 
 
     def privateNotice(self, text):
@@ -162,3 +171,126 @@ class IRCSource(object):
         Log the failure and have the protocol mention it.
         """
         self.protocol.mentionFailure(f, self, msg)
+
+
+
+class MessageContext(object):
+    """
+    A message received over IRC and information derived from it.
+
+    A context is created once per message and shared by everything the message
+    is dispatched to.  Derived information, such as the URLs occuring in the
+    message, is computed on first use and remembered, so that observers do not
+    each have to repeat the work.
+
+    @ivar text: The message text, with any nickname addressing the bot
+        removed
+    @type text: C{unicode}
+
+    @ivar lowerText: C{text} lowercased
+    @type lowerText: C{unicode}
+
+    @ivar isDirected: Whether the message was addressed to the bot, e.g.
+        C{"nickname: hello"}
+    @type isDirected: C{bool}
+
+    @ivar urlSchemes: URL schemes to recognise, see
+        L{eridanus.iriparse.extractURLsWithPosition}
+    @type urlSchemes: C{list} of C{unicode}
+    """
+    directedTextSuffixes = (u':', u',')
+
+    def __init__(self, message, nickname, urlSchemes=None):
+        """
+        @param message: The decoded message text
+        @type message: C{unicode}
+
+        @param nickname: The bot's nickname
+        @type nickname: C{unicode}
+        """
+        lowerText = message.lower()
+        isDirected = False
+        for suffix in self.directedTextSuffixes:
+            directedText = nickname.lower() + suffix
+            if lowerText.startswith(directedText):
+                isDirected = True
+                break
+
+        if isDirected:
+            # Remove our nickname from the beginning of the addressed text.
+            message = message[len(directedText):].strip()
+            lowerText = message.lower()
+
+        self._text = message
+        self._lowerText = lowerText
+        self._isDirected = isDirected
+        self._urlSchemes = urlSchemes
+        self._urlsWithPosition = None
+        self._urlsWithComments = None
+        self._urls = None
+
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.text)
+
+
+    @property
+    def text(self):
+        return self._text
+
+
+    @property
+    def lowerText(self):
+        return self._lowerText
+
+
+    @property
+    def isDirected(self):
+        return self._isDirected
+
+
+    @property
+    def urlSchemes(self):
+        return self._urlSchemes
+
+
+    @property
+    def urlsWithPosition(self):
+        """
+        URLs in the message and the position each one ends at.
+
+        @rtype: C{tuple} of C{(unicode, int)}
+        """
+        if self._urlsWithPosition is None:
+            self._urlsWithPosition = tuple(
+                iriparse.extractURLsWithPosition(self.text, self.urlSchemes))
+        return self._urlsWithPosition
+
+
+    @property
+    def urlsWithComments(self):
+        """
+        URLs in the message and the comment trailing each one.
+
+        @see: L{eridanus.iriparse.extractComment}
+
+        @rtype: C{tuple} of C{(unicode, unicode)}
+        """
+        if self._urlsWithComments is None:
+            self._urlsWithComments = tuple(
+                (uri, iriparse.extractComment(self.text, pos))
+                for uri, pos in self.urlsWithPosition)
+        return self._urlsWithComments
+
+
+    @property
+    def urls(self):
+        """
+        Parsed URLs in the message.
+
+        @rtype: C{tuple} of C{nevow.url.URL}
+        """
+        if self._urls is None:
+            self._urls = tuple(
+                URL.fromString(uri) for uri, pos in self.urlsWithPosition)
+        return self._urls
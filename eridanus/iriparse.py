@@ -1,155 +1,222 @@
-import string
-# suppress pyflakes warning, as this is used by the PyMeta grammar
-string
+import re
+import sys
 
-from pymeta.grammar import OMeta
 from pymeta.runtime import ParseError
 
 from nevow import url
 
 # http://www.ietf.org/rfc/rfc3987.txt
 
-def isInRange(c, ranges):
-    o = ord(c)
-    for start, end in ranges:
-        if start <= o <= end:
-            return True
-    return False
+iprivateRanges = [(0x0000e000, 0x0000f8ff),
+                  (0x000f0000, 0x000ffffd),
+                  (0x00100000, 0x0010fffd)]
+
+ucscharRanges  = [(0x000000a0, 0x0000d7ff),
+                  (0x0000f900, 0x0000fdcf),
+                  (0x0000fdf0, 0x0000ffef),
+                  (0x00010000, 0x0001fffd),
+                  (0x00020000, 0x0002fffd),
+                  (0x00030000, 0x0003fffd),
+                  (0x00040000, 0x0004fffd),
+                  (0x00050000, 0x0005fffd),
+                  (0x00060000, 0x0006fffd),
+                  (0x00070000, 0x0007fffd),
+                  (0x00080000, 0x0008fffd),
+                  (0x00090000, 0x0009fffd),
+                  (0x000a0000, 0x000afffd),
+                  (0x000b0000, 0x000bfffd),
+                  (0x000c0000, 0x000cfffd),
+                  (0x000d0000, 0x000dfffd),
+                  (0x000e0000, 0x000efffd)]
+
+
+def _characterRanges(ranges):
+    """
+    Convert a list of code point ranges into the body of a regular expression
+    character class.
+
+    Ranges beyond what this Python build can represent as a single character
+    are dropped, on a narrow build these code points only ever appear as
+    surrogate pairs, which do not fall within any of the ranges anyway.
+    """
+    def _ranges():
+        for start, end in ranges:
+            if start > sys.maxunicode:
+                continue
+            end = min(end, sys.maxunicode)
+            yield u'%s-%s' % (unichr(start), unichr(end))
+    return u''.join(_ranges())
+
+
+
+_hexdigit = u'[0-9A-Fa-f]'
+_unreserved = u'A-Za-z0-9\\-._~'
+_subDelims = u"!$&'()*+,;="
+_ucschar = _characterRanges(ucscharRanges)
+_iprivate = _characterRanges(iprivateRanges)
+
+_pctEncoded = u'%%%s{2}' % (_hexdigit,)
+
+def _chars(*classes):
+    """
+    Build a pattern matching a single character from any of C{classes} or a
+    percent-encoded octet.
+    """
+    return u'(?:[%s]|%s)' % (u''.join(classes), _pctEncoded)
+
+
+_ipchar = _chars(_unreserved, _ucschar, _subDelims, u':@')
+
+_decOctet = u'(?:25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9]?[0-9])'
+_ipv4address = u'%s(?:\\.%s){3}' % (_decOctet, _decOctet)
+
+_h16 = u'%s{1,4}' % (_hexdigit,)
+_ls32 = u'(?:%s:%s|%s)' % (_h16, _h16, _ipv4address)
+
+def _ipv6(before, after, last):
+    """
+    Build one of the RFC 3986 C{IPv6address} alternatives containing C{::}:
+    at most C{before} pieces preceding the C{::}, exactly C{after} pieces
+    following it and finally C{last}.
+    """
+    head = u''
+    if before:
+        head = u'(?:(?:%s:){0,%d}%s)?' % (_h16, before - 1, _h16)
+    return u'%s::(?:%s:){%d}%s' % (head, _h16, after, last)
+
+_ipv6address = u'(?:%s)' % (u'|'.join([
+    u'(?:%s:){6}%s' % (_h16, _ls32),
+    _ipv6(0, 5, _ls32),
+    _ipv6(1, 4, _ls32),
+    _ipv6(2, 3, _ls32),
+    _ipv6(3, 2, _ls32),
+    _ipv6(4, 1, _ls32),
+    _ipv6(5, 0, _ls32),
+    _ipv6(6, 0, _h16),
+    _ipv6(7, 0, u'')]),)
+
+_ipvFuture = u'v%s+\\.[%s%s:]+' % (_hexdigit, _unreserved, _subDelims)
+
+_iriPattern = re.compile(u''.join([
+    # scheme ":"
+    u'[A-Za-z][A-Za-z0-9+\\-.]+:',
+    # "//" iauthority
+    u'//',
+    u'(?:%s*@)?' % (_chars(_unreserved, _ucschar, _subDelims, u':'),),
+    u'(?:\\[(?:%s|%s)\\]|%s+)' % (
+        _ipv6address, _ipvFuture, _chars(_unreserved, _ucschar, _subDelims)),
+    u'(?::[0-9]+)?',
+    # ipath-abempty
+    u'(?:/%s*)*' % (_ipchar,),
+    # [ "?" iquery ]
+    u'(?:\\?(?:%s|[%s/?])+)?' % (_ipchar, _iprivate),
+    # [ "#" ifragment ]
+    u'(?:#(?:%s|[/?])+)?' % (_ipchar,)]))
+
+
+
+def _matchIRI(input, pos=0):
+    """
+    Match an IRI in C{input} starting exactly at C{pos}.
+
+    @rtype: C{re.MatchObject} or C{None}
+    """
+    return _iriPattern.match(input, pos)
 
 
-def checkIPv6(xs):
-    return len([x for x in xs if x is None]) <= 1
-
-
-iriGrammar = """
-hexdigit       ::= :x ?(x in string.hexdigits) => x
-
-IRI            ::= !(self.markURLStart()) <scheme> ':' <ihier_part> ('?' <iquery>)? ('#' <ifragment>)? !(self.markURLEnd()) => ''.join(self.input.data[self.urlStart:self.urlEnd])
-
-ihier_part     ::= '/' '/' <iauthority> (<ipath_abempty> | <ipath_absolute> | <ipath_rootless>)?
-
-IRI_reference  ::= <IRI> | <irelative_ref>
-
-absolute_IRI   ::= !(self.markURLStart()) <scheme> ':' <ihier_part> ('?' <iquery>)? !(self.markURLEnd()) => ''.join(self.input.data[self.urlStart:self.urlEnd])
-
-irelative_ref  ::= <irelative_part> ('?' <iquery>)? ('#' <ifragment>)?
-irelative_part ::= '/' '/' <iauthority> (<ipath_abempty> | <ipath_absolute> | <ipath_noscheme>)
-
-iauthority     ::= (<iuserinfo> '@')? <ihost> (':' <port>)?
-
-iuserinfo      ::= (<iunreserved> | <pct_encoded> | <sub_delims> | ':')*
-
-ihost          ::= <IP_literal> | <IPv4address> | <ireg_name>
-
-ireg_name      ::= (<iunreserved> | <pct_encoded> | <sub_delims>)+
-
-ipath          ::= <ipath_abempty> | <ipath_absolute> | <ipath_noscheme> | <ipath_rootless>
-
-ipath_abempty  ::= ('/' <isegment>)*
-ipath_absolute ::= '/' (<isegment_nz> <ipath_abempty>)?
-ipath_noscheme ::= <isegment_nz_nc> <ipath_abempty>
-ipath_rootless ::= <isegment_nz> <ipath_abempty>
-
-isegment       ::= <ipchar>*
-isegment_nz    ::= <ipchar>+
-isegment_nz_nc ::= (<iunreserved> | <pct_encoded> | <sub_delims> | '@')+
-
-ipchar         ::= <iunreserved> | <pct_encoded> | <sub_delims> | ':' | '@'
-
-iquery         ::= (<ipchar> | <iprivate> | '/' | '?')+
-
-ifragment      ::= (<ipchar> | '/' | '?')+
-
-iunreserved    ::= <unreserved> | <ucschar>
-
-ucschar        ::= :x ?(isInRange(x, self.ucscharRanges)) => x
-
-iprivate       ::= :x ?(isInRange(x, self.iprivateRanges)) => x
+def extractURL(input):
+    m = _matchIRI(input)
+    if m is None:
+        raise ParseError(0, [('expected', 'IRI', None)])
+    return m.group(), m.end()
 
-scheme         ::= <letter> (<letterOrDigit> | '+' | '-' | '.')+
 
-port           ::= <digit>+
+_schemePatterns = {}
 
-IP_literal     ::= '[' (<IPv6address> | <IPvFuture>) ']'
+def _schemePattern(supportedSchemes):
+    """
+    Get a compiled pattern that finds the earliest occurrence of any scheme in
+    C{supportedSchemes}.
 
-IPvFuture      ::= 'v' <hexdigit>+ '.' (<unreserved> | <sub_delims> | ':')+
+    Patterns are cached per scheme set, since the set rarely changes.
+    """
+    key = tuple(supportedSchemes)
+    pattern = _schemePatterns.get(key)
+    if pattern is None:
+        # Longer schemes first, so that "https" is preferred over "http".
+        schemes = sorted(set(key), key=len, reverse=True)
+        pattern = _schemePatterns[key] = re.compile(
+            u'|'.join(re.escape(scheme) for scheme in schemes))
+    return pattern
 
-IPv6address    ::= (<h16>?:x ':' => x)*:xs ?(checkIPv6(xs)) <h16>
 
-h16            ::= <hexdigit>*:hs ?(1 <= len(hs) <= 4) => ''.join(hs)
-ls32           ::= (<h16> ':' <h16>) | <IPv4address>
+def extractURLsWithPosition(input, supportedSchemes=None):
+    """
+    Extract URLs and the position where each ends from C{input}.
 
-IPv4address    ::= <dec_octet> '.' <dec_octet> '.' <dec_octet> '.' <dec_octet>
+    All of C{supportedSchemes} are searched for in a single pass, URLs are
+    produced in the order they appear in C{input}.
 
-dec_octet      ::= :x ?(0 <= x <= 255) => x
+    @type supportedSchemes: C{list} of C{unicode}
+    @param supportedSchemes: URL schemes to look for, defaults to C{http}
+        (which will also find C{https} URLs)
 
-pct_encoded    ::= '%' <hexdigit> <hexdigit>
+    @rtype: C{iterable} of C{(unicode, int)}
+    """
+    if supportedSchemes is None:
+        supportedSchemes = ['http']
 
-unreserved     ::= <letterOrDigit> | '-' | '.' | '_' | '~'
-reserved       ::= <gen_delims> | <sub_delims>
-gen_delims     ::= ':' | '/' | '?' | '#' | '[' | ']' | '@'
-sub_delims     ::= '!' | '$' | '&' | '\'' | '(' | ')' | '*' | '+' | ',' | ';' | '='
-"""
+    if not supportedSchemes:
+        return
 
+    search = _schemePattern(supportedSchemes).search
+    candidate = search(input)
+    while candidate is not None:
+        pos = candidate.start()
+        m = _matchIRI(input, pos)
+        if m is None:
+            # Attempt to skip over the broken IRI.
+            pos += 1
+        else:
+            pos = m.end()
+            yield m.group(), pos
+        candidate = search(input, pos)
 
-class IRIGrammar(OMeta.makeGrammar(iriGrammar, globals())):
-    iprivateRanges = [(0x0000e000, 0x0000f8ff),
-                      (0x000f0000, 0x000ffffd),
-                      (0x00100000, 0x0010fffd)]
 
-    ucscharRanges  = [(0x000000a0, 0x0000d7ff),
-                      (0x0000f900, 0x0000fdcf),
-                      (0x0000fdf0, 0x0000ffef),
-                      (0x00010000, 0x0001fffd),
-                      (0x00020000, 0x0002fffd),
-                      (0x00030000, 0x0003fffd),
-                      (0x00040000, 0x0004fffd),
-                      (0x00050000, 0x0005fffd),
-                      (0x00060000, 0x0006fffd),
-                      (0x00070000, 0x0007fffd),
-                      (0x00080000, 0x0008fffd),
-                      (0x00090000, 0x0009fffd),
-                      (0x000a0000, 0x000afffd),
-                      (0x000b0000, 0x000bfffd),
-                      (0x000c0000, 0x000cfffd),
-                      (0x000d0000, 0x000dfffd),
-                      (0x000e0000, 0x000efffd)]
+def extractURLs(input, supportedSchemes=None):
+    for uri, pos in extractURLsWithPosition(input, supportedSchemes):
+        yield uri
 
-    def markURLStart(self):
-        self.urlStart = self.input.position
 
-    def markURLEnd(self):
-        self.urlEnd = self.input.position
+_commentPattern = re.compile(ur'\s+(?:\[(.*?)\]|<?--\s+(.+))')
 
+def extractComment(input, pos):
+    """
+    Extract the comment trailing a URL that ends at C{pos} in C{input}.
 
-def extractURL(input):
-    g = IRIGrammar(input)
-    uri, err = g.apply('IRI')
-    return uri, g.urlEnd
+    Comments are of the form C{[comment]} or C{-- comment} (optionally
+    C{<-- comment}), the latter extending to the end of C{input}.
 
+    @rtype: C{unicode} or C{None}
+    """
+    comment = _commentPattern.match(input, pos)
+    if comment is not None:
+        comment = filter(None, comment.groups())[0]
+    return comment
 
-def extractURLsWithPosition(input, supportedSchemes=None):
-    if supportedSchemes is None:
-        supportedSchemes = ['http']
 
-    for scheme in supportedSchemes:
-        pos = 0
-        while True:
-            try:
-                pos = input.index(scheme, pos)
-                uri, inc = extractURL(input[pos:])
-                pos += inc
-                yield uri, pos
-            except ParseError:
-                # Attempt to skip over the broken IRI.
-                pos += 1
-            except ValueError:
-                break
+def extractURLsWithComments(input, supportedSchemes=None):
+    """
+    Extract URLs and their trailing comments from C{input}.
 
+    @see: L{extractComment}
 
-def extractURLs(input, supportedSchemes=None):
+    @rtype: C{iterable} of C{(unicode, unicode)}
+    @return: An iterable of C{(url, comment)} pairs, C{comment} is C{None} if
+        there is no comment trailing C{url}
+    """
     for uri, pos in extractURLsWithPosition(input, supportedSchemes):
-        yield uri
+        yield uri, extractComment(input, pos)
 
 
 def parseURL(input):
@@ -0,0 +1,285 @@
+# -*- test-case-name: eridanus.test.test_outbound -*-
+"""
+Outbound IRC message scheduling.
+
+IRC servers disconnect clients that send too many lines too quickly, so lines
+are metered out by a token bucket.  Lines waiting to be sent are queued per
+target (channel or nickname) and targets take turns, so that a burst of lines
+to one target does not hold up every other target.
+"""
+from collections import deque
+
+from twisted.internet import reactor
+
+
+
+#: Priority of lines that are direct replies to users.
+REPLY = 0
+
+#: Priority of ambient lines, such as notices about URLs or feed updates.
+AMBIENT = 1
+
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter.
+
+    The bucket starts full and is refilled at a constant rate, sending a line
+    consumes a token.
+
+    @type capacity: C{int}
+    @ivar capacity: Maximum number of tokens, i.e. the size of a burst
+
+    @type interval: C{float}
+    @ivar interval: Seconds it takes to refill a single token
+
+    @ivar tokens: Number of tokens currently available
+    """
+    def __init__(self, capacity, interval, clock=reactor):
+        self.capacity = capacity
+        self.interval = interval
+        self.clock = clock
+        self.tokens = float(capacity)
+        self._updated = clock.seconds()
+
+
+    def __repr__(self):
+        return '<%s %.1f/%d>' % (type(self).__name__, self.tokens, self.capacity)
+
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) / self.interval)
+        self._updated = now
+
+
+    def consume(self):
+        """
+        Consume a token, if one is available.
+
+        @rtype: C{bool}
+        @return: Whether a token was consumed
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+    def delay(self):
+        """
+        Seconds until a token will be available.
+
+        @rtype: C{float}
+        """
+        self._refill()
+        return max(0.0, (1 - self.tokens) * self.interval)
+
+
+
+class _OutboundLine(object):
+    """
+    A line waiting to be sent.
+
+    @ivar prefix: The command portion of the line, e.g. C{"NOTICE #chan :"}
+
+    @ivar text: The text following C{prefix}
+
+    @ivar maxLength: Maximum length of the complete line that merging may
+        produce, or C{None} if the line cannot be merged
+
+    @ivar queued: Time the line was queued at
+    """
+    def __init__(self, prefix, text, maxLength, queued):
+        self.prefix = prefix
+        self.text = text
+        self.maxLength = maxLength
+        self.queued = queued
+
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.prefix + self.text)
+
+
+    def merge(self, other, separator):
+        """
+        Append C{other}'s text to this line if the result fits.
+
+        @rtype: C{bool}
+        @return: Whether C{other} was merged
+        """
+        if (self.maxLength is None or other.maxLength is None or
+            self.prefix != other.prefix):
+            return False
+        text = self.text + separator + other.text
+        if len(self.prefix) + len(text) > min(self.maxLength, other.maxLength):
+            return False
+        self.text = text
+        return True
+
+
+
+class OutboundScheduler(object):
+    """
+    Schedule outbound lines fairly, within a rate limit.
+
+    Lines of a higher priority are always sent before lines of a lower
+    priority, lines of the same priority are sent round-robin across targets.
+    Mergeable lines, queued to the same target behind another mergeable line
+    with the same prefix, are appended to that line when the result fits.
+
+    @ivar sendLine: Callable to send a complete line with
+
+    @type bucket: L{TokenBucket}
+
+    @ivar sent: Number of lines sent
+
+    @ivar merged: Number of lines merged into other lines
+
+    @ivar totalWait: Seconds sent lines spent queued, in total
+
+    @ivar maxWait: Longest time, in seconds, a sent line spent queued
+    """
+    mergeSeparator = ' | '
+
+    def __init__(self, sendLine, bucket, clock=reactor):
+        self.sendLine = sendLine
+        self.bucket = bucket
+        self.clock = clock
+        self._queues = [{}, {}]
+        self._targets = [deque(), deque()]
+        self._pending = 0
+        self._delayedCall = None
+        self.sent = 0
+        self.merged = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+
+    def __repr__(self):
+        return '<%s %d queued>' % (type(self).__name__, self._pending)
+
+
+    def enqueue(self, target, prefix, text, priority=REPLY, maxLength=None):
+        """
+        Queue a line for sending.
+
+        @param target: Channel or nickname the line is directed at
+
+        @type prefix: C{str}
+        @param prefix: The command portion of the line, e.g.
+            C{"NOTICE #chan :"}
+
+        @type text: C{str}
+        @param text: The text following C{prefix}
+
+        @param priority: L{REPLY} or L{AMBIENT}
+
+        @type maxLength: C{int}
+        @param maxLength: Maximum length of a complete line, without the line
+            terminator, that merging this line with others may produce; or
+            C{None} if this line should not be merged
+        """
+        line = _OutboundLine(prefix, text, maxLength, self.clock.seconds())
+        queues = self._queues[priority]
+        queue = queues.get(target)
+        if queue is None:
+            queue = queues[target] = deque()
+            self._targets[priority].append(target)
+        elif queue[-1].merge(line, self.mergeSeparator):
+            self.merged += 1
+            return
+
+        queue.append(line)
+        self._pending += 1
+        self._pump()
+
+
+    def _nextLine(self):
+        """
+        Remove the next line to send from the queues.
+        """
+        for queues, targets in zip(self._queues, self._targets):
+            if targets:
+                target = targets.popleft()
+                queue = queues[target]
+                line = queue.popleft()
+                if queue:
+                    targets.append(target)
+                else:
+                    del queues[target]
+                self._pending -= 1
+                return line
+
+
+    def _pump(self):
+        """
+        Send as many lines as the rate limit allows, scheduling another pump
+        for when the next token is available if lines remain.
+        """
+        if self._delayedCall is not None:
+            return
+
+        while self._pending and self.bucket.consume():
+            line = self._nextLine()
+            wait = self.clock.seconds() - line.queued
+            self.totalWait += wait
+            self.maxWait = max(self.maxWait, wait)
+            self.sent += 1
+            self.sendLine(line.prefix + line.text)
+
+        if self._pending:
+            self._delayedCall = self.clock.callLater(
+                self.bucket.delay(), self._delayedPump)
+
+
+    def _delayedPump(self):
+        self._delayedCall = None
+        self._pump()
+
+
+    def stop(self):
+        """
+        Stop sending, discarding any queued lines.
+        """
+        if self._delayedCall is not None:
+            self._delayedCall.cancel()
+            self._delayedCall = None
+        for queues, targets in zip(self._queues, self._targets):
+            queues.clear()
+            targets.clear()
+        self._pending = 0
+
+
+    def getMetrics(self):
+        """
+        Get the scheduler's queue depth and wait time metrics.
+
+        @rtype: C{dict}
+        @return: Mapping of:
+            - C{'queued'}: Number of lines waiting to be sent,
+            - C{'queuedByTarget'}: Mapping of targets to the number of lines
+              waiting to be sent to them,
+            - C{'sent'}: Number of lines sent,
+            - C{'merged'}: Number of lines merged into others,
+            - C{'meanWait'}: Mean seconds sent lines spent queued,
+            - C{'maxWait'}: Longest time, in seconds, a line spent queued.
+        """
+        queuedByTarget = {}
+        for queues in self._queues:
+            for target, queue in queues.iteritems():
+                queuedByTarget[target] = (
+                    queuedByTarget.get(target, 0) + len(queue))
+        meanWait = 0.0
+        if self.sent:
+            meanWait = self.totalWait / self.sent
+        return {
+            'queued': self._pending,
+            'queuedByTarget': queuedByTarget,
+            'sent': self.sent,
+            'merged': self.merged,
+            'meanWait': meanWait,
+            'maxWait': self.maxWait}
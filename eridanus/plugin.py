@@ -5,12 +5,14 @@ import itertools
 import re
 import types
 from textwrap import dedent
+from weakref import WeakKeyDictionary
 
 from eridanus import errors, plugins, util
 from eridanus.ieridanus import (
     IAmbientEventObserver, ICommand, IEridanusBrokenPlugin,
     IEridanusBrokenPluginProvider, IEridanusPlugin, IEridanusPluginProvider)
-from twisted.internet.defer import maybeDeferred
+from eridanus.irc import MessageContext
+from twisted.internet.defer import Deferred
 from twisted.plugin import getPlugins, IPlugin
 from twisted.python.components import registerAdapter
 from twisted.python.failure import Failure
@@ -56,6 +58,29 @@ def safePluginImport(globals, pluginpath):
 
 
 
+def lazyPluginImport(globals, pluginpath, name=None):
+    """
+    Declare a plugin class without importing it.
+
+    A L{LazyPlugin} is added to the global namespace in place of the plugin
+    class, the plugin's module is only imported once the class is actually
+    needed.
+
+    @param globals: Namespace to declare plugin in (usually globals())
+    @type globals: C{dict}
+
+    @param pluginpath: Full module path of the plugin to import
+    @type pluginpath: C{str}
+
+    @param name: The plugin's command name, if it differs from the default of
+        the lowercased class name
+    @type name: C{unicode}
+    """
+    lazy = LazyPlugin(pluginpath, name)
+    globals[lazy.pluginName] = lazy
+
+
+
 paramPattern = re.compile(r'([<[])(.*?)([>\]])')
 
 def formatUsage(s):
@@ -111,6 +136,17 @@ def rest(f):
 
 
 
+def contextual(f):
+    """
+    Decorate an ambient event handler with a flag indicating that it should
+    receive the L{eridanus.irc.MessageContext} for a message, instead of only
+    the message text.
+    """
+    f.contextual = True
+    return f
+
+
+
 def alias(f, name=None):
     """
     Create an alias of another command.
@@ -257,9 +293,8 @@ class CommandLookupMixin(object):
 
 
     def getCommands(self):
-        for name in dir(self):
-            if name.startswith('cmd_'):
-                yield ICommand(getattr(self, name))
+        for name in getCommandNames(type(self)):
+            yield ICommand(getattr(self, name))
 
 
     # ICommand
@@ -291,81 +326,130 @@ class SubCommand(CommandLookupMixin):
 
 
 
-class MethodCommand(object):
+_commandNames = WeakKeyDictionary()
+
+def getCommandNames(cls):
     """
-    Wraps a method in something that implements L{ICommand}.
+    Get the names of the command attributes, those beginning with C{cmd_}, of
+    C{cls}.
 
-    This is most useful when combined with L{eridanus.plugin.usage} to generate
-    (and format) the relevant help strings.
+    The names are only looked up once per class.
 
-    @ivar method: The method being wrapped
+    @rtype: C{list} of C{str}
+    """
+    names = _commandNames.get(cls)
+    if names is None:
+        names = _commandNames[cls] = [
+            name for name in dir(cls) if name.startswith('cmd_')]
+    return names
 
-    @ivar usage: The command's usage, extracted from C{method.usage}
+
+
+class CommandMetadata(object):
+    """
+    Invocation-independent details of a command method.
+
+    @ivar name: The command's name, C{func}'s name without the C{cmd_} prefix
+
+    @ivar usage: The command's usage, extracted from C{func.usage}
                  or C{defaultUsage}
     @type usage: C{str} or C{unicode}
 
-    @ivar help: The command's complete help, extracted from C{method.help}
+    @ivar shortHelp: The first line of C{help}
+
+    @ivar help: The command's complete help, extracted from C{func.help}
                 or C{defaultHelp}
     @type help: C{str} or C{unicode}
 
-    @ivar shortHelp: The first line of C{help}, which should be a brief
-                     description of the command's purpose
-    """
-    implements(ICommand)
+    @ivar rest: Should the last argument receive all remaining arguments?
 
+    @ivar alias: Is the command an alias of another command?
+
+    @ivar minargs: Minimum number of arguments
+
+    @ivar maxargs: Maximum number of arguments, or C{None} if unbounded
+    """
     defaultUsage = 'No usage information'
     defaultHelp = 'No additional help.'
 
-    def __init__(self, method):
-        super(MethodCommand, self).__init__()
-
-        usage = getattr(method, 'usage', None)
+    def __init__(self, func):
+        usage = getattr(func, 'usage', None)
         if usage is None:
             usage = self.defaultUsage
 
-        help = getattr(method, 'help', None)
+        help = getattr(func, 'help', None)
         if help is None:
             help = self.defaultHelp
 
-        self.method = method
-        self.args = IncrementalArguments(u'')
-        self.rest = getattr(method, 'rest', False)
-        self.name = method.__name__[4:]
+        self.name = func.__name__[4:]
         self.usage = usage
         self.shortHelp, self.help = formatHelp(help)
+        self.rest = getattr(func, 'rest', False)
+        self.alias = getattr(func, 'alias', False)
 
-        self.minargs, self.maxargs = self.getArgLimits()
+        minargs, maxargs = getattr(func, 'arglimits', (None, None))
+        self.minargs, self.maxargs = getCommandArgLimits(
+            func, minargs, maxargs)
 
 
-    def __repr__(self):
-        return '<%s wrapping %s>' % (type(self).__name__, self.method)
 
+_commandMetadata = WeakKeyDictionary()
 
-    def getArgLimits(self):
-        """
-        Find the minimum and maximum arguments for L{MethodCommand.method}.
+def getCommandMetadata(method):
+    """
+    Get the L{CommandMetadata} for C{method}.
 
-        If the method has an C{arglimits} 2-tuple attribute, these values
-        are used.  Otherwise the limits are calculated by inspecting the
-        method.
+    Metadata is computed once per underlying function, and shared by every
+    instance the method is bound to.
+    """
+    func = getattr(method, 'im_func', method)
+    metadata = _commandMetadata.get(func)
+    if metadata is None:
+        metadata = _commandMetadata[func] = CommandMetadata(method)
+    return metadata
 
-        Implicit and default parameters are not taken into account when
-        calculating the minimum number of arguments.
 
-        The maximum number of arguments will be unbounded if the method accepts
-        varargs.
 
-        @returns: The minimum and maximum number of arguments that the method
-                  will accept
-        @rtype: C{(min, max)}
-        """
-        minargs, maxargs = getattr(self.method, 'arglimits', (None, None))
-        return getCommandArgLimits(self.method, minargs, maxargs)
+class MethodCommand(object):
+    """
+    Wraps a method in something that implements L{ICommand}.
 
+    This is most useful when combined with L{eridanus.plugin.usage} to generate
+    (and format) the relevant help strings.
 
-    @property
-    def alias(self):
-        return getattr(self.method, 'alias', False)
+    Everything that does not depend on a particular invocation is taken from
+    the method's L{CommandMetadata}, which is only computed once per method.
+
+    @ivar method: The method being wrapped
+
+    @ivar usage: The command's usage, see L{CommandMetadata.usage}
+    @type usage: C{str} or C{unicode}
+
+    @ivar help: The command's complete help, see L{CommandMetadata.help}
+    @type help: C{str} or C{unicode}
+
+    @ivar shortHelp: The first line of C{help}, which should be a brief
+                     description of the command's purpose
+    """
+    implements(ICommand)
+
+    def __init__(self, method):
+        super(MethodCommand, self).__init__()
+        metadata = getCommandMetadata(method)
+        self.method = method
+        self.args = IncrementalArguments(u'')
+        self.rest = metadata.rest
+        self.name = metadata.name
+        self.usage = metadata.usage
+        self.shortHelp = metadata.shortHelp
+        self.help = metadata.help
+        self.alias = metadata.alias
+        self.minargs = metadata.minargs
+        self.maxargs = metadata.maxargs
+
+
+    def __repr__(self):
+        return '<%s wrapping %s>' % (type(self).__name__, self.method)
 
 
     # ICommand
@@ -441,11 +525,221 @@ class BrokenPlugin(object):
 
 
 
+class LazyPlugin(object):
+    """
+    Stand-in for a plugin class whose module has not been imported yet.
+
+    Plugin metadata is available without importing anything, the plugin class
+    is imported by L{LazyPlugin.load}.  Import errors are captured, as with
+    L{safePluginImport}, after which the plugin is considered broken.
+
+    @type pluginpath: C{str}
+    @ivar pluginpath: Full module path of the plugin class
+
+    @type plugin: C{IEridanusPluginProvider}
+    @ivar plugin: The plugin class, or C{None} if it has not been imported yet
+        or is broken
+
+    @type broken: C{IEridanusBrokenPluginProvider}
+    @ivar broken: The broken plugin, or C{None} if the plugin has not been
+        imported yet or is not broken
+    """
+    implements(IPlugin, IEridanusPluginProvider)
+
+    axiomCommands = ()
+
+    def __init__(self, pluginpath, name=None):
+        self.pluginpath = pluginpath
+        self.pluginName = pluginpath.rsplit('.', 1)[1]
+        if name is None:
+            name = self.pluginName.lower()
+        self.name = name
+        self.plugin = None
+        self.broken = None
+
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.pluginpath)
+
+
+    def __call__(self, *a, **kw):
+        plugin = self.load()
+        if plugin is None:
+            raise errors.PluginNotFound(
+                u'Plugin "%s" is broken.' % (self.pluginName,))
+        return plugin(*a, **kw)
+
+
+    @property
+    def failure(self):
+        """
+        The reason the plugin is broken, or C{None} if it is not known to be
+        broken.
+        """
+        if self.broken is None:
+            return None
+        return self.broken.failure
+
+
+    def load(self):
+        """
+        Import the plugin class, if this has not yet been attempted.
+
+        @return: The plugin class, or C{None} if it is broken
+        """
+        if self.plugin is None and self.broken is None:
+            namespace = {}
+            safePluginImport(namespace, self.pluginpath)
+            plugin = namespace[self.pluginName]
+            if IEridanusBrokenPluginProvider.providedBy(plugin):
+                self.broken = plugin
+            else:
+                self.plugin = plugin
+        return self.plugin
+
+
+
+def loadPlugin(provider):
+    """
+    Get the plugin class for an C{IEridanusPluginProvider}, importing it if it
+    is a L{LazyPlugin}.
+
+    @return: The plugin class, or C{None} if it is broken
+    """
+    if isinstance(provider, LazyPlugin):
+        return provider.load()
+    return provider
+
+
+
+class PluginRegistry(object):
+    """
+    Plugin providers discovered via C{twisted.plugin}.
+
+    Discovering plugins walks the dropin cache and imports every plugin module,
+    so this is done once and the results kept in memory, see
+    L{getPluginRegistry} and L{refreshPluginRegistry}.
+
+    Plugins declared with L{lazyPluginImport} are only known to be broken once
+    they have been loaded, working plugins that turn out to be broken are
+    moved to the broken plugins when that happens.
+    """
+    def __init__(self):
+        self._plugins = list(getPlugins(IEridanusPluginProvider, plugins))
+        self._brokenPlugins = list(
+            getPlugins(IEridanusBrokenPluginProvider, plugins))
+        self._pluginsByName = self._indexByName(self._plugins)
+        self._brokenPluginsByName = self._indexByName(self._brokenPlugins)
+
+
+    def __repr__(self):
+        return '<%s %d plugins, %d broken>' % (
+            type(self).__name__,
+            len(self._plugins),
+            len(self._brokenPlugins))
+
+
+    def _indexByName(self, providers):
+        index = {}
+        for provider in providers:
+            index.setdefault(provider.pluginName, []).append(provider)
+        return index
+
+
+    def _working(self, providers):
+        return [p for p in providers if getattr(p, 'broken', None) is None]
+
+
+    def _knownBroken(self, providers, brokenProviders):
+        return brokenProviders + [
+            p.broken for p in providers if getattr(p, 'broken', None)]
+
+
+    def _broken(self, providers, brokenProviders):
+        for provider in providers:
+            loadPlugin(provider)
+        return self._knownBroken(providers, brokenProviders)
+
+
+    @property
+    def plugins(self):
+        """
+        C{IEridanusPluginProvider}s that are not known to be broken.
+        """
+        return self._working(self._plugins)
+
+
+    @property
+    def brokenPlugins(self):
+        """
+        C{IEridanusBrokenPluginProvider}s, loading every lazy plugin to find
+        out whether it is broken.
+        """
+        return self._broken(self._plugins, self._brokenPlugins)
+
+
+    @property
+    def knownBrokenPlugins(self):
+        """
+        C{IEridanusBrokenPluginProvider}s already known to be broken, without
+        loading any lazy plugins.
+        """
+        return self._knownBroken(self._plugins, self._brokenPlugins)
+
+
+    def getPluginProviders(self, pluginName):
+        """
+        Get the C{IEridanusPluginProvider}s named C{pluginName} that are not
+        known to be broken.
+
+        @rtype: C{list}
+        """
+        return self._working(self._pluginsByName.get(pluginName, []))
+
+
+    def getBrokenPluginProviders(self, pluginName):
+        """
+        Get the C{IEridanusBrokenPluginProvider}s named C{pluginName}, loading
+        lazy plugins with the same name to find out whether they are broken.
+
+        @rtype: C{list}
+        """
+        return self._broken(
+            self._pluginsByName.get(pluginName, []),
+            self._brokenPluginsByName.get(pluginName, []))
+
+
+
+_pluginRegistry = None
+
+def getPluginRegistry():
+    """
+    Get the process-wide L{PluginRegistry}, discovering plugins if this has not
+    yet been done.
+    """
+    if _pluginRegistry is None:
+        return refreshPluginRegistry()
+    return _pluginRegistry
+
+
+
+def refreshPluginRegistry():
+    """
+    Discover plugins again, replacing the process-wide L{PluginRegistry}.
+
+    @rtype: L{PluginRegistry}
+    """
+    global _pluginRegistry
+    _pluginRegistry = PluginRegistry()
+    return _pluginRegistry
+
+
+
 def getAllPlugins():
     """
     Get all plugins.
     """
-    return getPlugins(IEridanusPluginProvider, plugins)
+    return iter(getPluginRegistry().plugins)
 
 
 
@@ -453,7 +747,7 @@ def getBrokenPlugins():
     """
     Get broken plugins.
     """
-    return getPlugins(IEridanusBrokenPluginProvider, plugins)
+    return iter(getPluginRegistry().brokenPlugins)
 
 
 
@@ -471,11 +765,41 @@ def getPluginByName(store, name):
     @returns: The plugin item
     @rtype: C{IEridanusPlugin}
     """
-    for plugin in store.powerupsFor(IEridanusPlugin):
-        if plugin.name == name:
-            return plugin
+    plugin = getPluginIndex(store).get(name)
+    if plugin is None:
+        # The plugin may have been installed by another process, such as
+        # "axiomatic eridanus plugins install", rebuild the index to find it.
+        _pluginIndexes.pop(store, None)
+        plugin = getPluginIndex(store).get(name)
+        if plugin is None:
+            raise errors.PluginNotInstalled(name)
+    return plugin
+
+
+
+_pluginIndexes = WeakKeyDictionary()
+
+def getPluginIndex(store):
+    """
+    Get a mapping of plugin names to the C{IEridanusPlugin} powerups on
+    C{store}, creating it if need be.
+
+    The index is discarded whenever plugins are installed on or uninstalled
+    from C{store} in this process, see L{powerUp} and L{powerDown}.  Plugins
+    installed by other processes are picked up by L{getPluginByName}, which
+    rebuilds the index when a plugin is not found in it.
 
-    raise errors.PluginNotInstalled(name)
+    @type store: C{axiom.store.Store}
+
+    @rtype: C{dict} mapping C{unicode} to C{IEridanusPlugin}
+    """
+    index = _pluginIndexes.get(store)
+    if index is None:
+        index = {}
+        for plugin in store.powerupsFor(IEridanusPlugin):
+            index.setdefault(plugin.name, plugin)
+        _pluginIndexes[store] = index
+    return index
 
 
 
@@ -491,9 +815,8 @@ def getPluginProvidersByName(pluginName):
     """
     Get all objects that provide C{IEridanusPluginProvider}.
     """
-    for plugin in getPlugins(IEridanusPluginProvider, plugins):
-        if plugin.pluginName == pluginName:
-            yield plugin
+    for plugin in getPluginRegistry().getPluginProviders(pluginName):
+        yield plugin
 
     raise errors.PluginNotFound(u'No plugin named "%s".' % (pluginName,))
 
@@ -503,9 +826,8 @@ def getBrokenPluginProvidersByName(pluginName):
     """
     Get all objects that provide C{IEridanusPluginProvider}.
     """
-    for plugin in getPlugins(IEridanusBrokenPluginProvider, plugins):
-        if plugin.pluginName == pluginName:
-            yield plugin
+    for plugin in getPluginRegistry().getBrokenPluginProviders(pluginName):
+        yield plugin
 
     raise errors.PluginNotFound(u'No plugin named "%s".' % (pluginName,))
 
@@ -519,6 +841,45 @@ def getAmbientEventObservers(store):
 
 
 
+def powerUp(store, powerup, interface):
+    """
+    Power up C{store} with C{powerup} for C{interface}, invalidating any
+    in-memory state derived from C{store}'s powerups.
+
+    Plugin powerups should always be installed via this function rather than
+    C{store.powerUp}.
+    """
+    store.powerUp(powerup, interface)
+    invalidatePowerups(store)
+
+
+
+def powerDown(store, powerup, interface):
+    """
+    Remove C{powerup} for C{interface} from C{store}, invalidating any
+    in-memory state derived from C{store}'s powerups.
+
+    Plugin powerups should always be removed via this function rather than
+    C{store.powerDown}.
+    """
+    store.powerDown(powerup, interface)
+    invalidatePowerups(store)
+
+
+
+def invalidatePowerups(store):
+    """
+    Discard in-memory state derived from C{store}'s powerups.
+
+    This is done by L{powerUp} and L{powerDown}, it only needs to be called
+    directly when C{store}'s powerups have been changed by another process,
+    such as C{axiomatic eridanus plugins install}.
+    """
+    _ambientEventDispatchers.pop(store, None)
+    _pluginIndexes.pop(store, None)
+
+
+
 def installPlugin(store, pluginName):
     """
     Install a plugin on a store.
@@ -530,11 +891,15 @@ def installPlugin(store, pluginName):
 
     @raises PluginNotFound: If no plugin named C{pluginName} could be found
     """
-    for plugin in getPluginProvidersByName(pluginName):
+    for provider in getPluginProvidersByName(pluginName):
+        plugin = loadPlugin(provider)
+        if plugin is None:
+            raise errors.PluginNotFound(
+                u'Plugin "%s" is broken.' % (pluginName,))
         p = store.findOrCreate(plugin)
-        store.powerUp(p, IEridanusPlugin)
+        powerUp(store, p, IEridanusPlugin)
         if IAmbientEventObserver.providedBy(plugin):
-            store.powerUp(p, IAmbientEventObserver)
+            powerUp(store, p, IAmbientEventObserver)
         return
 
     raise errors.PluginNotFound(u'No plugin named "%s".' % (pluginName,))
@@ -570,12 +935,17 @@ def uninstallPlugin(store, pluginName):
         C{store}
     """
     # XXX: this should probably use store.powerupsFor
-    for plugin in getPluginProvidersByName(pluginName):
+    for provider in getPluginProvidersByName(pluginName):
+        plugin = loadPlugin(provider)
+        if plugin is None:
+            raise errors.PluginNotInstalled(pluginName)
         p = store.findUnique(plugin, default=None)
         if p is None:
             raise errors.PluginNotInstalled(pluginName)
 
-        store.powerDown(p, IEridanusPlugin)
+        powerDown(store, p, IEridanusPlugin)
+        if IAmbientEventObserver.providedBy(plugin):
+            powerDown(store, p, IAmbientEventObserver)
         return
 
 
@@ -589,12 +959,105 @@ class AmbientEventObserver(object):
 
 
 
+def _messageTexts(args):
+    """
+    Replace any L{MessageContext} in C{args} with its message text.
+    """
+    return tuple(
+        arg.text if isinstance(arg, MessageContext) else arg for arg in args)
+
+
+
+class _AmbientEventDispatcher(object):
+    """
+    Dispatch table of ambient event handlers for a store.
+
+    Observers are queried from the store once, and the handlers for each
+    event are looked up once, the first time that event is broadcast.
+    Observers that do not implement an event, or only inherit the no-op
+    implementation from L{AmbientEventObserver}, are left out of that event's
+    handlers.
+
+    @ivar observers: C{IAmbientEventObserver} powerups of the store
+
+    @ivar handlers: Mapping of event names to C{list}s of
+        C{(boundMethod, contextual)}
+    """
+    def __init__(self, store):
+        self.observers = list(getAmbientEventObservers(store))
+        self.handlers = {}
+
+
+    def _findHandlers(self, eventName):
+        noop = getattr(AmbientEventObserver, eventName, None)
+        for obs in self.observers:
+            meth = getattr(obs, eventName, None)
+            if meth is None:
+                continue
+            func = getattr(meth, 'im_func', None)
+            if noop is not None and func is noop.im_func:
+                continue
+            yield meth, getattr(meth, 'contextual', False)
+
+
+    def getHandlers(self, eventName):
+        """
+        Get the handlers for C{eventName}.
+
+        @rtype: C{list} of C{(boundMethod, contextual)}
+        """
+        handlers = self.handlers.get(eventName)
+        if handlers is None:
+            handlers = self.handlers[eventName] = list(
+                self._findHandlers(eventName))
+        return handlers
+
+
+
+_ambientEventDispatchers = WeakKeyDictionary()
+
+def getAmbientEventDispatcher(store):
+    """
+    Get the L{_AmbientEventDispatcher} for C{store}, creating it if need be.
+
+    The dispatcher is discarded whenever plugins are installed on or
+    uninstalled from C{store} in this process, see L{powerUp} and
+    L{powerDown}.  Observers installed by other processes are not noticed
+    until L{invalidatePowerups} is called, for example by the
+    C{refreshplugins} command.
+    """
+    dispatcher = _ambientEventDispatchers.get(store)
+    if dispatcher is None:
+        dispatcher = _ambientEventDispatchers[store] = _AmbientEventDispatcher(
+            store)
+    return dispatcher
+
+
+
 def broadcastAmbientEvent(appStore, eventName, source, *args, **kw):
-    for obs in getAmbientEventObservers(appStore):
-        meth = getattr(obs, eventName, None)
-        if meth is not None:
-            d = maybeDeferred(meth, source, *args, **kw)
-            d.addErrback(source.logFailure)
+    """
+    Broadcast an ambient event to all L{IAmbientEventObserver}s on
+    C{appStore}.
+
+    Event handlers that are not decorated with L{contextual} receive the
+    message text in place of any L{MessageContext} argument.  Failures, both
+    raised and asynchronous, are logged via C{source.logFailure}.
+    """
+    textArgs = None
+    for meth, isContextual in getAmbientEventDispatcher(appStore).getHandlers(
+            eventName):
+        callArgs = args
+        if not isContextual:
+            if textArgs is None:
+                textArgs = _messageTexts(args)
+            callArgs = textArgs
+        try:
+            result = meth(source, *callArgs, **kw)
+        except:
+            source.logFailure(Failure())
+        else:
+            if isinstance(result, Deferred):
+                result.addErrback(source.logFailure)
 
 
 
@@ -6,11 +6,11 @@ from functools import partial
 
 from eridanus import plugin
 
-importPlugin = partial(plugin.safePluginImport, globals())
+importPlugin = partial(plugin.lazyPluginImport, globals())
 
 importPlugin('eridanusstd.plugindefs.google.Google')
 importPlugin('eridanusstd.plugindefs.admin.Admin')
-importPlugin('eridanusstd.plugindefs.authenticate.Authenticate')
+importPlugin('eridanusstd.plugindefs.authenticate.Authenticate', u'auth')
 importPlugin('eridanusstd.plugindefs.topic.Topic')
 importPlugin('eridanusstd.plugindefs.dict.Dict')
 importPlugin('eridanusstd.plugindefs.time.Time')
@@ -19,15 +19,15 @@ importPlugin('eridanusstd.plugindefs.factoid.Factoid')
 importPlugin('eridanusstd.plugindefs.math.Math')
 importPlugin('eridanusstd.plugindefs.fortune.Fortune')
 importPlugin('eridanusstd.plugindefs.imdb.IMDB')
-importPlugin('eridanusstd.plugindefs.xboxlive.XboxLive')
+importPlugin('eridanusstd.plugindefs.xboxlive.XboxLive', u'xbl')
 importPlugin('eridanusstd.plugindefs.currency.Currency')
 importPlugin('eridanusstd.plugindefs.memo.Memo')
 importPlugin('eridanusstd.plugindefs.weather.Weather')
 importPlugin('eridanusstd.plugindefs.qdb.QDB')
 importPlugin('eridanusstd.plugindefs.unicode.Unicode')
 importPlugin('eridanusstd.plugindefs.rand.Random')
-importPlugin('eridanusstd.plugindefs.linkdb.LinkDB')
-importPlugin('eridanusstd.plugindefs.linkdb.LinkDBAdmin')
+importPlugin('eridanusstd.plugindefs.linkdb.LinkDB', u'url')
+importPlugin('eridanusstd.plugindefs.linkdb.LinkDBAdmin', u'url')
 importPlugin('eridanusstd.plugindefs.twitter.Twitter')
 importPlugin('eridanusstd.plugindefs.alias.Alias')
 importPlugin('eridanusstd.plugindefs.feedupdates.FeedUpdates')
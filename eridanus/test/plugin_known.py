@@ -6,10 +6,10 @@ from zope.interface import classProvides
 from twisted.plugin import IPlugin
 
 from axiom.item import Item
-from axiom.attributes import integer
+from axiom.attributes import integer, inmemory
 
-from eridanus.ieridanus import IEridanusPluginProvider
-from eridanus.plugin import Plugin
+from eridanus.ieridanus import IEridanusPluginProvider, IAmbientEventObserver
+from eridanus.plugin import AmbientEventObserver, Plugin
 
 
 
@@ -23,3 +23,22 @@ class Known(Item, Plugin):
 
     def cmd_test(self, source, foo, bar):
         return (foo, bar)
+
+
+
+class KnownObserver(Item, Plugin, AmbientEventObserver):
+    """
+    A little plugin that watches things.
+    """
+    classProvides(IPlugin, IEridanusPluginProvider, IAmbientEventObserver)
+
+    dummy = integer()
+
+    events = inmemory()
+
+    def activate(self):
+        self.events = []
+
+
+    def joinedChannel(self, source):
+        self.events.append(('joinedChannel', source))
@@ -38,6 +38,7 @@ class AvatarTests(TestCase):
     def setUp(self):
         self.store = Store()
         self.patch(plugin, 'getPlugins', self.getPlugins)
+        self.patch(plugin, '_pluginRegistry', None)
         installPlugin(self.store, u'Known')
         self.avatar = MockAvatar()
 
@@ -0,0 +1,156 @@
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from axiom.store import Store
+
+from eridanus import outbound, plugin
+from eridanus.bot import IRCBot, IRCBotConfig
+
+
+
+class IRCBotConfigTests(TestCase):
+    """
+    Tests for L{eridanus.bot.IRCBotConfig}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.config = IRCBotConfig(store=self.store)
+
+
+    def test_ignores(self):
+        """
+        Adding and removing ignores is reflected by
+        L{eridanus.bot.IRCBotConfig.isIgnored}.
+        """
+        host = u'joe!joebloggs@example.com'
+        self.assertFalse(self.config.isIgnored(host))
+        self.assertEqual(self.config.addIgnore(u'joe'), u'joe!*@*')
+        self.assertTrue(self.config.isIgnored(host))
+        self.assertEqual(self.config.removeIgnore(u'joe'), [u'joe!*@*'])
+        self.assertFalse(self.config.isIgnored(host))
+
+
+    def test_ignoresAssigned(self):
+        """
+        Assigning C{ignores} directly is also reflected by
+        L{eridanus.bot.IRCBotConfig.isIgnored}.
+        """
+        matcher = self.config.getIgnoreMatcher()
+        self.assertIdentical(self.config.getIgnoreMatcher(), matcher)
+        self.config.ignores = [u'*!*@example.com']
+        self.assertTrue(self.config.isIgnored(u'joe!joebloggs@example.com'))
+
+
+
+class IRCBotOutboundTests(TestCase):
+    """
+    Tests for L{eridanus.bot.IRCBot}'s outbound messages.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.config = IRCBotConfig(
+            store=self.store, nickname=u'bot', floodBurst=1)
+        self.bot = IRCBot(self.store, 'test', None, None, self.config)
+        self.transport = StringTransport()
+        self.bot.makeConnection(self.transport)
+        self.clock = Clock()
+        self.bot.scheduler = outbound.OutboundScheduler(
+            self.bot.sendLine,
+            outbound.TokenBucket(1, 2.0, self.clock),
+            self.clock)
+        self.transport.clear()
+
+
+    def test_messages(self):
+        """
+        Messages are sent via the outbound scheduler, replies before ambient
+        notices.  Ambient notices to the same target are merged while they
+        wait.
+        """
+        self.bot.notice('#a', 'one', ambient=True)
+        self.bot.notice('#a', 'two', ambient=True)
+        self.bot.notice('#a', 'three', ambient=True)
+        self.bot.msg('#b', 'four\nfive')
+        self.clock.advance(2)
+        self.clock.advance(2)
+        self.clock.advance(2)
+        self.assertEqual(
+            self.transport.value().splitlines(),
+            ['NOTICE #a :one',
+             'PRIVMSG #b :four',
+             'PRIVMSG #b :five',
+             'NOTICE #a :two | three'])
+
+
+    def test_replyNotices(self):
+        """
+        Notices that are not ambient, such as command output, are sent with
+        replies, ahead of ambient notices, and are not merged.
+        """
+        self.bot.notice('#a', 'one', ambient=True)
+        self.bot.notice('#a', 'two', ambient=True)
+        self.bot.notice('#b', 'three')
+        self.bot.notice('#b', 'four')
+        for i in xrange(3):
+            self.clock.advance(2)
+        self.assertEqual(
+            self.transport.value().splitlines(),
+            ['NOTICE #a :one',
+             'NOTICE #b :three',
+             'NOTICE #b :four',
+             'NOTICE #a :two'])
+
+
+    def test_ctcp(self):
+        """
+        CTCP replies are neither merged with other notices nor split.
+        """
+        self.bot.notice('#a', 'one', ambient=True)
+        self.bot.notice('#a', 'two', ambient=True)
+        self.bot.ctcpMakeReply('#a', [('PING', '1')])
+        self.bot.ctcpMakeReply('#a', [('PING', '2')])
+        self.bot.ctcpMakeReply('#a', [('VERSION', 'x' * 1000)])
+        self.bot.notice('#a', '\x01ACTION three\x01', ambient=True)
+        for i in xrange(5):
+            self.clock.advance(2)
+        self.assertEqual(
+            self.transport.value().splitlines(),
+            ['NOTICE #a :one',
+             'NOTICE #a :\x01PING 1\x01',
+             'NOTICE #a :\x01PING 2\x01',
+             'NOTICE #a :\x01VERSION %s\x01' % ('x' * 1000,),
+             'NOTICE #a :two',
+             'NOTICE #a :\x01ACTION three\x01'])
+
+
+    def test_connectionLost(self):
+        """
+        Queued messages are discarded when the connection is lost.
+        """
+        self.bot.msg('#a', 'one')
+        self.bot.msg('#a', 'two')
+        self.bot.connectionLost(None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class IRCBotPluginTests(TestCase):
+    """
+    Tests for L{eridanus.bot.IRCBot}'s plugin management.
+    """
+    def test_refreshPlugins(self):
+        """
+        Refreshing plugins discards in-memory state derived from the app
+        store's powerups, so that plugins installed by other processes are
+        picked up.
+        """
+        store = Store()
+        config = IRCBotConfig(store=store, nickname=u'bot')
+        bot = IRCBot(store, 'test', None, None, config)
+        registry = object()
+        self.patch(plugin, 'refreshPluginRegistry', lambda: registry)
+        dispatcher = plugin.getAmbientEventDispatcher(store)
+        self.assertIdentical(bot.refreshPlugins(), registry)
+        self.assertNotIdentical(
+            plugin.getAmbientEventDispatcher(store), dispatcher)
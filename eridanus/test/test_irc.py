@@ -0,0 +1,78 @@
+from twisted.trial.unittest import TestCase
+
+from nevow.url import URL
+
+from eridanus import iriparse
+from eridanus.irc import MessageContext
+
+
+
+class MessageContextTests(TestCase):
+    """
+    Tests for L{eridanus.irc.MessageContext}.
+    """
+    def test_undirected(self):
+        """
+        Messages not addressed to the bot are left intact.
+        """
+        context = MessageContext(u'Hello World', u'Bot')
+        self.assertFalse(context.isDirected)
+        self.assertEquals(context.text, u'Hello World')
+        self.assertEquals(context.lowerText, u'hello world')
+
+
+    def test_directed(self):
+        """
+        Messages addressed to the bot, with either C{:} or C{,}, are marked as
+        directed and have the bot's nickname removed, regardless of case.
+        """
+        for message in [u'bot: Hello World', u'BOT,  Hello World ']:
+            context = MessageContext(message, u'Bot')
+            self.assertTrue(context.isDirected)
+            self.assertEquals(context.text, u'Hello World')
+            self.assertEquals(context.lowerText, u'hello world')
+
+        context = MessageContext(u'botany: Hello World', u'Bot')
+        self.assertFalse(context.isDirected)
+
+
+    def test_urls(self):
+        """
+        URLs in the message are available with their positions, with their
+        trailing comments and parsed as L{nevow.url.URL}s, only for the
+        supported schemes.
+        """
+        context = MessageContext(
+            u'http://a.b/ [first] ftp://c.d/ gopher://e.f/ -- last',
+            u'Bot',
+            [u'http', u'gopher'])
+        self.assertEquals(
+            context.urlsWithPosition,
+            ((u'http://a.b/', 11), (u'gopher://e.f/', 44)))
+        self.assertEquals(
+            context.urlsWithComments,
+            ((u'http://a.b/', u'first'), (u'gopher://e.f/', u'last')))
+        self.assertEquals(
+            context.urls,
+            (URL.fromString(u'http://a.b/'), URL.fromString(u'gopher://e.f/')))
+
+
+    def test_urlsMemoized(self):
+        """
+        URLs are only extracted from the message once, no matter how many
+        times, or in which form, they are asked for.
+        """
+        calls = []
+        def extractURLsWithPosition(*a):
+            calls.append(a)
+            return [(u'http://a.b/', 11)]
+        self.patch(
+            iriparse, 'extractURLsWithPosition', extractURLsWithPosition)
+
+        context = MessageContext(u'http://a.b/', u'Bot')
+        self.assertIdentical(context.urls, context.urls)
+        self.assertIdentical(
+            context.urlsWithComments, context.urlsWithComments)
+        self.assertIdentical(
+            context.urlsWithPosition, context.urlsWithPosition)
+        self.assertEquals(calls, [(u'http://a.b/', None)])
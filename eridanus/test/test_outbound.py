@@ -0,0 +1,154 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from eridanus import outbound
+
+
+
+class TokenBucketTests(TestCase):
+    """
+    Tests for L{eridanus.outbound.TokenBucket}.
+    """
+    def test_burst(self):
+        """
+        Tokens can be consumed up to the bucket's capacity, after which they
+        are refilled at a constant rate.
+        """
+        clock = Clock()
+        bucket = outbound.TokenBucket(2, 2.0, clock)
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        self.assertEqual(bucket.delay(), 2.0)
+        clock.advance(1)
+        self.assertFalse(bucket.consume())
+        self.assertEqual(bucket.delay(), 1.0)
+        clock.advance(1)
+        self.assertTrue(bucket.consume())
+        clock.advance(60)
+        self.assertEqual(bucket.tokens, 0)
+        self.assertEqual(bucket.delay(), 0.0)
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+
+
+class OutboundSchedulerTests(TestCase):
+    """
+    Tests for L{eridanus.outbound.OutboundScheduler}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.lines = []
+        self.scheduler = outbound.OutboundScheduler(
+            self.lines.append,
+            outbound.TokenBucket(1, 1.0, self.clock),
+            self.clock)
+
+
+    def sendAll(self):
+        """
+        Advance the clock until all queued lines are sent.
+        """
+        while self.scheduler.getMetrics()['queued']:
+            self.clock.advance(1)
+
+
+    def test_rateLimited(self):
+        """
+        Lines are sent immediately while tokens are available, after that they
+        are sent as tokens become available.
+        """
+        self.scheduler.enqueue('#a', 'PRIVMSG #a :', 'one')
+        self.scheduler.enqueue('#a', 'PRIVMSG #a :', 'two')
+        self.assertEqual(self.lines, ['PRIVMSG #a :one'])
+        self.clock.advance(0.5)
+        self.assertEqual(self.lines, ['PRIVMSG #a :one'])
+        self.clock.advance(0.5)
+        self.assertEqual(self.lines, ['PRIVMSG #a :one', 'PRIVMSG #a :two'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_fairness(self):
+        """
+        Targets take turns sending lines.
+        """
+        for text in ['one', 'two', 'three']:
+            self.scheduler.enqueue('#a', 'PRIVMSG #a :', text)
+        self.scheduler.enqueue('#b', 'PRIVMSG #b :', 'four')
+        self.scheduler.enqueue('#c', 'PRIVMSG #c :', 'five')
+        self.sendAll()
+        self.assertEqual(self.lines, [
+            'PRIVMSG #a :one',
+            'PRIVMSG #a :two',
+            'PRIVMSG #b :four',
+            'PRIVMSG #c :five',
+            'PRIVMSG #a :three'])
+
+
+    def test_priority(self):
+        """
+        Replies are sent before ambient lines.
+        """
+        self.scheduler.enqueue('#a', 'NOTICE #a :', 'one', outbound.AMBIENT)
+        self.scheduler.enqueue('#a', 'NOTICE #a :', 'two', outbound.AMBIENT)
+        self.scheduler.enqueue('#b', 'PRIVMSG #b :', 'three', outbound.REPLY)
+        self.sendAll()
+        self.assertEqual(self.lines, [
+            'NOTICE #a :one',
+            'PRIVMSG #b :three',
+            'NOTICE #a :two'])
+
+
+    def test_merge(self):
+        """
+        Mergeable lines queued to the same target are merged, as long as the
+        result fits.
+        """
+        self.scheduler.enqueue('#a', 'PRIVMSG #a :', 'one')
+        for text in ['two', 'three', 'four']:
+            self.scheduler.enqueue(
+                '#a', 'NOTICE #a :', text, outbound.AMBIENT, 25)
+        self.scheduler.enqueue('#a', 'NOTICE #a :', 'five', outbound.AMBIENT)
+        self.sendAll()
+        self.assertEqual(self.lines, [
+            'PRIVMSG #a :one',
+            'NOTICE #a :two | three',
+            'NOTICE #a :four',
+            'NOTICE #a :five'])
+        self.assertEqual(self.scheduler.merged, 1)
+
+
+    def test_metrics(self):
+        """
+        The scheduler keeps track of queue depth and the time lines spend
+        queued.
+        """
+        self.scheduler.enqueue('#a', 'PRIVMSG #a :', 'one')
+        self.scheduler.enqueue('#a', 'PRIVMSG #a :', 'two')
+        self.scheduler.enqueue('#b', 'PRIVMSG #b :', 'three')
+        metrics = self.scheduler.getMetrics()
+        self.assertEqual(metrics['queued'], 2)
+        self.assertEqual(metrics['queuedByTarget'], {'#a': 1, '#b': 1})
+        self.assertEqual(metrics['sent'], 1)
+        self.sendAll()
+        metrics = self.scheduler.getMetrics()
+        self.assertEqual(metrics['queued'], 0)
+        self.assertEqual(metrics['queuedByTarget'], {})
+        self.assertEqual(metrics['sent'], 3)
+        self.assertEqual(metrics['maxWait'], 2.0)
+        self.assertEqual(metrics['meanWait'], 1.0)
+
+
+    def test_stop(self):
+        """
+        Stopping the scheduler discards queued lines.
+        """
+        self.scheduler.enqueue('#a', 'PRIVMSG #a :', 'one')
+        self.scheduler.enqueue('#a', 'PRIVMSG #a :', 'two')
+        self.scheduler.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.scheduler.getMetrics()['queued'], 0)
+        self.clock.advance(10)
+        self.assertEqual(self.lines, ['PRIVMSG #a :one'])
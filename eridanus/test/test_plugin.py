@@ -1,10 +1,17 @@
 from twisted.trial import unittest
+from twisted.internet.defer import fail
 
-from eridanus import errors
+from axiom.store import Store
+
+from eridanus import errors, plugin
 from eridanus.ieridanus import (ICommand, IEridanusPluginProvider,
-    IEridanusPlugin, IEridanusBrokenPlugin, IEridanusBrokenPluginProvider)
+    IEridanusPlugin, IEridanusBrokenPlugin, IEridanusBrokenPluginProvider,
+    IAmbientEventObserver)
+from eridanus.irc import MessageContext
 from eridanus.plugin import (safePluginImport, MethodCommand, rest,
-    IncrementalArguments)
+    IncrementalArguments, contextual, installPlugin, uninstallPlugin)
+
+from eridanus.test import plugin_known
 
 
 # Make pyflakes happy
@@ -44,6 +51,66 @@ class SafePluginImportTests(unittest.TestCase):
 
 
 
+class LazyPluginTests(unittest.TestCase):
+    """
+    Tests for L{eridanus.plugin.LazyPlugin}.
+    """
+    def setUp(self):
+        self.imports = []
+        safePluginImport = plugin.safePluginImport
+        def _safePluginImport(globals, pluginpath):
+            self.imports.append(pluginpath)
+            return safePluginImport(globals, pluginpath)
+        self.patch(plugin, 'safePluginImport', _safePluginImport)
+
+
+    def test_metadata(self):
+        """
+        Lazy plugins provide plugin metadata without importing the plugin.
+        """
+        namespace = {}
+        plugin.lazyPluginImport(
+            namespace, 'eridanus.test.plugin_working.UselessPlugin')
+        plugin.lazyPluginImport(
+            namespace, 'eridanus.test.plugin_broken.SadPlugin', u'sad')
+        useless = namespace['UselessPlugin']
+        self.assertEquals(useless.pluginName, 'UselessPlugin')
+        self.assertEquals(useless.name, 'uselessplugin')
+        self.assertTrue(IEridanusPluginProvider.providedBy(useless))
+        self.assertEquals(namespace['SadPlugin'].name, u'sad')
+        self.assertEquals(self.imports, [])
+
+
+    def test_load(self):
+        """
+        Loading a lazy plugin imports the plugin class, once.
+        """
+        from eridanus.test.plugin_working import UselessPlugin
+        lazy = plugin.LazyPlugin('eridanus.test.plugin_working.UselessPlugin')
+        self.assertIdentical(lazy.load(), UselessPlugin)
+        self.assertIdentical(lazy.load(), UselessPlugin)
+        self.assertIdentical(plugin.loadPlugin(lazy), UselessPlugin)
+        self.assertIdentical(lazy.failure, None)
+        self.assertEquals(
+            self.imports, ['eridanus.test.plugin_working.UselessPlugin'])
+
+
+    def test_loadBroken(self):
+        """
+        Loading a lazy plugin that fails to import captures the failure and
+        marks the plugin as broken.
+        """
+        lazy = plugin.LazyPlugin('eridanus.test.plugin_broken.SadPlugin')
+        self.assertIdentical(lazy.load(), None)
+        self.assertIdentical(lazy.load(), None)
+        self.assertTrue(IEridanusBrokenPluginProvider.providedBy(lazy.broken))
+        self.assertEquals(lazy.failure.type, ImportError)
+        self.assertRaises(errors.PluginNotFound, lazy)
+        self.assertEquals(
+            self.imports, ['eridanus.test.plugin_broken.SadPlugin'])
+
+
+
 class MethodCommandTests(unittest.TestCase):
     """
     Tests for L{eridanus.plugin.MethodCommand}.
@@ -272,3 +339,459 @@ class IncrementalArgumentsTests(unittest.TestCase):
         self.assertEquals(
             repr(args),
             "<IncrementalArguments tail=u'\"bar\" baz'>")
+
+
+
+class FakeSource(object):
+    """
+    A source that records logged failures.
+    """
+    def __init__(self):
+        self.failures = []
+
+
+    def logFailure(self, f, msg=None):
+        self.failures.append(f)
+
+
+
+class Observer(object):
+    """
+    An ambient event observer that records the events it receives.
+    """
+    def __init__(self):
+        self.events = []
+
+
+    def publicMessageReceived(self, source, message):
+        self.events.append(('publicMessageReceived', source, message))
+
+
+
+class ContextualObserver(Observer):
+    """
+    An ambient event observer that receives message contexts.
+    """
+    @contextual
+    def publicMessageReceived(self, source, context):
+        self.events.append(('publicMessageReceived', source, context))
+
+
+
+class BroadcastAmbientEventTests(unittest.TestCase):
+    """
+    Tests for L{eridanus.plugin.broadcastAmbientEvent}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.observers = [Observer(), ContextualObserver()]
+        self.queries = []
+        self.source = FakeSource()
+        self.patch(
+            plugin, 'getAmbientEventObservers', self.getAmbientEventObservers)
+
+
+    def getAmbientEventObservers(self, store):
+        """
+        Monkey patched version of
+        L{eridanus.plugin.getAmbientEventObservers}.
+        """
+        self.queries.append(store)
+        return self.observers
+
+
+    def test_messageContext(self):
+        """
+        Event handlers decorated with L{eridanus.plugin.contextual} receive
+        the L{eridanus.irc.MessageContext} while other handlers receive only
+        the message text.
+        """
+        context = MessageContext(u'hello http://a.b/', u'Bot')
+        plugin.broadcastAmbientEvent(
+            self.store, 'publicMessageReceived', self.source, context)
+        legacy, contextualObserver = self.observers
+        self.assertEquals(
+            legacy.events,
+            [('publicMessageReceived', self.source, u'hello http://a.b/')])
+        self.assertEquals(
+            contextualObserver.events,
+            [('publicMessageReceived', self.source, context)])
+        self.assertEquals(self.source.failures, [])
+
+
+    def test_missingEvent(self):
+        """
+        Observers that do not handle an event are skipped.
+        """
+        plugin.broadcastAmbientEvent(self.store, 'joinedChannel', self.source)
+        for observer in self.observers:
+            self.assertEquals(observer.events, [])
+        self.assertEquals(self.source.failures, [])
+
+
+    def test_noopEvent(self):
+        """
+        Observers that only inherit the no-op event handlers from
+        L{eridanus.plugin.AmbientEventObserver} are never called.
+        """
+        calls = []
+        class NoopObserver(plugin.AmbientEventObserver):
+            def __getattribute__(self, name):
+                calls.append(name)
+                return object.__getattribute__(self, name)
+
+        self.observers = [NoopObserver()]
+        handlers = plugin.getAmbientEventDispatcher(self.store).getHandlers(
+            'publicMessageReceived')
+        self.assertEquals(handlers, [])
+        del calls[:]
+        plugin.broadcastAmbientEvent(
+            self.store, 'publicMessageReceived', self.source, u'hello')
+        self.assertEquals(calls, [])
+
+
+    def test_cachedObservers(self):
+        """
+        Observers are only queried from the store once, no matter how many
+        events are broadcast.
+        """
+        for i in xrange(3):
+            plugin.broadcastAmbientEvent(
+                self.store, 'publicMessageReceived', self.source, u'hello')
+            plugin.broadcastAmbientEvent(
+                self.store, 'joinedChannel', self.source)
+        self.assertEquals(self.queries, [self.store])
+        self.assertEquals(len(self.observers[0].events), 3)
+
+
+    def test_failures(self):
+        """
+        Exceptions raised by event handlers, and failed C{Deferred}s returned
+        by them, are logged without interrupting the broadcast.
+        """
+        class Broken(Observer):
+            def publicMessageReceived(self, source, message):
+                Observer.publicMessageReceived(self, source, message)
+                raise RuntimeError()
+
+        class Failing(Observer):
+            def publicMessageReceived(self, source, message):
+                Observer.publicMessageReceived(self, source, message)
+                return fail(ValueError())
+
+        self.observers = [Broken(), Failing(), Observer()]
+        plugin.broadcastAmbientEvent(
+            self.store, 'publicMessageReceived', self.source, u'hello')
+        self.assertEquals(
+            [f.type for f in self.source.failures],
+            [RuntimeError, ValueError])
+        for observer in self.observers:
+            self.assertEquals(len(observer.events), 1)
+
+
+
+class AmbientEventDispatchInvalidationTests(unittest.TestCase):
+    """
+    Tests for invalidating the ambient event dispatch table.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.source = FakeSource()
+        self.patch(plugin, 'getPlugins', self.getPlugins)
+        self.patch(plugin, '_pluginRegistry', None)
+
+
+    def getPlugins(self, this, that):
+        """
+        Monkey patched version of C{twisted.plugin.getPlugins}.
+        """
+        yield plugin_known.KnownObserver
+
+
+    def broadcast(self):
+        plugin.broadcastAmbientEvent(self.store, 'joinedChannel', self.source)
+
+
+    def test_installUninstall(self):
+        """
+        Installing a plugin makes it receive subsequent events, uninstalling
+        it stops it from receiving events.
+        """
+        self.broadcast()
+        installPlugin(self.store, u'KnownObserver')
+        observer = self.store.findUnique(plugin_known.KnownObserver)
+        self.broadcast()
+        self.assertEquals(observer.events, [('joinedChannel', self.source)])
+
+        uninstallPlugin(self.store, u'KnownObserver')
+        self.broadcast()
+        self.assertEquals(observer.events, [('joinedChannel', self.source)])
+
+
+    def test_installedElsewhere(self):
+        """
+        Observers installed without invalidating the dispatch table, for
+        example by another process, receive events once
+        L{eridanus.plugin.invalidatePowerups} is called.
+        """
+        self.broadcast()
+        observer = plugin_known.KnownObserver(store=self.store)
+        self.store.powerUp(observer, IAmbientEventObserver)
+        self.broadcast()
+        self.assertEquals(observer.events, [])
+
+        plugin.invalidatePowerups(self.store)
+        self.broadcast()
+        self.assertEquals(observer.events, [('joinedChannel', self.source)])
+
+
+
+class PluginIndexTests(unittest.TestCase):
+    """
+    Tests for L{eridanus.plugin.getPluginByName} and
+    L{eridanus.plugin.getPluginIndex}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.userStore = Store()
+        self.patch(plugin, 'getPlugins', self.getPlugins)
+        self.patch(plugin, '_pluginRegistry', None)
+
+
+    def getPlugins(self, this, that):
+        """
+        Monkey patched version of C{twisted.plugin.getPlugins}.
+        """
+        yield plugin_known.Known
+        yield plugin_known.KnownObserver
+
+
+    def test_getPluginByName(self):
+        """
+        Installed plugins can be found by name, plugins that are not installed
+        cannot.
+        """
+        installPlugin(self.store, u'Known')
+        known = self.store.findUnique(plugin_known.Known)
+        self.assertIdentical(
+            plugin.getPluginByName(self.store, u'known'), known)
+        self.assertRaises(errors.PluginNotInstalled,
+            plugin.getPluginByName, self.store, u'knownobserver')
+
+
+    def test_cached(self):
+        """
+        The store is only queried once for its plugins, no matter how many
+        installed plugins are looked up.  Looking up a plugin that is not
+        installed queries the store again.
+        """
+        installPlugin(self.store, u'Known')
+        queries = []
+        powerupsFor = self.store.powerupsFor
+        def _powerupsFor(interface):
+            queries.append(interface)
+            return powerupsFor(interface)
+        self.store.powerupsFor = _powerupsFor
+
+        for i in xrange(3):
+            plugin.getPluginByName(self.store, u'known')
+        self.assertEquals(queries, [IEridanusPlugin])
+        self.assertRaises(errors.PluginNotInstalled,
+            plugin.getPluginByName, self.store, u'missing')
+        self.assertEquals(queries, [IEridanusPlugin] * 2)
+
+
+    def test_installedElsewhere(self):
+        """
+        Plugins installed without invalidating the index, for example by
+        another process, are found once they are looked up.
+        """
+        self.assertEquals(plugin.getPluginIndex(self.store), {})
+        known = plugin_known.Known(store=self.store)
+        self.store.powerUp(known, IEridanusPlugin)
+        self.assertIdentical(
+            plugin.getPluginByName(self.store, u'known'), known)
+
+
+    def test_installUninstall(self):
+        """
+        Installing or uninstalling a plugin, whether globally or on a user's
+        store, is reflected in that store's index only.
+        """
+        installPlugin(self.store, u'Known')
+        self.assertEquals(plugin.getPluginIndex(self.userStore), {})
+
+        installPlugin(self.userStore, u'KnownObserver')
+        self.assertEquals(
+            sorted(plugin.getPluginIndex(self.userStore)), [u'knownobserver'])
+        self.assertEquals(
+            sorted(plugin.getPluginIndex(self.store)), [u'known'])
+
+        installPlugin(self.store, u'KnownObserver')
+        self.assertEquals(
+            sorted(plugin.getPluginIndex(self.store)),
+            [u'known', u'knownobserver'])
+
+        uninstallPlugin(self.store, u'Known')
+        self.assertEquals(
+            sorted(plugin.getPluginIndex(self.store)), [u'knownobserver'])
+        self.assertRaises(errors.PluginNotInstalled,
+            plugin.getPluginByName, self.store, u'known')
+
+        uninstallPlugin(self.userStore, u'KnownObserver')
+        self.assertEquals(plugin.getPluginIndex(self.userStore), {})
+
+
+
+class PluginRegistryTests(unittest.TestCase):
+    """
+    Tests for L{eridanus.plugin.PluginRegistry}.
+    """
+    def setUp(self):
+        self.discoveries = []
+        self.patch(plugin, 'getPlugins', self.getPlugins)
+        self.patch(plugin, '_pluginRegistry', None)
+
+
+    def getPlugins(self, interface, package):
+        """
+        Monkey patched version of C{twisted.plugin.getPlugins}.
+        """
+        self.discoveries.append(interface)
+        if interface is IEridanusPluginProvider:
+            yield plugin_known.Known
+            yield plugin_known.KnownObserver
+
+
+    def test_discoverOnce(self):
+        """
+        Plugins are only discovered once, no matter how many times they are
+        looked up.
+        """
+        for i in xrange(3):
+            self.assertEquals(
+                list(plugin.getAllPlugins()),
+                [plugin_known.Known, plugin_known.KnownObserver])
+            self.assertEquals(list(plugin.getBrokenPlugins()), [])
+            self.assertEquals(
+                list(plugin.getPluginRegistry().getPluginProviders(u'Known')),
+                [plugin_known.Known])
+        self.assertEquals(
+            self.discoveries,
+            [IEridanusPluginProvider, IEridanusBrokenPluginProvider])
+
+
+    def test_getPluginProvidersByName(self):
+        """
+        L{eridanus.plugin.getPluginProvidersByName} produces the plugins with
+        a matching name and then raises L{errors.PluginNotFound}.
+        """
+        providers = plugin.getPluginProvidersByName(u'KnownObserver')
+        self.assertIdentical(providers.next(), plugin_known.KnownObserver)
+        self.assertRaises(errors.PluginNotFound, providers.next)
+        self.assertRaises(errors.PluginNotFound,
+            plugin.getPluginProvidersByName(u'Unknown').next)
+
+
+    def test_refresh(self):
+        """
+        Refreshing the registry discovers plugins again.
+        """
+        registry = plugin.getPluginRegistry()
+        self.assertIdentical(plugin.getPluginRegistry(), registry)
+        newRegistry = plugin.refreshPluginRegistry()
+        self.assertNotIdentical(newRegistry, registry)
+        self.assertIdentical(plugin.getPluginRegistry(), newRegistry)
+        self.assertEquals(len(self.discoveries), 4)
+
+
+    def test_lazyPlugins(self):
+        """
+        Lazy plugins are considered working until they are loaded, broken
+        plugins are discovered by loading them when broken plugins are asked
+        for.
+        """
+        self.patch(plugin, 'getPlugins', lambda interface, package: iter(
+            {IEridanusPluginProvider: [self.useless, self.sad]}.get(
+                interface, [])))
+        self.useless = plugin.LazyPlugin(
+            'eridanus.test.plugin_working.UselessPlugin')
+        self.sad = plugin.LazyPlugin('eridanus.test.plugin_broken.SadPlugin')
+
+        registry = plugin.refreshPluginRegistry()
+        self.assertEquals(registry.plugins, [self.useless, self.sad])
+        self.assertEquals(registry.knownBrokenPlugins, [])
+        self.assertIdentical(self.sad.plugin, None)
+        self.assertIdentical(self.sad.broken, None)
+        self.assertEquals(registry.getPluginProviders('SadPlugin'), [self.sad])
+        self.assertEquals(
+            registry.getBrokenPluginProviders('SadPlugin'), [self.sad.broken])
+        self.assertEquals(registry.getPluginProviders('SadPlugin'), [])
+        self.assertEquals(registry.plugins, [self.useless])
+        self.assertEquals(registry.brokenPlugins, [self.sad.broken])
+        self.assertEquals(registry.knownBrokenPlugins, [self.sad.broken])
+        self.assertEquals(
+            plugin.diagnoseBrokenPlugin('SadPlugin').type, ImportError)
+
+
+    def test_installBrokenLazyPlugin(self):
+        """
+        Installing a lazy plugin that turns out to be broken raises
+        L{errors.PluginNotFound}.
+        """
+        sad = plugin.LazyPlugin('eridanus.test.plugin_broken.SadPlugin')
+        self.patch(plugin, 'getPlugins', lambda interface, package: iter(
+            {IEridanusPluginProvider: [sad]}.get(interface, [])))
+        plugin.refreshPluginRegistry()
+        self.assertRaises(errors.PluginNotFound,
+            installPlugin, Store(), u'SadPlugin')
+
+
+
+class CommandMetadataTests(unittest.TestCase):
+    """
+    Tests for L{eridanus.plugin.CommandMetadata}.
+    """
+    def test_metadata(self):
+        """
+        Command metadata is extracted from the method and its decorations.
+        """
+        metadata = plugin.getCommandMetadata(MethodCommandTests.cmd_rest)
+        self.assertEquals(metadata.name, 'rest')
+        self.assertEquals(metadata.usage, 'No usage information')
+        self.assertEquals(metadata.help, 'No additional help.')
+        self.assertTrue(metadata.rest)
+        self.assertFalse(metadata.alias)
+        self.assertEquals((metadata.minargs, metadata.maxargs), (2, 2))
+
+
+    def test_computedOnce(self):
+        """
+        Command metadata is only computed once per method, no matter how many
+        instances it is bound to or how many times it is adapted to
+        L{ICommand}.
+        """
+        calls = []
+        self.patch(
+            plugin, 'formatHelp',
+            lambda help: calls.append(help) or (help, help))
+        self.patch(plugin, '_commandMetadata', {})
+
+        known = plugin_known.Known()
+        cmd = ICommand(known.cmd_test)
+        ICommand(plugin_known.Known().cmd_test)
+        ICommand(known.cmd_test)
+        self.assertEquals(len(calls), 1)
+        self.assertIdentical(cmd.method.im_self, known)
+
+
+    def test_commandNames(self):
+        """
+        L{eridanus.plugin.getCommandNames} finds the command attributes of a
+        class, once.
+        """
+        self.patch(plugin, '_commandNames', {})
+        names = plugin.getCommandNames(plugin_known.Known)
+        self.assertEquals(names, ['cmd_test'])
+        self.assertIdentical(
+            plugin.getCommandNames(plugin_known.Known), names)
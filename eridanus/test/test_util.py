@@ -1,7 +1,10 @@
 from datetime import timedelta
 from textwrap import dedent
 
+from twisted.internet.defer import CancelledError, Deferred, succeed
+from twisted.python.failure import Failure
 from twisted.trial import unittest
+from twisted.web import client
 
 from eridanus import util, errors
 
@@ -124,3 +127,238 @@ class TestMisc(unittest.TestCase):
 
         self.assertEqual(util.unescapeEntities(u'bob'), u'bob')
         self.assertEqual(util.unescapeEntities(u'&bob;'), u'&bob;')
+
+
+class LRUCacheTests(unittest.TestCase):
+    """
+    Tests for L{eridanus.util.LRUCache}.
+    """
+    def test_bounded(self):
+        """
+        Adding items beyond the cache's size discards the least recently used
+        items.
+        """
+        cache = util.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('b', 42), 42)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+
+class MaskMatcherTests(unittest.TestCase):
+    """
+    Tests for L{eridanus.util.MaskMatcher}.
+    """
+    host = 'joe!joebloggs@an-isp-of-some-sort.roflcopter.com'
+
+    def test_matches(self):
+        """
+        A host matches if any of the masks match it, as with
+        L{eridanus.util.hostMatches}.
+        """
+        matcher = util.MaskMatcher(['bob', 'joe!*blog*@*rofl*.com'])
+        self.assertTrue(matcher.matches(self.host))
+        self.assertTrue(matcher.matches('bob!foo@bar'))
+        self.assertTrue(matcher.matches('bob'))
+        self.assertFalse(matcher.matches('bobby!foo@bar'))
+        self.assertFalse(util.MaskMatcher(['*!*@*lol*']).matches(self.host))
+        self.assertFalse(util.MaskMatcher([]).matches(self.host))
+
+    def test_invalidMask(self):
+        """
+        Invalid masks raise L{errors.InvalidMaskError}.
+        """
+        self.assertRaises(errors.InvalidMaskError, util.MaskMatcher, ['a@b'])
+        matcher = util.MaskMatcher(['bob'])
+        self.assertRaises(errors.InvalidMaskError, matcher.matches, 'a@b')
+
+    def test_memoized(self):
+        """
+        Results are memoized per host, up to the size of the cache.
+        """
+        matcher = util.MaskMatcher(['joe'], cacheSize=1)
+        calls = []
+        normalizeMask = util.normalizeMask
+        def _normalizeMask(mask):
+            calls.append(mask)
+            return normalizeMask(mask)
+        self.patch(util, 'normalizeMask', _normalizeMask)
+
+        self.assertTrue(matcher.matches(self.host))
+        self.assertTrue(matcher.matches(self.host))
+        self.assertEqual(calls, [self.host])
+        self.assertFalse(matcher.matches('bob'))
+        self.assertTrue(matcher.matches(self.host))
+        self.assertEqual(calls, [self.host, 'bob', self.host])
+
+
+class FakeBodyTransport(object):
+    stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class BodyReaderTests(unittest.TestCase):
+    """
+    Tests for L{eridanus.util.BodyReader}.
+    """
+    def setUp(self):
+        self.results = []
+        self.transport = FakeBodyTransport()
+
+    def makeReader(self, maxBytes, isComplete=None):
+        d = Deferred()
+        d.addBoth(self.results.append)
+        reader = util.BodyReader(d, maxBytes, isComplete)
+        reader.makeConnection(self.transport)
+        return reader
+
+    def test_complete(self):
+        """
+        A body shorter than the limit is read in full.
+        """
+        reader = self.makeReader(10)
+        reader.dataReceived('foo')
+        reader.dataReceived('bar')
+        self.assertEqual(self.results, [])
+        reader.connectionLost(Failure(client.ResponseDone()))
+        self.assertEqual(self.results, ['foobar'])
+        self.assertFalse(self.transport.stopped)
+
+    def test_maxBytes(self):
+        """
+        Reading stops at C{maxBytes}, no matter how much more is sent.
+        """
+        reader = self.makeReader(4)
+        reader.dataReceived('foo')
+        reader.dataReceived('bar')
+        reader.dataReceived('baz')
+        self.assertEqual(self.results, ['foob'])
+        self.assertTrue(self.transport.stopped)
+        reader.connectionLost(Failure(client.ResponseFailed([])))
+        self.assertEqual(self.results, ['foob'])
+
+    def test_isComplete(self):
+        """
+        Reading stops once C{isComplete} is satisfied.
+        """
+        reader = self.makeReader(100, lambda data: 'x' in data)
+        reader.dataReceived('foo')
+        reader.dataReceived('xbar')
+        self.assertEqual(self.results, ['fooxbar'])
+        self.assertTrue(self.transport.stopped)
+
+    def test_failure(self):
+        """
+        A connection lost before the body is complete fails the read.
+        """
+        reader = self.makeReader(10)
+        reader.dataReceived('foo')
+        reader.connectionLost(Failure(client.ResponseFailed([])))
+        [f] = self.results
+        self.assertTrue(f.check(client.ResponseFailed))
+
+
+    def test_cancel(self):
+        """
+        Cancelling L{eridanus.util.readBody} closes the connection.
+        """
+        test = self
+        class FakeResponse(object):
+            def deliverBody(self, protocol):
+                test.reader = protocol
+                protocol.makeConnection(test.transport)
+
+        d = util.readBody(FakeResponse(), 10)
+        self.reader.dataReceived('foo')
+        d.cancel()
+        self.assertTrue(self.transport.stopped)
+        self.reader.connectionLost(Failure(client.ResponseFailed([])))
+        self.assertFailure(d, CancelledError)
+        return d
+
+
+
+class FakeTreq(object):
+    """
+    Stand-in for C{treq} that records requests and never completes them on
+    its own.
+    """
+    def __init__(self):
+        self.requests = []
+        self.cancelled = []
+
+    def get(self, url, **kw):
+        d = Deferred(lambda d: self.cancelled.append(url))
+        self.requests.append((url, kw, d))
+        return d
+
+
+
+class FakeResponse(object):
+    code = 200
+    phrase = 'OK'
+    headers = None
+
+
+
+class PerseverantDownloaderTests(unittest.TestCase):
+    """
+    Tests for L{eridanus.util.PerseverantDownloader}.
+    """
+    def setUp(self):
+        self.treq = FakeTreq()
+        self.patch(util, 'treq', self.treq)
+
+
+    def test_timeout(self):
+        """
+        The request is made with the downloader's timeout.
+        """
+        util.PerseverantDownloader('http://example.com/', timeout=5).go()
+        [(url, kw, d)] = self.treq.requests
+        self.assertEqual(url, 'http://example.com/')
+        self.assertEqual(kw['timeout'], 5)
+
+
+    def test_readBody(self):
+        """
+        The body is read with C{readBody}, if one is given.
+        """
+        response = FakeResponse()
+        d = util.PerseverantDownloader(
+            'http://example.com/', readBody=lambda r: succeed('body')).go()
+        self.treq.requests[0][2].callback(response)
+        d.addCallback(self.assertEqual, ('body', None))
+        return d
+
+
+    def test_cancelRequest(self):
+        """
+        Cancelling the download cancels the request in progress.
+        """
+        d = util.PerseverantDownloader('http://example.com/').go()
+        d.cancel()
+        self.assertEqual(self.treq.cancelled, ['http://example.com/'])
+        return self.assertFailure(d, CancelledError)
+
+
+    def test_cancelBody(self):
+        """
+        Cancelling the download once the response has arrived cancels the
+        reading of its body.
+        """
+        cancelled = []
+        body = Deferred(cancelled.append)
+        d = util.PerseverantDownloader(
+            'http://example.com/', readBody=lambda r: body).go()
+        self.treq.requests[0][2].callback(FakeResponse())
+        d.cancel()
+        self.assertEqual(cancelled, [body])
+        return self.assertFailure(d, CancelledError)
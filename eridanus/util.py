@@ -1,7 +1,9 @@
 import re, math, fnmatch, itertools, warnings, htmlentitydefs
+from collections import OrderedDict
 
 from twisted.internet import reactor, task, error as ineterror
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Protocol
 from twisted.web import client, http, error as weberror
 from twisted.web.http_headers import Headers
 from twisted.python import log
@@ -75,7 +77,8 @@ class PerseverantDownloader(object):
 
     defaultTimeout = 300.0
 
-    def __init__(self, url, tries=10, timeout=defaultTimeout, *a, **kw):
+    def __init__(self, url, tries=10, timeout=defaultTimeout, readBody=None,
+                 *a, **kw):
         """
         Prepare the download information.
 
@@ -91,6 +94,11 @@ class PerseverantDownloader(object):
         @type timeout: C{float}
         @param timeout: Timeout value, in seconds, for the page fetch;
             defaults to L{defaultTimeout}
+
+        @type readBody: C{callable} taking a response and returning a
+            C{Deferred} firing with C{str}, or C{None}
+        @param readBody: Callable to read the response body with, such as
+            L{readBody}; if C{None}, the entire body is read
         """
         if isinstance(url, unicode):
             url = url.encode('utf-8')
@@ -103,25 +111,110 @@ class PerseverantDownloader(object):
         self.delay = self.initialDelay
         self.tries = tries
         self.timeout = timeout
+        self.readBody = readBody
 
     def __repr__(self):
         return '<%s %s>' % (type(self).__name__, self.url)
 
-    @inlineCallbacks
     def go(self):
         """
         Attempt to download L{self.url}.
+
+        Cancelling the returned C{Deferred} cancels the request, or the
+        reading of the response body, in progress.
         """
+        def gotResponse(response):
+            if self.readBody is None:
+                d = response.content()
+            else:
+                d = self.readBody(response)
+            return d.addCallback(gotBody, response)
+
+        def gotBody(data, response):
+            if response.code // 100 == 2:
+                return data, response.headers
+            raise weberror.Error(response.code, response.phrase, data)
+
         headers = self.kwargs.pop('headers', Headers())
         headers.setRawHeaders('user-agent', ['Eridanus IRC bot'])
-        response = yield treq.get(
+        return treq.get(
             str(self.url), timeout=self.timeout, headers=headers,
-            *self.args, **self.kwargs)
-        data = yield response.content()
-        if response.code // 100 == 2:
-            returnValue((data, response.headers))
+            *self.args, **self.kwargs).addCallback(gotResponse)
+
+
+class BodyReader(Protocol):
+    """
+    Read a response body, stopping after C{maxBytes} bytes or once
+    C{isComplete} is satisfied, whichever comes first.
+
+    Once reading stops, the connection is closed, the remainder of the body
+    is never received.
+
+    @type finished: C{Deferred}
+    @ivar finished: Deferred to fire with the body that was read
+
+    @type maxBytes: C{int}
+    @ivar maxBytes: Maximum number of bytes to read
+
+    @ivar isComplete: Callable, or C{None}, called with each chunk of the
+        body as it is received, returning C{True} once enough of the body has
+        been read
+    """
+    def __init__(self, finished, maxBytes, isComplete=None):
+        self.finished = finished
+        self.maxBytes = maxBytes
+        self.isComplete = isComplete
+        self.chunks = []
+        self.length = 0
+
+    def _finish(self):
+        finished, self.finished = self.finished, None
+        finished.callback(''.join(self.chunks))
+
+    def dataReceived(self, data):
+        if self.finished is None:
+            return
+
+        data = data[:self.maxBytes - self.length]
+        self.chunks.append(data)
+        self.length += len(data)
+        if (self.length >= self.maxBytes or
+            self.isComplete is not None and self.isComplete(data)):
+            self._finish()
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.finished is None:
+            return
+
+        if reason.check(client.ResponseDone, http.PotentialDataLoss):
+            self._finish()
         else:
-            raise weberror.Error(response.code, response.phrase, data)
+            finished, self.finished = self.finished, None
+            finished.errback(reason)
+
+
+def readBody(response, maxBytes, isComplete=None):
+    """
+    Read at most C{maxBytes} bytes of C{response}'s body, regardless of how
+    much the server sends.
+
+    @type isComplete: C{callable} taking C{str} and returning C{bool}
+    @param isComplete: Called with each chunk of the body, returning C{True}
+        once enough of the body has been read
+
+    @rtype: C{Deferred} firing with C{str}
+    @return: A Deferred that fires with the body; cancelling it closes the
+        connection
+    """
+    def cancel(d):
+        reader.finished = None
+        reader.transport.stopProducing()
+
+    d = Deferred(cancel)
+    reader = BodyReader(d, maxBytes, isComplete)
+    response.deliverBody(reader)
+    return d
 
 
 def encode(s):
@@ -222,6 +315,107 @@ def hostMatches(host, mask):
     return re.match(fnmatch.translate(mask), host) is not None
 
 
+def _translateMask(mask):
+    """
+    Translate a wildcard mask into a regular expression, without the flags
+    C{fnmatch.translate} appends, so that it can be combined with others.
+    """
+    pattern = fnmatch.translate(mask)
+    if pattern.endswith('(?ms)'):
+        pattern = pattern[:-5]
+    return pattern
+
+
+class LRUCache(object):
+    """
+    A mapping that holds at most C{size} items, discarding the least recently
+    used items to make room for new ones.
+
+    @type size: C{int}
+    @ivar size: Maximum number of items to hold
+    """
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+
+    def __repr__(self):
+        return '<%s %d/%d>' % (type(self).__name__, len(self), self.size)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def get(self, key, default=None):
+        """
+        Get the item for C{key}, marking it as the most recently used, or
+        C{default} if there is no such item.
+        """
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            return default
+        self._items[key] = value
+        return value
+
+    def clear(self):
+        self._items.clear()
+
+
+class MaskMatcher(object):
+    """
+    Match hosts against a collection of wildcard masks.
+
+    The masks are normalized and compiled into a single regular expression
+    once, results are memoized per host.
+
+    @type masks: C{list} of C{unicode}
+    @ivar masks: Masks to match against, as given
+    """
+    cacheSize = 1024
+
+    def __init__(self, masks, cacheSize=None):
+        if cacheSize is None:
+            cacheSize = self.cacheSize
+        self.masks = masks
+        if masks:
+            self._pattern = re.compile(
+                u'(?:%s)' % (u'|'.join(
+                    _translateMask(normalizeMask(mask)) for mask in masks),),
+                re.M | re.S)
+        else:
+            self._pattern = None
+        self._results = LRUCache(cacheSize)
+
+    def __repr__(self):
+        return '<%s %d masks>' % (type(self).__name__, len(self.masks))
+
+    def matches(self, host):
+        """
+        Determine whether any mask matches C{host}.
+
+        @param host: Something of the form C{nick!user@host}, partial masks
+            are normalized
+        @type host: C{str} or C{unicode}
+
+        @rtype: C{bool}
+        """
+        if self._pattern is None:
+            return False
+        result = self._results.get(host)
+        if result is None:
+            result = self._pattern.match(normalizeMask(host)) is not None
+            self._results[host] = result
+        return result
+
+
 def padIterable(iterable, length, padding=None):
     """
     Ensure that C{iterable} is at least C{length} items long.
@@ -0,0 +1,187 @@
+# -*- test-case-name: eridanusstd.test.test_charset -*-
+"""
+Detect the character encoding of web pages.
+
+Cheap, reliable sources of the encoding are consulted first; C{chardet}, which
+is slow, is only run when none of them say anything.
+"""
+import codecs, re
+
+import chardet
+
+from twisted.internet.defer import succeed
+from twisted.internet.threads import deferToThread
+
+
+
+_boms = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16')]
+
+_contentTypeCharset = re.compile(
+    r'''charset\s*=\s*["']?\s*([-\w.:]+)''', re.IGNORECASE)
+
+_comment = re.compile(r'<!--.*?-->', re.DOTALL)
+
+# Matches both <meta charset="..."> and
+# <meta http-equiv="Content-Type" content="text/html; charset=...">.
+_metaCharset = re.compile(
+    r'''<meta\s[^>]*?charset\s*=\s*["']?\s*([-\w.:]+)''', re.IGNORECASE)
+
+# Encodings that browsers treat as their superset.
+_supersets = {
+    'ascii':     'cp1252',
+    'iso8859-1': 'cp1252'}
+
+
+
+def _lookup(name):
+    """
+    Get the canonical name of the encoding C{name}.
+
+    @rtype: C{str} or C{None}
+    @return: The canonical encoding name, or C{None} if C{name} is not a
+        known encoding
+    """
+    try:
+        name = codecs.lookup(name).name
+    except LookupError:
+        return None
+    return _supersets.get(name, name)
+
+
+
+def _isUTF8(data):
+    """
+    Determine whether C{data} is valid UTF-8, allowing for it to have been cut
+    short in the middle of a character.
+    """
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError, e:
+        return e.reason == 'unexpected end of data'
+    return True
+
+
+
+class EncodingDetector(object):
+    """
+    Detect the character encoding of web pages.
+
+    Detection stops at the first of these stages to find an encoding:
+
+        1. A byte order mark;
+
+        2. The C{charset} parameter of the C{Content-Type} header;
+
+        3. A C{meta} element, declaring a charset, within the first
+           L{prescanBytes} bytes of the page;
+
+        4. The page being valid UTF-8;
+
+        5. C{chardet}, run in a thread on the first L{sampleBytes} bytes of
+           the page.
+
+    @type counts: C{dict} mapping C{str} to C{int}
+    @ivar counts: Number of encodings detected by each stage, C{'bom'},
+        C{'contentType'}, C{'meta'}, C{'utf8'} and C{'chardet'}; and the
+        number of pages whose encoding could not be detected, C{'unknown'}
+
+    @ivar runInThread: Callable, like C{deferToThread}, to run C{chardet}
+        with
+    """
+    prescanBytes = 1024
+    sampleBytes = 8192
+    defaultEncoding = 'ascii'
+
+    def __init__(self, runInThread=deferToThread):
+        self.runInThread = runInThread
+        self.counts = dict.fromkeys(
+            ['bom', 'contentType', 'meta', 'utf8', 'chardet', 'unknown'], 0)
+
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.counts)
+
+
+    def _found(self, stage, encoding):
+        self.counts[stage] += 1
+        return encoding
+
+
+    def detectCheaply(self, data, contentType=None):
+        """
+        Detect the encoding of C{data} without resorting to C{chardet}.
+
+        @type contentType: C{str} or C{unicode}
+        @param contentType: The C{Content-Type} header the page was served
+            with, or C{None}
+
+        @rtype: C{str} or C{None}
+        @return: The encoding, or C{None} if it could not be detected
+        """
+        for bom, encoding in _boms:
+            if data.startswith(bom):
+                return self._found('bom', encoding)
+
+        if contentType:
+            match = _contentTypeCharset.search(contentType)
+            if match is not None:
+                encoding = _lookup(match.group(1))
+                if encoding is not None:
+                    return self._found('contentType', encoding)
+
+        prescan = _comment.sub('', data[:self.prescanBytes])
+        match = _metaCharset.search(prescan)
+        if match is not None:
+            encoding = _lookup(match.group(1))
+            if encoding is not None:
+                # A page that could declare UTF-16 in ASCII is not UTF-16.
+                if encoding.startswith('utf-16'):
+                    encoding = 'utf-8'
+                return self._found('meta', encoding)
+
+        if _isUTF8(data):
+            return self._found('utf8', 'utf-8')
+
+        return None
+
+
+    def detect(self, data, contentType=None):
+        """
+        Detect the encoding of C{data}.
+
+        @type contentType: C{str} or C{unicode}
+        @param contentType: The C{Content-Type} header the page was served
+            with, or C{None}
+
+        @rtype: C{Deferred} firing with C{str}
+        @return: The encoding, or L{defaultEncoding} if it could not be
+            detected
+        """
+        encoding = self.detectCheaply(data, contentType)
+        if encoding is not None:
+            return succeed(encoding)
+
+        def detected(info):
+            encoding = _lookup(info.get('encoding') or '')
+            if encoding is None:
+                return self._found('unknown', self.defaultEncoding)
+            return self._found('chardet', encoding)
+
+        return self.runInThread(chardet.detect, data[:self.sampleBytes]
+            ).addCallback(detected)
+
+
+
+_encodingDetector = None
+
+def getEncodingDetector():
+    """
+    Get the shared L{EncodingDetector}, creating it if need be.
+    """
+    global _encodingDetector
+    if _encodingDetector is None:
+        _encodingDetector = EncodingDetector()
+    return _encodingDetector
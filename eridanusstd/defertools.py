@@ -1,7 +1,9 @@
 import itertools
 from collections import deque
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
 
 from eridanusstd import errors
 
@@ -156,3 +158,312 @@ def slice(queue, n):
                                 for d in itertools.islice(queue, n)]
         ).addErrback(_gatherErr
         ).addCallback(lambda results: sum(results, []))
+
+
+class _Job(object):
+    """
+    A job waiting in, or running in, a L{JobPool}.
+    """
+    def __init__(self, queue, host, f, args, kwargs):
+        self.queue = queue
+        self.host = host
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.deferred = defer.Deferred()
+        self.running = None
+        self.timeout = None
+
+    def __repr__(self):
+        return '<%s %s %r>' % (type(self).__name__, self.host, self.f)
+
+
+class JobPool(object):
+    """
+    Run Deferred-returning jobs with bounded concurrency.
+
+    At most C{maxConcurrent} jobs run at once, and at most C{maxPerHost} of
+    those for any single host.  Jobs wait in one of several named queues (for
+    example one per IRC channel); queues take turns starting jobs, so that a
+    flood of jobs in one queue does not hold up every other queue.  Jobs that
+    have not completed within C{deadline} seconds of being submitted fail with
+    L{errors.DeadlineExceeded}, running jobs are cancelled.
+
+    @type maxConcurrent: C{int}
+    @ivar maxConcurrent: Maximum number of jobs to run at once
+
+    @type maxPerHost: C{int}
+    @ivar maxPerHost: Maximum number of jobs to run at once for a single host
+
+    @type deadline: C{float}
+    @ivar deadline: Seconds a job may take, including time spent queued
+
+    @type inFlightByHost: C{dict} mapping C{str} to C{int}
+    @ivar inFlightByHost: Number of jobs running for each host
+    """
+    def __init__(self, maxConcurrent=8, maxPerHost=2, deadline=120.0,
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.maxConcurrent = maxConcurrent
+        self.maxPerHost = maxPerHost
+        self.deadline = deadline
+        self.clock = clock
+        self.inFlightByHost = {}
+        self._inFlight = 0
+        self._queues = {}
+        self._queueOrder = deque()
+
+    def __repr__(self):
+        return '<%s %d queued, %d in flight>' % (
+            type(self).__name__, self.queued, self.inFlight)
+
+    @property
+    def queued(self):
+        """
+        Number of jobs waiting to run.
+        """
+        return sum(len(jobs) for jobs in self._queues.itervalues())
+
+    @property
+    def inFlight(self):
+        """
+        Number of jobs running.
+        """
+        return self._inFlight
+
+    def submit(self, queue, host, f, *a, **kw):
+        """
+        Submit a job to the pool.
+
+        @param queue: Name of the queue the job waits in
+
+        @type host: C{str}
+        @param host: Host the job will connect to
+
+        @param f: Callable, returning a C{Deferred}, to call with the
+            remaining arguments when the job runs
+
+        @rtype: C{Deferred}
+        @return: A Deferred that fires with the result of the job
+        """
+        job = _Job(queue, host, f, a, kw)
+        job.timeout = self.clock.callLater(self.deadline, self._expire, job)
+        jobs = self._queues.get(queue)
+        if jobs is None:
+            jobs = self._queues[queue] = deque()
+            self._queueOrder.append(queue)
+        jobs.append(job)
+        self._pump()
+        return job.deferred
+
+    def _nextJob(self):
+        """
+        Remove the next job that may run from the queues.
+
+        @return: The next job, or C{None} if no job may run right now
+        """
+        for i in xrange(len(self._queueOrder)):
+            queue = self._queueOrder.popleft()
+            jobs = self._queues[queue]
+            for job in jobs:
+                if self.inFlightByHost.get(job.host, 0) < self.maxPerHost:
+                    jobs.remove(job)
+                    if jobs:
+                        self._queueOrder.append(queue)
+                    else:
+                        del self._queues[queue]
+                    return job
+            self._queueOrder.append(queue)
+        return None
+
+    def _pump(self):
+        """
+        Start as many queued jobs as the limits allow.
+        """
+        while self._inFlight < self.maxConcurrent:
+            job = self._nextJob()
+            if job is None:
+                break
+            self._start(job)
+
+    def _start(self, job):
+        self._inFlight += 1
+        self.inFlightByHost[job.host] = self.inFlightByHost.get(job.host, 0) + 1
+        job.running = defer.maybeDeferred(job.f, *job.args, **job.kwargs)
+        job.running.addBoth(self._finished, job)
+
+    def _finished(self, result, job):
+        self._inFlight -= 1
+        self.inFlightByHost[job.host] -= 1
+        if not self.inFlightByHost[job.host]:
+            del self.inFlightByHost[job.host]
+        if job.timeout.active():
+            job.timeout.cancel()
+            job.deferred.callback(result)
+        self._pump()
+
+    def _expire(self, job):
+        """
+        Fail C{job} for exceeding its deadline.
+        """
+        if job.running is None:
+            jobs = self._queues[job.queue]
+            jobs.remove(job)
+            if not jobs:
+                del self._queues[job.queue]
+                self._queueOrder.remove(job.queue)
+        else:
+            # Ignore the outcome of the cancelled job.
+            job.running.addErrback(lambda f: None)
+            job.running.cancel()
+        job.deferred.errback(errors.DeadlineExceeded(
+            'Job for %s did not complete within %s seconds' % (
+                job.host, self.deadline)))
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls for the same key into a single call.
+
+    While a call for a key is in flight, further calls for that key wait for
+    its result instead of making another call.  Every caller receives its own
+    Deferred, and its own copy of the result.
+
+    @ivar copy: Callable to copy a result for each caller
+    """
+    def __init__(self, copy=lambda result: result):
+        self.copy = copy
+        self._waiting = {}
+
+    def __repr__(self):
+        return '<%s %d in flight>' % (type(self).__name__, len(self._waiting))
+
+    def __contains__(self, key):
+        return key in self._waiting
+
+    def call(self, key, f, *a, **kw):
+        """
+        Call C{f} with the remaining arguments, unless a call for C{key} is
+        already in flight.
+
+        @rtype: C{Deferred}
+        @return: A Deferred firing with a copy of the result
+        """
+        d = defer.Deferred()
+        waiting = self._waiting.get(key)
+        if waiting is not None:
+            waiting.append(d)
+        else:
+            self._waiting[key] = [d]
+            defer.maybeDeferred(f, *a, **kw).addBoth(self._done, key)
+        return d
+
+    def _done(self, result, key):
+        for d in self._waiting.pop(key):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(self.copy(result))
+
+
+class WorkerPool(object):
+    """
+    Run CPU-bound functions in a pool of threads, off the reactor thread.
+
+    At most C{size} functions run at once and at most C{maxQueued} more wait
+    for a thread, further jobs fail immediately with L{errors.WorkerPoolFull}
+    so that callers shed work instead of piling it up.  Jobs that have not
+    completed within C{timeLimit} seconds of being submitted fail with
+    L{errors.DeadlineExceeded}; since threads cannot be interrupted, such a
+    job keeps its thread busy until it returns and its result is discarded.
+
+    @type size: C{int}
+    @ivar size: Number of threads
+
+    @type maxQueued: C{int}
+    @ivar maxQueued: Maximum number of jobs waiting for a thread
+
+    @type timeLimit: C{float}
+    @ivar timeLimit: Seconds a job may take, including time spent queued
+
+    @type pending: C{int}
+    @ivar pending: Number of jobs queued or running
+
+    @type rejected: C{int}
+    @ivar rejected: Number of jobs rejected because the pool was full
+
+    @type timedOut: C{int}
+    @ivar timedOut: Number of jobs that exceeded the time limit
+    """
+    def __init__(self, size=2, maxQueued=16, timeLimit=10.0, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.size = size
+        self.maxQueued = maxQueued
+        self.timeLimit = timeLimit
+        self.clock = clock
+        self.pending = 0
+        self.rejected = 0
+        self.timedOut = 0
+        self._threadpool = None
+
+    def __repr__(self):
+        return '<%s %d/%d pending>' % (
+            type(self).__name__, self.pending, self.size + self.maxQueued)
+
+    def _runInThread(self, f, *a, **kw):
+        from twisted.internet import reactor
+        if self._threadpool is None:
+            self._threadpool = ThreadPool(0, self.size, 'WorkerPool')
+            self._threadpool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+        return threads.deferToThreadPool(
+            reactor, self._threadpool, f, *a, **kw)
+
+    def resize(self, size):
+        """
+        Change the number of threads.
+        """
+        self.size = size
+        if self._threadpool is not None:
+            self._threadpool.adjustPoolsize(0, size)
+
+    def stop(self):
+        """
+        Stop the threads, once their current jobs are complete.
+        """
+        if self._threadpool is not None:
+            self._threadpool.stop()
+            self._threadpool = None
+
+    def run(self, f, *a, **kw):
+        """
+        Call C{f} with the remaining arguments in a thread.
+
+        @rtype: C{Deferred}
+        @return: A Deferred that fires with the result of the call
+        """
+        if self.pending >= self.size + self.maxQueued:
+            self.rejected += 1
+            return defer.fail(errors.WorkerPoolFull(
+                '%d jobs already pending' % (self.pending,)))
+
+        d = defer.Deferred()
+
+        def expire():
+            self.timedOut += 1
+            d.errback(errors.DeadlineExceeded(
+                'Job %r did not complete within %s seconds' % (
+                    f, self.timeLimit)))
+
+        def finished(result):
+            self.pending -= 1
+            if timeout.active():
+                timeout.cancel()
+                d.callback(result)
+
+        self.pending += 1
+        timeout = self.clock.callLater(self.timeLimit, expire)
+        self._runInThread(f, *a, **kw).addBoth(finished)
+        return d
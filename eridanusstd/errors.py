@@ -99,3 +99,24 @@ class InvalidIdentifier(ValueError):
     """
     The specified identifier could not be found or is invalid.
     """
+
+
+
+class DeadlineExceeded(RuntimeError):
+    """
+    A job did not complete before its deadline.
+    """
+
+
+
+class WorkerPoolFull(RuntimeError):
+    """
+    A worker pool has too many jobs waiting to accept another.
+    """
+
+
+
+class InvalidQuery(ValueError):
+    """
+    A search query could not be parsed.
+    """
@@ -17,7 +17,7 @@ from nevow.url import URL
 
 from eridanus import util
 from eridanusstd import errors, defertools
-from eridanusstd.util import parseHTML
+from eridanusstd.util import parseHTML, deferToParser
 
 
 
@@ -177,5 +177,6 @@ class Calculator(object):
         url = url.add('q', expn + '=')
         url = url.add('num', '1')
         d = self._fetch(url)
-        d.addCallback(self._extractResult, expn)
+        d.addCallback(
+            lambda result: deferToParser(self._extractResult, result, expn))
         return d
@@ -0,0 +1,139 @@
+# -*- test-case-name: eridanusstd.test.test_imagesize -*-
+"""
+Determine image dimensions from the first few bytes of an image.
+
+Only as much of the image as is needed to find its dimensions is examined,
+which for most formats is a fixed size header and for JPEG is every segment
+up to the start of the frame.
+"""
+import re, struct
+
+
+
+def _png(data):
+    # Signature, then the IHDR chunk's length and type.
+    if data[12:16] == 'IHDR' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    return None
+
+
+
+def _gif(data):
+    if len(data) >= 10:
+        return struct.unpack('<HH', data[6:10])
+    return None
+
+
+
+# Start of frame markers, excluding DHT (C4), JPG (C8) and DAC (CC).
+_jpegSOF = set(range(0xc0, 0xd0)) - set([0xc4, 0xc8, 0xcc])
+
+# Markers that are not followed by a segment.
+_jpegStandalone = set(range(0xd0, 0xda)) | set([0x01])
+
+def _jpeg(data):
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != '\xff':
+            return None
+        marker = ord(data[offset + 1])
+        if marker == 0xff:
+            # Fill byte.
+            offset += 1
+            continue
+        if marker in _jpegStandalone:
+            offset += 2
+            continue
+        if marker in _jpegSOF:
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height
+        length, = struct.unpack('>H', data[offset + 2:offset + 4])
+        offset += 2 + length
+    return None
+
+
+
+def _webp(data):
+    chunk = data[12:16]
+    if chunk == 'VP8 ' and len(data) >= 30:
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3fff, height & 0x3fff
+    elif chunk == 'VP8L' and len(data) >= 25:
+        bits, = struct.unpack('<I', data[21:25])
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    elif chunk == 'VP8X' and len(data) >= 30:
+        width, = struct.unpack('<I', data[24:27] + '\x00')
+        height, = struct.unpack('<I', data[27:30] + '\x00')
+        return width + 1, height + 1
+    return None
+
+
+
+def _bmp(data):
+    if len(data) < 26:
+        return None
+    headerSize, = struct.unpack('<I', data[14:18])
+    if headerSize == 12:
+        return struct.unpack('<HH', data[18:22])
+    width, height = struct.unpack('<ii', data[18:26])
+    # Top-down bitmaps have a negative height.
+    return width, abs(height)
+
+
+
+_svgTag = re.compile(r'<svg\b([^>]*)>', re.IGNORECASE)
+_svgAttribute = re.compile(
+    r'''(?:^|\s)(width|height|viewBox)\s*=\s*["']([^"']*)["']''')
+_svgLength = re.compile(r'^\s*(\d+(?:\.\d*)?)\s*(?:px)?\s*$')
+
+def _svg(data):
+    tag = _svgTag.search(data)
+    if tag is None:
+        return None
+    attributes = dict(_svgAttribute.findall(tag.group(1)))
+
+    width = _svgLength.match(attributes.get('width', ''))
+    height = _svgLength.match(attributes.get('height', ''))
+    if width is not None and height is not None:
+        return (int(round(float(width.group(1)))),
+                int(round(float(height.group(1)))))
+
+    viewBox = attributes.get('viewBox', '').replace(',', ' ').split()
+    if len(viewBox) == 4:
+        try:
+            return tuple(int(round(float(n))) for n in viewBox[2:])
+        except ValueError:
+            pass
+    return None
+
+
+
+_formats = [
+    (lambda data: data[:8] == '\x89PNG\r\n\x1a\n', _png),
+    (lambda data: data[:6] in ('GIF87a', 'GIF89a'), _gif),
+    (lambda data: data[:2] == '\xff\xd8', _jpeg),
+    (lambda data: data[:4] == 'RIFF' and data[8:12] == 'WEBP', _webp),
+    (lambda data: data[:2] == 'BM', _bmp),
+    (lambda data: '<svg' in data[:4096].lower(), _svg)]
+
+def getDimensions(data):
+    """
+    Determine the dimensions of a PNG, GIF, JPEG, WebP, BMP or SVG image.
+
+    @type data: C{str} or C{buffer}
+    @param data: The beginning of the image; a C{buffer} avoids copying an
+        image that is still being received
+
+    @rtype: C{(int, int)} or C{None}
+    @return: The image's width and height, or C{None} if the format is not
+        recognised or C{data} is too short to tell
+    """
+    for matches, getSize in _formats:
+        if matches(data):
+            try:
+                return getSize(data)
+            except struct.error:
+                return None
+    return None
@@ -9,7 +9,7 @@ from nevow.url import URL
 
 from eridanus.util import PerseverantDownloader
 
-from eridanusstd.util import parseHTML
+from eridanusstd.util import parseHTML, deferToParser
 
 
 IMDB_URL = URL.fromString('http://www.imdb.com/')
@@ -73,7 +73,8 @@ def searchByTitle(title, exact=True, artifacts=None):
                                method='POST',
                                postdata=postdata)
 
-    return pd.go().addCallback(_parseSearchResults)
+    return pd.go().addCallback(
+        lambda result: deferToParser(_parseSearchResults, result))
 
 
 def getInfoByID(id):
@@ -81,8 +82,20 @@ def getInfoByID(id):
     Get information for the given IMDB ID.
     """
     url = IMDB_URL.child('title').child(id)
+
+    def gotInfo((info, posterURL)):
+        d = defer.succeed(info
+            ).addCallback(_getPlotSummary, url.child('plotsummary'))
+
+        if posterURL is not None:
+            d.addCallback(_getPoster, posterURL)
+
+        return d
+
     return PerseverantDownloader(url).go(
-        ).addCallback(_parseTitleInfo, url)
+        ).addCallback(
+            lambda result: deferToParser(_parseTitleInfo, result, url)
+        ).addCallback(gotInfo)
 
 
 def getInfoByTitle(title, **kw):
@@ -105,9 +118,10 @@ def getInfoByTitle(title, **kw):
 
 def _parseSearchResults((data, headers)):
     """
-    Parse search result HTML into an iterable of C{(name, url, id)}.
+    Parse search result HTML into a list of C{(name, url, id)}.
     """
     tree = parseHTML(data)
+    results = []
 
     # XXX: Maybe do something a little more less shot-in-the-darkish, like
     # finding the first `ol` after an `h1`.
@@ -120,7 +134,8 @@ def _parseSearchResults((data, headers)):
         if not name.endswith(u'(VG)'):
             pathList = url.pathList()
             id = pathList[-1] or pathList[-2]
-            yield name, url, id
+            results.append((name, url, id))
+    return results
 
 
 def _parseSummary((data, headers)):
@@ -150,7 +165,7 @@ def _getPlotSummary(info, url):
         return info
 
     return PerseverantDownloader(url).go(
-        ).addCallback(_parseSummary
+        ).addCallback(lambda result: deferToParser(_parseSummary, result)
         ).addCallback(gotSummary)
 
 
@@ -184,7 +199,7 @@ def _getPoster(info, url):
         return info
 
     return PerseverantDownloader(url).go(
-        ).addCallback(_parsePoster
+        ).addCallback(lambda result: deferToParser(_parsePoster, result)
         ).addCallback(gotPoster)
 
 
@@ -278,7 +293,9 @@ def _parseTitleInfo((data, headers), url):
     The resulting dictionary contains keys that map roughly to the relevant
     IMDB fields of the same name.
 
-    @rtype: Deferred firing with a C{dict}
+    @rtype: C{(dict, nevow.url.URL)}
+    @return: The information and the URL of the poster image page, or
+        C{None} if there is no poster
     """
     tree = parseHTML(data)
 
@@ -311,10 +328,4 @@ def _parseTitleInfo((data, headers), url):
             posterURL = url.click(a.get('href'))
             break
 
-    d = defer.succeed(info
-        ).addCallback(_getPlotSummary, url.child('plotsummary'))
-
-    if posterURL is not None:
-        d.addCallback(_getPoster, posterURL)
-
-    return d
+    return info, posterURL
@@ -1,6 +1,7 @@
 # -*- test-case-name: eridanusstd.test.test_linkdb -*-
-import datetime, itertools, urllib, re, chardet, gzip
+import datetime, itertools, urllib, urlparse, re, gzip
 from StringIO import StringIO
+from weakref import WeakKeyDictionary
 try:
     import PIL.Image
     # To shut pyflakes up.
@@ -16,16 +17,17 @@ from twisted.python import log
 from twisted.web import error as weberror
 from twisted.web.http_headers import Headers
 
-from axiom import batch
-from axiom.attributes import (AND, timestamp, integer, reference, text,
-    boolean, bytes, inmemory)
-from axiom.item import Item
+from axiom import batch, iaxiom
+from axiom.attributes import (AND, OR, timestamp, integer, reference, text,
+    boolean, bytes, inmemory, textlist, compoundIndex)
+from axiom.item import Item, declareLegacyItem
+from axiom.upgrade import registerUpgrader
 
-from xmantissa.ixmantissa import IFulltextIndexable, IFulltextIndexer
+from xmantissa.ixmantissa import IFulltextIndexable
 
 from eridanus import const, util, iriparse
-from eridanusstd import errors
-from eridanusstd.util import parseHTML
+from eridanusstd import errors, defertools, imagesize, charset
+from eridanusstd.util import parseHTML, deferToParser
 
 
 def parseEntryID(eid):
@@ -99,12 +101,12 @@ def getLinkManager(store, serviceID, channel):
     # XXX: maybe fix this one day?
     assert channel.startswith(u'#'), u'Channels must start with a "#"'
     global _managerCache
-    em = _managerCache.get(channel)
+    em = _managerCache.get((serviceID, channel))
     if em is None:
         em = store.findOrCreate(LinkManager,
                                 serviceID=serviceID,
                                 channel=channel)
-        _managerCache[channel] = em
+        _managerCache[serviceID, channel] = em
 
     return em
 
@@ -144,55 +146,40 @@ def getEntryByID(store, serviceID, entryID, defaultChannel):
     return entry
 
 
-_commentPattern = re.compile(ur'\s+(?:\[(.*?)\]|<?--\s+(.+))')
-
-def extractURLs(text):
+def extractURLs(text, supportedSchemes=None):
     """
     Extract URLs and comments from C{text}
 
     @type text: C{unicode}
 
-    @rtype: C{iterable} of C{(nevow.url.URL, unicode)}
+    @type supportedSchemes: C{list} of C{unicode}
+    @param supportedSchemes: URL schemes to extract, see
+        L{eridanus.iriparse.extractURLsWithPosition}
+
+    @rtype: C{iterable} of C{(unicode, unicode)}
     @return: An iterable of C{(url, comment)} pairs
     """
-    for url, pos in iriparse.extractURLsWithPosition(text):
-        comment = _commentPattern.match(text, pos)
-        if comment is not None:
-            comment = filter(None, comment.groups())[0]
-
-        yield url, comment
+    return iriparse.extractURLsWithComments(text, supportedSchemes)
 
 
-def _decodeText(data, encoding=None):
+def _decodeText(data, contentType=None):
     """
     Decode C{data} as text.
 
-    If encoding is C{None} or decoding fails, an attempt to detect the encoding
-    is made, finally falling back to the C{ascii} encoding.
+    The encoding is detected by L{eridanusstd.charset.EncodingDetector}.
 
     @type data: C{str}
     @param data: The encoded text
 
-    @type encoding: C{str} or C{None}
-    @param encoding: The encoding to treat data as, or C{None} to attempt to
-        detect the encoding
+    @type contentType: C{str} or C{unicode}
+    @param contentType: The C{Content-Type} header C{data} was served with,
+        or C{None}
 
-    @rtype: C{unicode}
+    @rtype: C{Deferred} firing with C{unicode}
     @return: Decoded text
     """
-    def detectEncoding(data):
-        info = chardet.detect(data)
-        return info.get('encoding') or 'ascii'
-
-    if not encoding:
-        encoding = detectEncoding(data)
-
-    try:
-        return data.decode(encoding, 'replace')
-    except (ValueError, LookupError):
-        newEncoding = detectEncoding(data)
-        log.msg('Decoding text with %r failed, detected data as %r.' % (encoding, newEncoding))
-        return data.decode(newEncoding, 'replace')
+    return charset.getEncodingDetector().detect(data, contentType
+        ).addCallback(lambda encoding: data.decode(encoding, 'replace'))
 
 
 def _monkey_read_eof(self):
@@ -203,24 +190,23 @@ def _monkey_read_eof(self):
 
 
 
-def _extractImageMetadata(stream):
+def _extractImageMetadata(data):
     """
-    Extract image metadata from a stream.
+    Extract image metadata from the beginning of an image.
 
-    If the Python Imaging Library is not available, no image metadata is
-    extracted.
+    Dimensions are read from the image header by
+    L{eridanusstd.imagesize.getDimensions}; the Python Imaging Library, if it
+    is available, is used for formats that are not recognised.
 
     @rtype: C{iterable} of C{(unicode, unicode)} pairs
     @return: An iterable of C{(name, value)} pairs containg image metadata
     """
-    if PIL is None:
-        return
-    
-    try:
-        im = PIL.Image.open(stream)
-        dims = im.size
-    except IOError:
-        dims = None
+    dims = imagesize.getDimensions(data)
+    if dims is None and PIL is not None:
+        try:
+            dims = PIL.Image.open(StringIO(data)).size
+        except IOError:
+            pass
 
     if dims is not None:
         yield u'dimensions', u'x'.join(map(unicode, dims))
@@ -245,7 +231,7 @@ def _buildMetadata(data, headers):
         yield u'contentType', contentType
 
         if contentType.startswith('image'):
-            for info in _extractImageMetadata(StringIO(data)):
+            for info in _extractImageMetadata(data):
                 yield info
 
     size = getHeader('content-range')
@@ -280,9 +266,176 @@ def _extractTitle(data):
     return None
 
 
-def fetchPageData(url):
+def _hasTitle(contentType):
+    """
+    Determine whether content of type C{contentType} may have a title.
+    """
+    major, minor = util.padIterable(contentType.split(u'/', 1), 2)
+    return major == u'text' or u'html' in (minor or u'')
+
+
+
+class _TitleEnd(object):
+    """
+    Detect the end of an HTML document's C{title} element, as the document is
+    received in chunks.
+    """
+    _pattern = re.compile(r'</title\s*>', re.IGNORECASE)
+
+    def __init__(self):
+        self._tail = ''
+
+
+    def __call__(self, data):
+        # Keep the end of the previous chunk, in case the end tag was split.
+        data = self._tail + data
+        self._tail = data[-64:]
+        return self._pattern.search(data) is not None
+
+
+
+class _ImageHeaderEnd(object):
+    """
+    Detect the end of an image header that contains the image's dimensions,
+    as the image is received in chunks.
+    """
+    def __init__(self):
+        self._data = bytearray()
+
+
+    def __call__(self, data):
+        self._data.extend(data)
+        return imagesize.getDimensions(buffer(self._data)) is not None
+
+
+
+#: Maximum number of bytes of a page to read while looking for its title.
+MAX_PAGE_BYTES = 256 * 1024
+
+#: Maximum number of bytes of an image to read while looking for its
+#: dimensions, JPEG images may have large segments before them.
+MAX_IMAGE_BYTES = 128 * 1024
+
+#: Number of bytes of any other content to read, enough for the metadata
+#: extracted from it.
+MAX_HEADER_BYTES = 4096
+
+#: Range of bytes to request, covering as much as L{_readPageBody} will read
+#: of any content, so that servers that honour it report the content's size
+#: without truncating it.
+PAGE_RANGE = 'bytes=0-%d' % (
+    max(MAX_PAGE_BYTES, MAX_IMAGE_BYTES, MAX_HEADER_BYTES) - 1,)
+
+def _readPageBody(response):
+    """
+    Read as much of C{response}'s body as is needed to build the page title
+    and metadata.
+
+    Pages are read until the end of their title, images until their
+    dimensions are known and other content only as far as L{MAX_HEADER_BYTES}.
+    """
+    contentType, = response.headers.getRawHeaders(
+        'content-type', ['application/octet-stream'])
+    if _hasTitle(contentType):
+        return util.readBody(response, MAX_PAGE_BYTES, _TitleEnd())
+    elif contentType.startswith('image'):
+        return util.readBody(response, MAX_IMAGE_BYTES, _ImageHeaderEnd())
+    return util.readBody(response, MAX_HEADER_BYTES)
+
+
+
+_fetchPool = None
+
+def getFetchPool():
+    """
+    Get the L{eridanusstd.defertools.JobPool} that page fetches are run in,
+    creating it if need be.
+
+    The pool is shared by every LinkDB in the process, so that the number of
+    connections made, in total and to any single host, is bounded.
+    """
+    global _fetchPool
+    if _fetchPool is None:
+        _fetchPool = defertools.JobPool()
+    return _fetchPool
+
+
+def _normalizeURL(url):
+    """
+    Normalize C{url} for the purpose of identifying the page it refers to.
+
+    The scheme and host are lowercased and the fragment is dropped, since it
+    is never sent to the server.
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    return urlparse.urlunsplit(
+        (scheme.lower(), netloc.lower(), path or u'/', query, u''))
+
+
+def _copyPage(page):
+    if page is None:
+        return None
+    title, metadata, etag, lastModified = page
+    return title, dict(metadata), etag, lastModified
+
+
+_pageFetches = defertools.SingleFlight(_copyPage)
+
+def fetchPage(url, queue=None, etag=None, lastModified=None):
+    """
+    Fetch the title, metadata and cache validators for C{url}, once the fetch
+    pool allows it.
+
+    If C{etag} or C{lastModified} are given, the request is conditional on
+    the page having changed since they were issued.  Concurrent fetches of the
+    same page are coalesced, every caller receives its own copy of the result.
+
+    @type url: C{unicode}
+
+    @param queue: The fetch pool queue to wait in, usually the channel the URL
+        was seen in, or C{None} for the default queue
+
+    @type etag: C{str}
+    @param etag: C{ETag} of a previously fetched copy of the page
+
+    @type lastModified: C{str}
+    @param lastModified: C{Last-Modified} of a previously fetched copy of the
+        page
+
+    @rtype: C{Deferred} firing with C{(unicode, dict, str, str)} or C{None}
+    @return: The page title, or C{None}, metadata and the page's C{ETag} and
+        C{Last-Modified} headers, either of which may be C{None}; or C{None}
+        if the page has not been modified
+    """
+    host = urlparse.urlsplit(url).hostname
+    return _pageFetches.call(
+        (_normalizeURL(url), etag, lastModified),
+        getFetchPool().submit, queue, host, _fetchPageData, url,
+        etag, lastModified)
+
+
+def fetchPageData(url, queue=None):
+    """
+    Fetch the title and metadata for C{url}, once the fetch pool allows it.
+
+    @see: L{fetchPage}
+
+    @rtype: C{Deferred} firing with C{(unicode, dict)}
+    @return: The page title, or C{None}, and metadata
+    """
+    return fetchPage(url, queue).addCallback(
+        lambda (title, metadata, etag, lastModified): (title, metadata))
+
+
+def _fetchPageData(url, etag=None, lastModified=None):
+    # Requests must not outlive the fetch pool deadline, or the pool's
+    # limits no longer bound the number of open connections.
+    timeout = getFetchPool().deadline
+
     def _doFetch(headers):
-        return util.PerseverantDownloader(url, headers=headers).go()
+        return util.PerseverantDownloader(
+            url, timeout=timeout, headers=headers,
+            readBody=_readPageBody).go()
 
     def maybeBadBehaviour(f):
         # Once upon a time retards invaded Earth and invented
@@ -292,22 +445,90 @@ def fetchPageData(url):
             return _doFetch(Headers())
         return f
 
+    def notModified(f):
+        f.trap(weberror.Error)
+        if int(f.value.status) == 304:
+            return None
+        return f
+
+    def parseFailed(f):
+        # Give up on the title rather than wait on a busy parser pool.
+        f.trap(errors.DeadlineExceeded, errors.WorkerPoolFull)
+        log.msg('Extracting title for %s failed: %s' % (
+            url, f.getErrorMessage()))
+        return None
+
     def gotData((data, headers)):
         metadata = dict(_buildMetadata(data, headers))
 
         contentType = metadata.get('contentType', u'application/octet-stream')
-        major, minor = util.padIterable(contentType.split(u'/', 1), 2)
-        if major == u'text' or u'html' in minor:
-            title = _extractTitle(data)
+        if _hasTitle(contentType):
+            d = _decodeText(data, contentType
+                ).addCallback(lambda text: deferToParser(_extractTitle, text)
+                ).addErrback(parseFailed)
         else:
-            title = None
-
-        return succeed((title, metadata))
-
-    headers = Headers({'range': ['bytes=0-4095']})
+            d = succeed(None)
+
+        etag, = headers.getRawHeaders('etag', [None])
+        lastModified, = headers.getRawHeaders('last-modified', [None])
+        return d.addCallback(
+            lambda title: (title, metadata, etag, lastModified))
+
+    headers = Headers({'range': [PAGE_RANGE]})
+    if etag is not None:
+        headers.addRawHeader('if-none-match', etag)
+    if lastModified is not None:
+        headers.addRawHeader('if-modified-since', lastModified)
     return _doFetch(headers
         ).addErrback(maybeBadBehaviour
-        ).addCallback(gotData)
+        ).addCallback(gotData
+        ).addErrback(notModified)
+
+
+def getPageCache(store):
+    """
+    Get the L{PageCache} for C{store}, creating it if need be.
+    """
+    return store.findOrCreate(PageCache)
+
+
+def _hostKey(url):
+    """
+    Get the host of C{url} with its labels reversed, for L{LinkEntry.host}.
+
+    @rtype: C{unicode} or C{None}
+    @return: The reversed host, e.g. C{u"com.example.www"}, or C{None} if
+        C{url} has no host
+    """
+    host = urlparse.urlsplit(url).hostname
+    if not host:
+        return None
+    return u'.'.join(reversed(host.rstrip(u'.').split(u'.')))
+
+
+def _countByNick(store, comparison, limit=None):
+    """
+    Count the L{LinkEntry}s matching C{comparison} by nickname, in the
+    database.
+
+    @rtype: C{iterable} of C{(unicode, int)}
+    @return: Nicknames and their number of entries, most entries first
+    """
+    nick = LinkEntry.nick.getColumnName(store)
+    sql = ('SELECT %s, COUNT(*) FROM %s WHERE %s GROUP BY %s '
+           'ORDER BY COUNT(*) DESC, %s DESC' % (
+               nick,
+               store.getTableName(LinkEntry),
+               comparison.getQuery(store),
+               nick,
+               nick))
+    args = list(comparison.getArgs(store))
+    if limit is not None:
+        sql += ' LIMIT ?'
+        args.append(limit)
+
+    for nick, count in store.querySQL(sql, args):
+        yield nick, count
 
 
 class LinkManager(Item):
@@ -326,13 +547,15 @@ class LinkManager(Item):
     The previously allocated entry ID, starting at 0.
     """, allowNone=False, default=0)
 
-    searchIndexer = inmemory()
-
     def __repr__(self):
         return '<%s %s>' % (type(self).__name__, self.channel)
 
-    def activate(self):
-        self.searchIndexer = IFulltextIndexer(self.store)
+    @property
+    def searchIndexer(self):
+        """
+        The L{LinkEntryIndex} for this manager's store.
+        """
+        return getLinkEntryIndex(self.store)
 
     def createEntry(self, nick, url, title=None):
         """
@@ -358,7 +581,7 @@ class LinkManager(Item):
                          title=title)
 
     # XXX: this function needs work, it does way too many things
-    def getEntries(self, limit=None, discarded=False, deleted=False, sort=None, criteria=None):
+    def getEntries(self, limit=None, discarded=False, deleted=False, sort=None, criteria=None, prefetch=False):
         """
         Retrieve all L{Entry}s given certain criteria.
 
@@ -373,9 +596,31 @@ class LinkManager(Item):
         @param deleted: If this value is not C{None}, only items with the
             specified value will be queried
 
+        @type prefetch: C{bool}
+        @param prefetch: Prefetch the entries' comments and metadata, with
+            L{prefetchEntries}, for displaying them
+
         @rtype: C{iterable}
         @return: Entries that matching the specified criteria
         """
+        if sort is None:
+            sort = LinkEntry.modified.descending
+
+        comparison = self._entryComparison(discarded, deleted, criteria)
+        entries = self.store.query(LinkEntry,
+                                   comparison,
+                                   limit=limit,
+                                   sort=sort)
+        if prefetch:
+            return prefetchEntries(entries)
+        return entries
+
+    def _entryComparison(self, discarded=False, deleted=False, criteria=None):
+        """
+        Build the comparison for querying this manager's entries.
+
+        @see: L{getEntries}
+        """
         if criteria is None:
             criteria = []
 
@@ -384,13 +629,8 @@ class LinkManager(Item):
             criteria.append(LinkEntry.isDiscarded == discarded)
         if deleted is not None:
             criteria.append(LinkEntry.isDeleted == deleted)
-        if sort is None:
-            sort = LinkEntry.modified.descending
 
-        return self.store.query(LinkEntry,
-                                AND(*criteria),
-                                limit=limit,
-                                sort=sort)
+        return AND(*criteria)
 
     def _entryBy(self, eid=None, url=None, evenDeleted=False):
         """
@@ -455,50 +695,126 @@ class LinkManager(Item):
         @type  limit: C{int} or C{None}
         @param limit: Maximum number of results to find.
 
-        @rtype: C{iterable}
-        @return: All L{LinkEntry}s that matched the search term
+        @rtype: C{Deferred} firing with C{list}
+        @return: The L{LinkEntry}s that matched the search term, most relevant
+            first
+        """
+        return self.searchResults(term, limit).addCallback(
+            lambda results: [result.entry for result in results])
+
+
+    def searchResults(self, term, limit=None, offset=0):
+        """
+        Find L{LinkEntry}s with information that matches C{term}, along with
+        snippets of the matching text.
+
+        @type  term: C{unicode}
+        @param term: Words and double-quoted phrases to search for, a
+            trailing C{*} matches a prefix
+
+        @type  limit: C{int} or C{None}
+        @param limit: Maximum number of results to find.
+
+        @type  offset: C{int}
+        @param offset: Number of results to skip.
+
+        @rtype: C{Deferred} firing with C{list} of L{SearchResult}
+        @return: The results, most relevant first
+        """
+        return succeed(
+            self.searchIndexer.search(term, self.channel, limit, offset))
+
+
+    def _buildQuery(self, query, limit):
+        """
+        Build the SQL, and its arguments, for a L{LinkQuery} without free
+        text.
+        """
+        store = self.store
+        comparison = self._entryComparison(
+            criteria=[query.getComparison(store)])
+        sql = 'SELECT %s FROM %s WHERE %s ORDER BY %s DESC LIMIT ?' % (
+            LinkEntry.storeID.getColumnName(store),
+            store.getTableName(LinkEntry),
+            comparison.getQuery(store),
+            LinkEntry.created.getColumnName(store))
+        if limit is None:
+            limit = -1
+        return sql, list(comparison.getArgs(store)) + [limit]
+
+
+    def query(self, query, limit=None):
+        """
+        Find L{LinkEntry}s matching a query.
+
+        Queries with free text are ranked by the full-text index, other
+        queries find the most recently created entries first.
+
+        @type  query: C{unicode}
+        @param query: Query to parse with L{parseQuery}
+
+        @type  limit: C{int} or C{None}
+        @param limit: Maximum number of results to find.
+
+        @raise errors.InvalidQuery: If C{query} cannot be parsed
+
+        @rtype: C{Deferred} firing with C{list} of L{SearchResult}
+        @return: The results, which only have snippets for queries with free
+            text
         """
-        def getEntries(results):
-            def getEntryItemByID(storeID):
-                return self.store.getItemByID(storeID).getEntry()
+        query = parseQuery(query)
+        if query.text:
+            return succeed(self.searchIndexer.search(
+                query.text,
+                self.channel,
+                limit,
+                criteria=query.getComparison(self.store)))
+
+        if not query.filters:
+            return succeed([])
+
+        store = self.store
+        return succeed([SearchResult(store.getItemByID(storeID), None)
+                        for (storeID,) in store.querySQL(
+                            *self._buildQuery(query, limit))])
 
-            def _validEntry(e):
-                return e.channel == self.channel and not (e.isDiscarded or e.isDeleted)
 
-            def _removeDuplicates(entries):
-                seen = set()
-                for entry in entries:
-                    if entry not in seen:
-                        seen.add(entry)
-                        yield entry
+    def explain(self, query):
+        """
+        Explain how SQLite will perform a L{query}.
+
+        @type  query: C{unicode}
 
-            entries = (getEntryItemByID(r.uniqueIdentifier) for r in results)
-            entries = _removeDuplicates(itertools.ifilter(_validEntry, entries))
-            entries = itertools.islice(entries, limit)
-            return sorted(entries, key=lambda e: e.modified, reverse=True)
+        @rtype: C{list} of C{unicode}
+        @return: The steps of the query plan, naming the tables scanned and
+            the indexes used
+        """
+        query = parseQuery(query)
+        if query.text:
+            return self.searchIndexer.explain(
+                query.text,
+                self.channel,
+                criteria=query.getComparison(self.store))
 
-        return self.searchIndexer.search(term).addCallback(getEntries)
+        if not query.filters:
+            return []
+        return explainQuery(self.store, *self._buildQuery(query, None))
 
 
     # XXX: should this really be a method?
     def topContributors(self, limit=None):
-        query = self.getEntries(sort=LinkEntry.nick.descending)
-
-        runningTotal = 0
-        contributors = 0
+        """
+        Find the nicknames that authored the most entries.
 
-        # XXX: this doesn't seem optimal
-        groups = ((nick, len(list(entries))) for nick, entries in itertools.groupby(query, lambda e: e.nick))
-        groups = sorted(groups, reverse=True, key=lambda g: g[1])
+        Entries are counted by the database, rather than being loaded.
 
-        for nick, count in itertools.islice(groups, limit):
-            contributors += 1
-            runningTotal += count
-            yield nick, count
+        @type limit: C{int} or C{None}
+        @param limit: The maximum number of contributors to find
 
-        # XXX: other seems a bit of a pointless thing
-        #if limit is not None and contributors > limit:
-        #    yield 'Other', totalEntries - runningTotal
+        @rtype: C{iterable} of C{(unicode, int)}
+        @return: Nicknames and their number of entries, most entries first
+        """
+        return _countByNick(self.store, self._entryComparison(), limit)
 
     def recent(self, count, nickname):
         if nickname is not None:
@@ -506,34 +822,33 @@ class LinkManager(Item):
         else:
             criteria = None
         return self.getEntries(limit=count,
-                               criteria=criteria)
+                               criteria=criteria,
+                               prefetch=True)
 
     # XXX: should this really be a method?
     def stats(self):
-        store = self.store
-        entries = store.query(LinkEntry,
-                              LinkEntry.channel == self.channel,
-                              sort=LinkEntry.created.ascending)
-        numComments = store.query(LinkEntryComment,
-                                  AND(LinkEntryComment.parent == LinkEntry.storeID,
-                                      LinkEntry.channel == self.channel)).count()
-
-        numEntries = entries.count()
-        numContributors = len(list(entries.getColumn('nick').distinct()))
-        if numEntries > 0:
-            start = iter(entries).next().created
-            age = Time() - start
+        """
+        Get statistics for the entries in this manager's channel that are
+        neither discarded nor deleted.
+
+        @rtype: C{(int, int, int, datetime.timedelta)}
+        @return: The number of entries, comments and contributors, and the
+            age of the oldest entry
+        """
+        stats = getChannelStats(self.store, self.channel)
+        if stats.firstEntry is not None:
+            age = Time() - stats.firstEntry
         else:
             age = datetime.timedelta()
 
-        return numEntries, numComments, numContributors, age
+        return stats.entries, stats.comments, stats.contributors, age
 
 
 class LinkEntry(Item):
     implements(IFulltextIndexable)
 
     typeName = 'eridanus_plugins_linkdb_linkentry'
-    schemaVersion = 1
+    schemaVersion = 3
 
     eid = integer(doc="""
     The ID of this entry.
@@ -575,20 +890,69 @@ class LinkEntry(Item):
     Indicates whether this item is to be considered at all.
     """, default=False)
 
+    host = text(doc="""
+    The host of L{url}, with its labels reversed, e.g. C{u"com.example.www"},
+    so that a domain and its subdomains sort together.  Filled in when the
+    entry is stored.
+    """)
+
+    initialCommentText = text(doc="""
+    The text of the initial comment, or C{None} if there isn't one.
+
+    @see: L{getInitialComment}
+    """)
+
+    initialCommentNick = text(doc="""
+    The nickname of the author of the initial comment, or C{None} if there
+    isn't one.
+    """)
+
+    metadata = textlist(doc="""
+    The entry's metadata, as alternating kinds and data.
+
+    @see: L{getMetadata}
+    """, allowNone=False, default=[])
+
+    contentType = text(doc="""
+    The C{contentType} metadata, if any, for filtering entries by.
+    """)
+
+    compoundIndex(channel, nick)
+    compoundIndex(channel, created)
+    compoundIndex(channel, host)
+    compoundIndex(channel, contentType)
+
+    _prefetchedComments = inmemory()
+
     def __repr__(self):
         return '<%s %s %s>' % (type(self).__name__, self.canonical, self.url)
 
+    def activate(self):
+        self._prefetchedComments = None
+
     def stored(self):
+        if self.host is None:
+            self.host = _hostKey(self.url)
+
         # Tell the batch processor that we have data to index.
         s = self.store.findUnique(LinkEntrySource)
         s.itemAdded()
 
+        if self.isVisible:
+            stats = _findChannelStats(self.store, self.channel)
+            if stats is not None:
+                stats.entryShown(self)
+
 
     def getEntry(self):
         return self
 
 
     def getComments(self, initial=None):
+        if self._prefetchedComments is not None:
+            return iter([comment for comment in self._prefetchedComments
+                         if initial is None or comment.initial == initial])
+
         criteria = [LinkEntryComment.parent == self]
         if initial is not None:
             criteria.append(LinkEntryComment.initial == initial)
@@ -609,10 +973,9 @@ class LinkEntry(Item):
 
     @property
     def displayComment(self):
-        comment = self.getInitialComment()
-        if comment is None:
+        if self.initialCommentText is None:
             return u''
-        return u' [%s]' % (comment.comment,)
+        return u' [%s]' % (self.initialCommentText,)
 
     @property
     def slug(self):
@@ -641,9 +1004,8 @@ class LinkEntry(Item):
         if self.title is not None:
             title = self.title
         else:
-            comment = self.getInitialComment()
-            if comment is not None:
-                title = comment.comment
+            if self.initialCommentText is not None:
+                title = self.initialCommentText
             else:
                 title = self.slug
 
@@ -688,12 +1050,15 @@ class LinkEntry(Item):
         except StopIteration:
             return None
 
-    def _getMetadata(self):
-        return self.store.query(LinkEntryMetadata,
-                                LinkEntryMetadata.entry == self)
-
     def getMetadata(self):
-        return dict((md.kind, md.data) for md in self._getMetadata())
+        """
+        Get this entry's metadata.
+
+        @rtype: C{dict} mapping C{unicode} to C{unicode}
+        @return: A mapping of metadata kinds to metadata data
+        """
+        metadata = self.metadata
+        return dict(zip(metadata[::2], metadata[1::2]))
 
     def addComment(self, nick, comment):
         """
@@ -712,7 +1077,7 @@ class LinkEntry(Item):
         @rtype: L{LinkEntryComment}
         @return: The newly created comment
         """
-        initial = self.getInitialComment() is None and nick == self.nick
+        initial = self.initialCommentText is None and nick == self.nick
         return self.store.findOrCreate(LinkEntryComment, parent=self, nick=nick, comment=comment, initial=initial)
 
     def touchEntry(self):
@@ -722,14 +1087,58 @@ class LinkEntry(Item):
         self.modified = Time()
         self.occurences += 1
 
-    # XXX: does anything use this?
-    #def getMetadataByKind(self, kind):
-    #    """
-    #    Get all L{LinkEntryMetadata} items associated with this entry.
-    #    """
-    #    return self.store.query(LinkEntryMetadata,
-    #                            AND(LinkEntryMetadata.entry == self,
-    #                                LinkEntryMetadata.kind == kind))
+    @property
+    def isVisible(self):
+        """
+        Is this entry neither discarded nor deleted?
+        """
+        return not (self.isDiscarded or self.isDeleted)
+
+    def _setVisibility(self, **kw):
+        """
+        Set this entry's C{isDiscarded} or C{isDeleted} attributes, keeping
+        its channel's L{LinkChannelStats} up to date.
+        """
+        def _set():
+            wasVisible = self.isVisible
+            for name, value in kw.iteritems():
+                setattr(self, name, value)
+
+            stats = _findChannelStats(self.store, self.channel)
+            if stats is not None and wasVisible != self.isVisible:
+                if wasVisible:
+                    stats.entryHidden(self)
+                else:
+                    stats.entryShown(self)
+
+        self.store.transact(_set)
+
+    def setDiscarded(self, discarded):
+        """
+        Discard or undiscard this entry.
+
+        @type discarded: C{bool}
+        """
+        self._setVisibility(isDiscarded=discarded)
+
+    def setDeleted(self, deleted):
+        """
+        Delete or undelete this entry.
+
+        @type deleted: C{bool}
+        """
+        self._setVisibility(isDeleted=deleted)
+
+    def setTitle(self, title):
+        """
+        Change this entry's title, reindexing it if it has been indexed.
+
+        @type title: C{unicode}
+        """
+        self.title = title
+        index = _findLinkEntryIndex(self.store)
+        if index is not None:
+            index.index(self)
 
     def updateMetadata(self, metadata):
         """
@@ -739,10 +1148,10 @@ class LinkEntry(Item):
         @param metadata: A mapping of metadata kinds to metadata data to use
             for updating this entry's metadata
         """
-        store = self.store
-        for kind, data in metadata.iteritems():
-            md = store.findOrCreate(LinkEntryMetadata, entry=self, kind=kind)
-            md.data = data
+        md = self.getMetadata()
+        md.update(metadata)
+        self.metadata = list(itertools.chain(*sorted(md.iteritems())))
+        self.contentType = md.get(u'contentType')
 
     # IFulltextIndexable
 
@@ -757,10 +1166,123 @@ class LinkEntry(Item):
 
 
 
+declareLegacyItem(LinkEntry.typeName, 1, dict(
+    eid=integer(indexed=True, allowNone=False),
+    created=timestamp(),
+    modified=timestamp(),
+    channel=text(indexed=True, allowNone=False),
+    nick=text(allowNone=False),
+    url=text(indexed=True, allowNone=False),
+    title=text(),
+    occurences=integer(default=1),
+    isDiscarded=boolean(default=False),
+    isDeleted=boolean(default=False)))
+
+def linkEntry1to2(old):
+    """
+    Fill in the host of each entry's URL.
+    """
+    return old.upgradeVersion(
+        LinkEntry.typeName, 1, 2,
+        eid=old.eid,
+        created=old.created,
+        modified=old.modified,
+        channel=old.channel,
+        nick=old.nick,
+        url=old.url,
+        title=old.title,
+        occurences=old.occurences,
+        isDiscarded=old.isDiscarded,
+        isDeleted=old.isDeleted,
+        host=_hostKey(old.url))
+
+registerUpgrader(linkEntry1to2, LinkEntry.typeName, 1, 2)
+
+
+
+declareLegacyItem(LinkEntry.typeName, 2, dict(
+    eid=integer(indexed=True, allowNone=False),
+    created=timestamp(),
+    modified=timestamp(),
+    channel=text(indexed=True, allowNone=False),
+    nick=text(allowNone=False),
+    url=text(indexed=True, allowNone=False),
+    title=text(),
+    occurences=integer(default=1),
+    isDiscarded=boolean(default=False),
+    isDeleted=boolean(default=False),
+    host=text()))
+
+def linkEntry2to3(old):
+    """
+    Copy the initial comment onto the entry, and move the entry's
+    L{LinkEntryMetadata} items into L{LinkEntry.metadata}.
+    """
+    new = old.upgradeVersion(
+        LinkEntry.typeName, 2, 3,
+        eid=old.eid,
+        created=old.created,
+        modified=old.modified,
+        channel=old.channel,
+        nick=old.nick,
+        url=old.url,
+        title=old.title,
+        occurences=old.occurences,
+        isDiscarded=old.isDiscarded,
+        isDeleted=old.isDeleted,
+        host=old.host)
+
+    comment = new.getInitialComment()
+    if comment is not None:
+        new.initialCommentText = comment.comment
+        new.initialCommentNick = comment.nick
+
+    metadata = new.store.query(LinkEntryMetadata,
+                               LinkEntryMetadata.entry == new)
+    new.updateMetadata(dict((md.kind, md.data) for md in metadata))
+    metadata.deleteFromStore()
+    return new
+
+registerUpgrader(linkEntry2to3, LinkEntry.typeName, 2, 3)
+
+
+
 LinkEntrySource = batch.processor(LinkEntry)
 
 
 
+def prefetchEntries(entries, batchSize=500):
+    """
+    Load the comments of L{LinkEntry}s in bulk.
+
+    Entries are prefetched in batches of C{batchSize}, with one query for the
+    comments of each batch, so that listing their comments afterwards needs
+    no further queries.
+
+    @type entries: C{iterable} of L{LinkEntry}
+
+    @rtype: C{iterator} of L{LinkEntry}
+    @return: C{entries}, each batch yielded once it has been prefetched
+    """
+    entries = iter(entries)
+    while True:
+        batch = list(itertools.islice(entries, batchSize))
+        if not batch:
+            break
+
+        store = batch[0].store
+        comments = dict((entry.storeID, []) for entry in batch)
+        for comment in store.query(LinkEntryComment,
+                                   LinkEntryComment.parent.oneOf(batch),
+                                   sort=LinkEntryComment.created.ascending):
+            comments[comment.parent.storeID].append(comment)
+
+        for entry in batch:
+            entry._prefetchedComments = comments[entry.storeID]
+            yield entry
+
+
+
 class LinkEntryComment(Item):
     implements(IFulltextIndexable)
 
@@ -796,6 +1318,17 @@ class LinkEntryComment(Item):
         s = self.store.findUnique(LinkEntryCommentSource)
         s.itemAdded()
 
+        parent = self.parent
+        parent._prefetchedComments = None
+        if self.initial and parent.initialCommentText is None:
+            parent.initialCommentText = self.comment
+            parent.initialCommentNick = self.nick
+
+        if parent.isVisible:
+            stats = _findChannelStats(self.store, parent.channel)
+            if stats is not None:
+                stats.comments += 1
+
 
     def getEntry(self):
         return self.parent
@@ -833,6 +1366,11 @@ LinkEntryCommentSource = batch.processor(LinkEntryComment)
 
 
 class LinkEntryMetadata(Item):
+    """
+    Metadata for a L{LinkEntry}, from before metadata was stored on the entry
+    itself.  These items only exist until L{linkEntry2to3} moves them onto
+    their entries.
+    """
     typeName = 'eridanus_plugins_linkdb_linkentrymetadata'
     schemaVersion = 1
 
@@ -850,3 +1388,1070 @@ class LinkEntryMetadata(Item):
 
     def __repr__(self):
         return '<%s %s: %r>' % (type(self).__name__, self.kind, self.data)
+
+
+
+def _visibleEntries(channel):
+    """
+    Build the comparison for the L{LinkEntry}s in C{channel} that are neither
+    discarded nor deleted.
+    """
+    return AND(LinkEntry.channel == channel,
+               LinkEntry.isDiscarded == False,
+               LinkEntry.isDeleted == False)
+
+
+
+def _findChannelStats(store, channel):
+    """
+    Find the L{LinkChannelStats} for C{channel}, if it has been built yet.
+    """
+    return store.findUnique(LinkChannelStats,
+                            LinkChannelStats.channel == channel,
+                            default=None)
+
+
+
+def getChannelStats(store, channel):
+    """
+    Get the L{LinkChannelStats} for C{channel}, building it if need be.
+
+    @rtype: L{LinkChannelStats}
+    """
+    stats = _findChannelStats(store, channel)
+    if stats is None:
+        stats = LinkChannelStats(store=store, channel=channel)
+        stats.rebuild()
+    return stats
+
+
+
+class LinkChannelStats(Item):
+    """
+    Statistics for the entries in a channel that are neither discarded nor
+    deleted.
+
+    Statistics are kept up to date as entries and comments are created, and
+    as entries are discarded or deleted, or restored, with
+    L{LinkEntry.setDiscarded} and L{LinkEntry.setDeleted}.
+    """
+    typeName = 'eridanus_plugins_linkdb_linkchannelstats'
+    schemaVersion = 1
+
+    channel = text(doc="""
+    The channel these statistics are for.
+    """, indexed=True, allowNone=False)
+
+    entries = integer(doc="""
+    Number of entries.
+    """, allowNone=False, default=0)
+
+    comments = integer(doc="""
+    Number of comments on entries.
+    """, allowNone=False, default=0)
+
+    contributors = integer(doc="""
+    Number of distinct nicknames that authored entries.
+    """, allowNone=False, default=0)
+
+    firstEntry = timestamp(doc="""
+    Timestamp of when the oldest entry was created, or C{None} if there are
+    no entries.
+    """)
+
+    def __repr__(self):
+        return '<%s %s: %d entries>' % (
+            type(self).__name__, self.channel, self.entries)
+
+
+    def _getContributor(self, nick):
+        return self.store.findOrCreate(LinkChannelContributor,
+                                       channel=self.channel,
+                                       nick=nick)
+
+
+    def _findFirstEntry(self):
+        for created in self.store.query(
+            LinkEntry,
+            _visibleEntries(self.channel),
+            sort=LinkEntry.created.ascending,
+            limit=1).getColumn('created'):
+            return created
+        return None
+
+
+    def entryShown(self, entry):
+        """
+        Count C{entry}, and its comments.
+        """
+        self.entries += 1
+        self.comments += self.store.count(LinkEntryComment,
+                                          LinkEntryComment.parent == entry)
+        contributor = self._getContributor(entry.nick)
+        if contributor.entries == 0:
+            self.contributors += 1
+        contributor.entries += 1
+        if self.firstEntry is None or entry.created < self.firstEntry:
+            self.firstEntry = entry.created
+
+
+    def entryHidden(self, entry):
+        """
+        Stop counting C{entry}, and its comments.
+        """
+        self.entries -= 1
+        self.comments -= self.store.count(LinkEntryComment,
+                                          LinkEntryComment.parent == entry)
+        contributor = self._getContributor(entry.nick)
+        contributor.entries -= 1
+        if contributor.entries == 0:
+            self.contributors -= 1
+            contributor.deleteFromStore()
+        if entry.created == self.firstEntry:
+            self.firstEntry = self._findFirstEntry()
+
+
+    def rebuild(self):
+        """
+        Recount everything from scratch.
+        """
+        def _rebuild():
+            store = self.store
+            comparison = _visibleEntries(self.channel)
+            store.query(LinkChannelContributor,
+                        LinkChannelContributor.channel == self.channel
+                        ).deleteFromStore()
+
+            self.entries = store.count(LinkEntry, comparison)
+            self.comments = store.query(
+                LinkEntryComment,
+                AND(LinkEntryComment.parent == LinkEntry.storeID,
+                    comparison)).count()
+            self.contributors = 0
+            for nick, count in _countByNick(store, comparison):
+                LinkChannelContributor(store=store,
+                                       channel=self.channel,
+                                       nick=nick,
+                                       entries=count)
+                self.contributors += 1
+            self.firstEntry = self._findFirstEntry()
+
+        self.store.transact(_rebuild)
+
+
+
+class LinkChannelContributor(Item):
+    """
+    The number of entries a nickname authored in a channel, for
+    L{LinkChannelStats}.
+    """
+    typeName = 'eridanus_plugins_linkdb_linkchannelcontributor'
+    schemaVersion = 1
+
+    channel = text(doc="""
+    The channel the entries are in.
+    """, allowNone=False)
+
+    nick = text(doc="""
+    The nickname that authored the entries.
+    """, allowNone=False)
+
+    entries = integer(doc="""
+    The number of entries, neither discarded nor deleted.
+    """, allowNone=False, default=0)
+
+    compoundIndex(channel, nick)
+
+    def __repr__(self):
+        return '<%s %s %s: %d>' % (
+            type(self).__name__, self.channel, self.nick, self.entries)
+
+
+
+def explainQuery(store, sql, args=()):
+    """
+    Explain how SQLite will perform a query.
+
+    @rtype: C{list} of C{unicode}
+    @return: The steps of the query plan, naming the tables scanned and the
+        indexes used
+    """
+    return [row[-1] for row in
+            store.querySQL('EXPLAIN QUERY PLAN ' + sql, args)]
+
+
+
+def _findLinkEntryIndex(store):
+    """
+    Find the L{LinkEntryIndex} in C{store}, if one has been created yet.
+    """
+    return store.findUnique(LinkEntryIndex, default=None)
+
+
+
+def getLinkEntryIndex(store):
+    """
+    Get the L{LinkEntryIndex} for C{store}, creating it if need be.
+
+    A newly created index is registered with the L{LinkEntry} and
+    L{LinkEntryComment} batch processors, which will index every existing
+    entry.
+
+    @rtype: L{LinkEntryIndex}
+    """
+    return store.findOrCreate(LinkEntryIndex, lambda index: index.addSources())
+
+
+
+_queryTerm = re.compile(r'"([^"]*)"?(\*?)|([^\s"]+)', re.UNICODE)
+
+def _buildMatchQuery(term):
+    """
+    Build an FTS5 query from a user's search term.
+
+    Words and double-quoted phrases must all match, a trailing C{*} makes a
+    word or phrase match as a prefix.  Everything else is matched literally,
+    rather than as FTS5 query syntax.
+
+    @type term: C{unicode}
+
+    @rtype: C{unicode}
+    @return: FTS5 query, or an empty string if C{term} contains nothing to
+        search for
+    """
+    parts = []
+    for phrase, star, word in _queryTerm.findall(term):
+        if word:
+            phrase = word
+        prefix = bool(star) or phrase.endswith(u'*')
+        phrase = phrase.rstrip(u'*').strip()
+        if not phrase:
+            continue
+        part = u'"%s"' % (phrase.replace(u'"', u'""'),)
+        if prefix:
+            part += u' *'
+        parts.append(part)
+    return u' '.join(parts)
+
+
+
+class SearchResult(object):
+    """
+    An entry found by L{LinkEntryIndex.search}.
+
+    @type entry: L{LinkEntry}
+
+    @type snippet: C{unicode}
+    @ivar snippet: The text around the best match in C{entry}'s URL, title or
+        comments, with matching terms in bold
+    """
+    def __init__(self, entry, snippet):
+        self.entry = entry
+        self.snippet = snippet
+
+
+    def __repr__(self):
+        return '<%s %r: %r>' % (type(self).__name__, self.entry, self.snippet)
+
+
+
+class LinkEntryIndex(Item):
+    """
+    Full-text index of L{LinkEntry}s.
+
+    The index is an SQLite FTS5 table in the same database as the entries,
+    with a single document per entry made up of its URL, title and comments.
+    This allows searches to be joined against the entries themselves, so that
+    entries from other channels, or that are discarded or deleted, are
+    excluded and results are ranked, by BM25, and limited by the database.
+    """
+    implements(iaxiom.IReliableListener)
+
+    typeName = 'eridanus_plugins_linkdb_linkentryindex'
+    schemaVersion = 2
+
+    tableName = 'eridanus_linkdb_fts5'
+
+    # BM25 weights of the url, title and comments columns.
+    weights = (1.0, 4.0, 2.0)
+
+    snippetTokens = 8
+
+    indexCount = integer(doc="""
+    Number of times an entry has been indexed.
+    """, allowNone=False, default=0)
+
+    _tableCreated = inmemory()
+
+    def activate(self):
+        self._tableCreated = False
+
+
+    def __repr__(self):
+        return '<%s %d indexed>' % (type(self).__name__, self.indexCount)
+
+
+    def _createTable(self):
+        if not self._tableCreated:
+            self.store.createSQL(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS main.%s '
+                'USING fts5(url, title, comments, prefix=\'2 3\')' % (
+                    self.tableName,))
+            self._tableCreated = True
+
+
+    def _getSources(self):
+        store = self.store
+        return [store.findOrCreate(LinkEntrySource),
+                store.findOrCreate(LinkEntryCommentSource)]
+
+
+    def addSources(self):
+        """
+        Index entries, and their comments, as they are created.
+        """
+        for source in self._getSources():
+            source.addReliableListener(self, style=iaxiom.REMOTE)
+
+
+    def reset(self):
+        """
+        Empty the index and have the batch processors index every entry all
+        over again.
+        """
+        self._createTable()
+        self.store.executeSQL('DELETE FROM main.%s' % (self.tableName,))
+        self.indexCount = 0
+        for source in self._getSources():
+            source.removeReliableListener(self)
+        self.addSources()
+
+
+    def rebuild(self):
+        """
+        Empty the index and index every entry all over again, immediately.
+        """
+        def _rebuild():
+            self._createTable()
+            self.store.executeSQL('DELETE FROM main.%s' % (self.tableName,))
+            self.indexCount = 0
+            for entry in prefetchEntries(self.store.query(LinkEntry)):
+                self.index(entry)
+
+        self.store.transact(_rebuild)
+
+
+    def index(self, entry):
+        """
+        Index, or reindex, C{entry}.
+
+        @type entry: L{LinkEntry}
+        """
+        self._createTable()
+        comments = []
+        for comment in entry.getComments():
+            comments.extend(comment.textParts())
+
+        docid = entry.storeID
+        self.store.executeSQL(
+            'DELETE FROM main.%s WHERE rowid = ?' % (self.tableName,),
+            [docid])
+        self.store.executeSQL(
+            'INSERT INTO main.%s (rowid, url, title, comments) '
+            'VALUES (?, ?, ?, ?)' % (self.tableName,),
+            [docid, entry.url, entry.title, u' '.join(comments)])
+        self.indexCount += 1
+
+
+    def _buildSearch(self, term, channel, limit, offset, criteria):
+        """
+        Build the SQL, and its arguments, for L{search}.
+
+        @rtype: C{(str, list)} or C{None}
+        @return: The SQL and its arguments, or C{None} if C{term} contains
+            nothing to search for
+        """
+        query = _buildMatchQuery(term)
+        if not query:
+            return None
+
+        self._createTable()
+        store = self.store
+        comparison = _visibleEntries(channel)
+        if criteria is not None:
+            comparison = AND(comparison, criteria)
+        sql = ('SELECT %s, snippet(%s, -1, ?, ?, ?, ?) '
+               'FROM main.%s, %s '
+               'WHERE %s MATCH ? AND %s = %s.rowid AND %s '
+               'ORDER BY bm25(%s, %s), %s DESC '
+               'LIMIT ? OFFSET ?' % (
+                   LinkEntry.storeID.getColumnName(store),
+                   self.tableName,
+                   self.tableName,
+                   store.getTableName(LinkEntry),
+                   self.tableName,
+                   LinkEntry.storeID.getColumnName(store),
+                   self.tableName,
+                   comparison.getQuery(store),
+                   self.tableName,
+                   ', '.join(map(str, self.weights)),
+                   LinkEntry.modified.getColumnName(store)))
+        if limit is None:
+            limit = -1
+        args = ([u'\002', u'\002', u'...', self.snippetTokens, query] +
+                list(comparison.getArgs(store)) +
+                [limit, offset])
+        return sql, args
+
+
+    def search(self, term, channel, limit=None, offset=0, criteria=None):
+        """
+        Find the L{LinkEntry}s in C{channel} that match C{term}, and are
+        neither discarded nor deleted.
+
+        @type term: C{unicode}
+        @param term: Words and double-quoted phrases to search for, a
+            trailing C{*} matches a prefix
+
+        @type limit: C{int} or C{None}
+        @param limit: Maximum number of entries to find
+
+        @type offset: C{int}
+        @param offset: Number of matching entries to skip
+
+        @param criteria: Additional comparison, on L{LinkEntry}, that entries
+            must match, or C{None}
+
+        @rtype: C{list} of L{SearchResult}
+        @return: Matching entries, most relevant first
+        """
+        search = self._buildSearch(term, channel, limit, offset, criteria)
+        if search is None:
+            return []
+
+        store = self.store
+        return [SearchResult(store.getItemByID(storeID), snippet)
+                for storeID, snippet in store.querySQL(*search)]
+
+
+    def explain(self, term, channel, criteria=None):
+        """
+        Explain how SQLite will perform a L{search}.
+
+        @rtype: C{list} of C{unicode}
+        @return: The steps of the query plan
+        """
+        search = self._buildSearch(term, channel, None, 0, criteria)
+        if search is None:
+            return []
+        return explainQuery(self.store, *search)
+
+
+    # IReliableListener
+
+    def processItem(self, item):
+        self.index(item.getEntry())
+
+
+    def suspend(self):
+        return succeed(None)
+
+
+    def resume(self):
+        return succeed(None)
+
+
+
+declareLegacyItem(LinkEntryIndex.typeName, 1, dict(indexCount=integer()))
+
+def linkEntryIndex1to2(old):
+    """
+    Drop the FTS4 table and rebuild the index with FTS5.
+    """
+    new = old.upgradeVersion(LinkEntryIndex.typeName, 1, 2, indexCount=0)
+    new.store.createSQL('DROP TABLE IF EXISTS main.eridanus_linkdb_fts')
+    new.reset()
+    return new
+
+registerUpgrader(linkEntryIndex1to2, LinkEntryIndex.typeName, 1, 2)
+
+
+
+def _prefixRange(attribute, prefix):
+    """
+    Build a comparison for values of C{attribute} starting with C{prefix},
+    as a range that an index on C{attribute} can be used for.
+    """
+    end = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+    return AND(attribute >= prefix, attribute < end)
+
+
+
+_absoluteTime = re.compile(r'^(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?$')
+_relativeTime = re.compile(r'^(\d+)([hdwmy])$')
+
+_relativeUnits = {
+    u'h': datetime.timedelta(hours=1),
+    u'd': datetime.timedelta(days=1),
+    u'w': datetime.timedelta(weeks=1),
+    u'm': datetime.timedelta(days=30),
+    u'y': datetime.timedelta(days=365)}
+
+def _parseTime(value, now):
+    """
+    Parse a date, C{YYYY}, C{YYYY-MM} or C{YYYY-MM-DD} in the bot's timezone,
+    or a time relative to C{now}, such as C{3d} for three days ago.
+
+    Relative times are in hours (C{h}), days (C{d}), weeks (C{w}), months of
+    30 days (C{m}) or years of 365 days (C{y}).
+
+    @rtype: C{Time}
+    """
+    match = _relativeTime.match(value)
+    if match is not None:
+        count, unit = match.groups()
+        return now - _relativeUnits[unit] * int(count)
+
+    match = _absoluteTime.match(value)
+    if match is not None:
+        year, month, day = [int(n or 1) for n in match.groups()]
+        try:
+            dt = datetime.datetime(year, month, day, tzinfo=const.timezone)
+        except ValueError:
+            pass
+        else:
+            return Time.fromDatetime(dt)
+
+    raise errors.InvalidQuery(u'Invalid time: %s' % (value,))
+
+
+
+_queryToken = re.compile(r'(?:(\w+):)?("[^"]*"?\*?|[^\s"]+)', re.UNICODE)
+
+class LinkQuery(object):
+    """
+    A parsed link query.
+
+    @see: L{parseQuery}
+
+    @type text: C{unicode}
+    @ivar text: Free text to search the full-text index for
+
+    @type filters: C{list} of C{(unicode, object)}
+    @ivar filters: Field names and their values, C{Time}s for C{before} and
+        C{after}, and C{unicode} otherwise
+    """
+    fields = [u'nick', u'site', u'before', u'after', u'has', u'type']
+
+    hasValues = [u'comment', u'title']
+
+    def __init__(self, text, filters):
+        self.text = text
+        self.filters = filters
+
+
+    def __repr__(self):
+        return '<%s %r %r>' % (type(self).__name__, self.text, self.filters)
+
+
+    def getValues(self, field):
+        """
+        Get the values of every filter for C{field}.
+        """
+        return [value for name, value in self.filters if name == field]
+
+
+    def getComparison(self, store):
+        """
+        Build the comparison, on L{LinkEntry}, for this query's filters.
+
+        Filters for the same field, other than C{before} and C{after}, match
+        if any of them do; filters for different fields must all match.
+
+        @rtype: Axiom comparison or C{None}
+        @return: The comparison, or C{None} if there are no filters
+        """
+        criteria = []
+
+        nicks = self.getValues(u'nick')
+        if nicks:
+            criteria.append(OR(*[LinkEntry.nick == nick for nick in nicks]))
+
+        sites = []
+        for host in self.getValues(u'site'):
+            sites.append(LinkEntry.host == host)
+            sites.append(_prefixRange(LinkEntry.host, host + u'.'))
+        if sites:
+            criteria.append(OR(*sites))
+
+        after = self.getValues(u'after')
+        if after:
+            criteria.append(LinkEntry.created >= max(after))
+        before = self.getValues(u'before')
+        if before:
+            criteria.append(LinkEntry.created < min(before))
+
+        for value in set(self.getValues(u'has')):
+            if value == u'comment':
+                criteria.append(LinkEntry.storeID.oneOf(
+                    store.query(LinkEntryComment).getColumn('parent')))
+            elif value == u'title':
+                criteria.append(LinkEntry.title != None)
+
+        types = []
+        for contentType in self.getValues(u'type'):
+            if u'/' not in contentType:
+                contentType += u'/'
+            types.append(_prefixRange(LinkEntry.contentType, contentType))
+        if types:
+            criteria.append(OR(*types))
+
+        if not criteria:
+            return None
+        return AND(*criteria)
+
+
+
+def parseQuery(query, now=None):
+    """
+    Parse a link query.
+
+    A query is made up of free text, to search entries' URLs, titles and
+    comments for, and any of these filters:
+
+        - C{nick:<nickname>}, entries posted by C{<nickname>};
+
+        - C{site:<domain>}, entries for URLs on C{<domain>} or its
+          subdomains;
+
+        - C{after:<time>} and C{before:<time>}, entries posted at or after, or
+          before, C{<time>}, see L{_parseTime};
+
+        - C{has:comment} or C{has:title}, entries with comments or a title;
+
+        - C{type:<type>}, entries with a content type of C{<type>}, or of the
+          major type C{<type>} such as C{image}.
+
+    @type query: C{unicode}
+
+    @param now: The time relative times are relative to, or C{None} for the
+        current time
+
+    @raise errors.InvalidQuery: If a filter's value is invalid
+
+    @rtype: L{LinkQuery}
+    """
+    if now is None:
+        now = Time()
+
+    text = []
+    filters = []
+    for match in _queryToken.finditer(query):
+        field, value = match.groups()
+        if field is not None:
+            field = field.lower()
+        if field not in LinkQuery.fields:
+            text.append(match.group(0))
+            continue
+
+        value = value.strip(u'"')
+        if field == u'site':
+            host = _hostKey(u'http://%s/' % (value,))
+            if host is None:
+                raise errors.InvalidQuery(u'Invalid site: %s' % (value,))
+            value = host
+        elif field in (u'before', u'after'):
+            value = _parseTime(value, now)
+        elif field == u'has':
+            value = value.lower()
+            if value not in LinkQuery.hasValues:
+                raise errors.InvalidQuery(
+                    u'"has" must be one of: %s' % (
+                        u', '.join(LinkQuery.hasValues),))
+        elif field == u'type':
+            value = value.lower()
+        filters.append((field, value))
+
+    return LinkQuery(u' '.join(text), filters)
+
+
+
+class PageCache(Item):
+    """
+    Cache of page titles and metadata, keyed by URL.
+
+    Cached pages are fresh for C{ttl} seconds after they were fetched, after
+    which they are revalidated with a conditional request; a C{304 Not
+    Modified} response makes them fresh again without refetching them.  At
+    most C{maxEntries} pages are cached, the least recently used pages are
+    removed to make room for new ones.
+
+    @ivar hits: Number of fetches served from the cache without a request
+
+    @ivar revalidated: Number of stale pages found to be unmodified
+
+    @ivar fetched: Number of pages fetched in full
+    """
+    typeName = 'eridanus_plugins_linkdb_pagecache'
+    schemaVersion = 1
+
+    ttl = integer(doc="""
+    Number of seconds a cached page is fresh for.
+    """, allowNone=False, default=3600)
+
+    maxEntries = integer(doc="""
+    Maximum number of cached pages.
+    """, allowNone=False, default=5000)
+
+    hits = inmemory()
+    revalidated = inmemory()
+    fetched = inmemory()
+
+    def __repr__(self):
+        return '<%s ttl=%d maxEntries=%d>' % (
+            type(self).__name__, self.ttl, self.maxEntries)
+
+
+    def activate(self):
+        self.hits = 0
+        self.revalidated = 0
+        self.fetched = 0
+
+
+    def getEntry(self, url):
+        """
+        Get the cache entry for C{url}.
+
+        @rtype: L{PageCacheEntry} or C{None}
+        """
+        return self.store.findUnique(PageCacheEntry,
+                                     PageCacheEntry.url == _normalizeURL(url),
+                                     default=None)
+
+
+    def fetch(self, url, queue=None, refresh=False):
+        """
+        Fetch the title and metadata for C{url}, from the cache if possible.
+
+        @type url: C{unicode}
+
+        @param queue: The fetch pool queue to wait in, see L{fetchPage}
+
+        @type refresh: C{bool}
+        @param refresh: Fetch the page in full, even if it is cached
+
+        @rtype: C{Deferred} firing with C{(unicode, dict)}
+        @return: The page title, or C{None}, and metadata
+        """
+        etag = lastModified = None
+        entry = self.getEntry(url)
+        if entry is not None and not refresh:
+            entry.lastUsed = Time()
+            if entry.isFresh(self.ttl):
+                self.hits += 1
+                return succeed(entry.pageData)
+            etag, lastModified = entry.etag, entry.lastModified
+
+        def gotPage(page):
+            entry = self.getEntry(url)
+            if page is None:
+                if entry is None:
+                    # Pruned while being revalidated.
+                    return self.fetch(url, queue, refresh=True)
+                self.revalidated += 1
+                entry.fetchedAt = Time()
+                return entry.pageData
+
+            self.fetched += 1
+            title, metadata, etag, lastModified = page
+            if entry is None:
+                entry = PageCacheEntry(store=self.store,
+                                       url=_normalizeURL(url))
+                self.prune()
+            entry.title = title
+            entry.metadata = list(itertools.chain(*metadata.iteritems()))
+            entry.etag = etag
+            entry.lastModified = lastModified
+            entry.fetchedAt = entry.lastUsed = Time()
+            return title, metadata
+
+        return fetchPage(url, queue, etag, lastModified
+            ).addCallback(gotPage)
+
+
+    def prune(self):
+        """
+        Remove the least recently used pages in excess of C{maxEntries}.
+        """
+        excess = self.store.count(PageCacheEntry) - self.maxEntries
+        if excess > 0:
+            self.store.query(PageCacheEntry,
+                             sort=PageCacheEntry.lastUsed.ascending,
+                             limit=excess).deleteFromStore()
+
+
+
+class PageCacheEntry(Item):
+    """
+    A page cached by L{PageCache}.
+    """
+    typeName = 'eridanus_plugins_linkdb_pagecacheentry'
+    schemaVersion = 1
+
+    url = text(doc="""
+    The normalized URL of the page.
+    """, indexed=True, allowNone=False)
+
+    title = text(doc="""
+    The page title, or C{None} if it has none.
+    """)
+
+    metadata = textlist(doc="""
+    The page metadata, as alternating keys and values.
+    """, allowNone=False, default=[])
+
+    etag = bytes(doc="""
+    The page's C{ETag} header, if it had one.
+    """)
+
+    lastModified = bytes(doc="""
+    The page's C{Last-Modified} header, if it had one.
+    """)
+
+    fetchedAt = timestamp(doc="""
+    Timestamp of when the page was last fetched or revalidated.
+    """, allowNone=False, defaultFactory=lambda: Time())
+
+    lastUsed = timestamp(doc="""
+    Timestamp of when the page was last requested.
+    """, indexed=True, allowNone=False, defaultFactory=lambda: Time())
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.url)
+
+
+    @property
+    def pageData(self):
+        """
+        The cached page title and metadata.
+
+        @rtype: C{(unicode, dict)}
+        """
+        metadata = self.metadata
+        return self.title, dict(zip(metadata[::2], metadata[1::2]))
+
+
+    def isFresh(self, ttl):
+        """
+        Determine whether this page was fetched within the last C{ttl}
+        seconds.
+        """
+        age = Time() - self.fetchedAt
+        return age < datetime.timedelta(seconds=ttl)
+
+
+
+class LinkEnrichmentJob(Item):
+    """
+    A pending fetch of the title and metadata for an entry.
+
+    Jobs are persistent, so that entries created before a restart are still
+    enriched after it.  See L{LinkEnricher}.
+    """
+    typeName = 'eridanus_plugins_linkdb_linkenrichmentjob'
+    schemaVersion = 1
+
+    entry = reference(doc="""
+    L{LinkEntry} item to fill in the title and metadata of.
+    """, indexed=True, allowNone=False, reftype=LinkEntry,
+        whenDeleted=reference.CASCADE)
+
+    due = timestamp(doc="""
+    Timestamp of when the job should next be attempted.
+    """, indexed=True, allowNone=False, defaultFactory=lambda: Time())
+
+    tries = integer(doc="""
+    Number of failed attempts made so far.
+    """, allowNone=False, default=0)
+
+    manager = reference(doc="""
+    L{LinkManager} to announce the entry through when its title changes, or
+    C{None} if the entry should not be announced.
+    """, reftype=LinkManager, whenDeleted=reference.NULLIFY)
+
+    def __repr__(self):
+        return '<%s %r tries=%d>' % (
+            type(self).__name__, self.entry, self.tries)
+
+
+
+class LinkEnricher(object):
+    """
+    Drain the queue of L{LinkEnrichmentJob}s in a store, filling in entry
+    titles and metadata via the store's L{PageCache}.
+
+    At most L{maxConcurrent} jobs run at once.  Failed jobs are retried, with
+    exponential backoff starting at L{initialDelay} seconds, until they have
+    been tried L{maxTries} times.
+
+    @type announcers: C{dict} mapping C{(str, unicode)} to C{callable}
+    @ivar announcers: Mapping of C{(serviceID, channel)} pairs, identifying a
+        L{LinkManager}, to callables, taking an entry, used to announce
+        entries whose titles change
+    """
+    maxConcurrent = 4
+    maxTries = 5
+    initialDelay = 60.0
+    factor = 4.0
+
+    def __init__(self, store, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.store = store
+        self.clock = clock
+        self.announcers = {}
+        self._running = set()
+        self._delayedCall = None
+        self._pumping = False
+        self._pumpAgain = False
+
+
+    def __repr__(self):
+        return '<%s %d running>' % (type(self).__name__, len(self._running))
+
+
+    def _now(self):
+        return Time.fromPOSIXTimestamp(self.clock.seconds())
+
+
+    def enqueue(self, entry, manager=None):
+        """
+        Queue a job to fill in C{entry}'s title and metadata.
+
+        @type entry: L{LinkEntry}
+
+        @type manager: L{LinkManager}
+        @param manager: Manager to announce C{entry} through if its title
+            changes, or C{None} to not announce it
+        """
+        LinkEnrichmentJob(store=self.store,
+                          entry=entry,
+                          due=self._now(),
+                          manager=manager)
+        self.pump()
+
+
+    def pump(self):
+        """
+        Start as many due jobs as the concurrency limit allows, and schedule
+        another pump for when the next job is due.
+        """
+        # Jobs served from the page cache complete, and pump, immediately.
+        if self._pumping:
+            self._pumpAgain = True
+            return
+
+        self._pumping = True
+        try:
+            self._pumpAgain = True
+            while self._pumpAgain:
+                self._pumpAgain = False
+                self._pump()
+        finally:
+            self._pumping = False
+
+
+    def _pump(self):
+        if self._delayedCall is not None and self._delayedCall.active():
+            self._delayedCall.cancel()
+        self._delayedCall = None
+
+        # Finished jobs pump again, so there is nothing to do until then.
+        free = self.maxConcurrent - len(self._running)
+        if free <= 0:
+            return
+
+        now = self._now()
+        due = list(self.store.query(
+            LinkEnrichmentJob,
+            AND(LinkEnrichmentJob.due <= now,
+                LinkEnrichmentJob.storeID.notOneOf(self._running)),
+            sort=LinkEnrichmentJob.due.ascending,
+            limit=free))
+        for job in due:
+            self._run(job)
+        if len(due) == free:
+            return
+
+        for job in self.store.query(LinkEnrichmentJob,
+                                    LinkEnrichmentJob.due > now,
+                                    sort=LinkEnrichmentJob.due.ascending,
+                                    limit=1):
+            delay = job.due.asPOSIXTimestamp() - now.asPOSIXTimestamp()
+            self._delayedCall = self.clock.callLater(delay, self.pump)
+
+
+    def _run(self, job):
+        storeID = job.storeID
+        self._running.add(storeID)
+        entry = job.entry
+
+        def done(ignored):
+            self._running.discard(storeID)
+            self.pump()
+
+        return getPageCache(self.store).fetch(entry.url, entry.channel
+            ).addCallbacks(self._succeeded, self._failed,
+                           callbackArgs=(storeID,), errbackArgs=(storeID,)
+            ).addErrback(log.err
+            ).addCallback(done)
+
+
+    def _succeeded(self, (title, metadata), storeID):
+        job = self.store.getItemByID(storeID, default=None)
+        if job is None:
+            # The entry was deleted in the meantime.
+            return
+
+        entry = job.entry
+        changed = title is not None and title != entry.title
+        if changed:
+            entry.setTitle(title)
+        if metadata:
+            entry.updateMetadata(metadata)
+        manager = job.manager
+        if changed and manager is not None:
+            announcer = self.announcers.get(
+                (manager.serviceID, manager.channel))
+            if announcer is not None:
+                announcer(entry)
+        job.deleteFromStore()
+
+
+    def _failed(self, f, storeID):
+        job = self.store.getItemByID(storeID, default=None)
+        if job is None:
+            return
+
+        job.tries += 1
+        if job.tries >= self.maxTries:
+            log.msg('Giving up on enriching %r after %d tries:' % (
+                job.entry, job.tries))
+            log.err(f)
+            job.deleteFromStore()
+        else:
+            delay = self.initialDelay * self.factor ** (job.tries - 1)
+            job.due = Time.fromPOSIXTimestamp(self.clock.seconds() + delay)
+
+
+
+_enrichers = WeakKeyDictionary()
+
+def getLinkEnricher(store):
+    """
+    Get the L{LinkEnricher} for C{store}, creating it if need be.
+    """
+    enricher = _enrichers.get(store)
+    if enricher is None:
+        enricher = _enrichers[store] = LinkEnricher(store)
+    return enricher
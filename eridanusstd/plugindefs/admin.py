@@ -165,6 +165,31 @@ class Admin(Item, Plugin):
             msg = u'No broken plugins'
         source.reply(msg)
 
+    @usage(u'outbound')
+    def cmd_outbound(self, source):
+        """
+        Show outbound message queue statistics.
+        """
+        metrics = source.protocol.scheduler.getMetrics()
+        source.reply(
+            u'%(queued)d queued, %(sent)d sent, %(merged)d merged; '
+            u'waited %(meanWait).1fs on average, %(maxWait).1fs at most.' % (
+                metrics))
+
+    @usage(u'refreshplugins')
+    def cmd_refreshplugins(self, source):
+        """
+        Discover available plugins again.
+
+        Plugins are only discovered once, when the bot starts, this picks up
+        any plugins that have been added since, as well as plugins installed
+        with axiomatic while the bot is running.  Plugins that have not been
+        loaded yet are not known to be broken, see "brokenplugins".
+        """
+        registry = source.protocol.refreshPlugins()
+        source.reply(u'Found %d plugins, %d known to be broken.' % (
+            len(registry.plugins), len(registry.knownBrokenPlugins)))
+
     @usage(u'diagnose <pluginName>')
     def cmd_diagnose(self, source, pluginName):
         """
@@ -64,7 +64,8 @@ class FeedUpdates(Item, Plugin, AmbientEventObserver):
         for item in items:
             text = self.formatEntry(
                 self.formatting[sub.formatting], item.entry)
-            sub.source.notice(u'\002%s\002: %s' % (sub.id, text))
+            sub.source.notice(
+                u'\002%s\002: %s' % (sub.id, text), ambient=True)
 
 
     def getSubscriptions(self, subscriber):
@@ -1,7 +1,6 @@
 from zope.interface import classProvides
 
 from twisted.python.filepath import FilePath
-from twisted.internet.defer import gatherResults
 from twisted.plugin import IPlugin
 
 from epsilon.extime import Time
@@ -12,10 +11,12 @@ from axiom.scripts import axiomatic
 
 from eridanus import util
 from eridanus.ieridanus import IEridanusPluginProvider, IAmbientEventObserver
-from eridanus.plugin import AmbientEventObserver, Plugin, usage, alias, rest
+from eridanus.plugin import (AmbientEventObserver, Plugin, usage, alias, rest,
+    contextual)
 from eridanus.bot import IRCBotService, IRCBotConfig
 
-from eridanusstd import linkdb
+from eridanusstd import charset, linkdb
+from eridanusstd.util import getParserPool
 
 
 class ImportExportFile(object):
@@ -129,7 +130,7 @@ class ImportExportFile(object):
         self.writeline('entrymanager')
         self.writeItem(entryManager, self.entryManagerAttrs)
 
-        for entry in entryManager.getEntries(discarded=None, deleted=None):
+        for entry in entryManager.getEntries(discarded=None, deleted=None, prefetch=True):
             self.writeEntry(entry)
 
     def readEntryManager(self):
@@ -144,8 +145,8 @@ class ImportExportFile(object):
         for comment in entry.getComments():
             self.writeComment(comment)
 
-        for metadata in entry._getMetadata():
-            self.writeMetadata(metadata)
+        for kind, data in sorted(entry.getMetadata().iteritems()):
+            self.writeMetadata(kind, data)
 
     def readEntry(self):
         return self.readItem(linkdb.LinkEntry, self.entryAttrs)
@@ -161,9 +162,10 @@ class ImportExportFile(object):
 
     metadataAttrs = ['kind', 'data']
 
-    def writeMetadata(self, metadata):
+    def writeMetadata(self, kind, data):
         self.writeline('metadata')
-        self.writeItem(metadata, self.metadataAttrs)
+        self.writeText(kind)
+        self.writeText(data)
 
     def readMetadata(self):
         return self.readItem(linkdb.LinkEntryMetadata, self.metadataAttrs)
@@ -228,6 +230,8 @@ class ImportEntries(axiomatic.AxiomaticSubCommand):
             appStore.query(linkdb.LinkEntryMetadata).deleteFromStore()
             appStore.query(linkdb.LinkEntry).deleteFromStore()
             appStore.query(linkdb.LinkManager).deleteFromStore()
+            appStore.query(linkdb.LinkChannelContributor).deleteFromStore()
+            appStore.query(linkdb.LinkChannelStats).deleteFromStore()
 
         mode = None
         service = None
@@ -276,7 +280,7 @@ class ImportEntries(axiomatic.AxiomaticSubCommand):
                 elif mode == 'metadata':
                     assert entry is not None
                     kw = ief.readMetadata()
-                    linkdb.LinkEntryMetadata(store=appStore, entry=entry, **kw)
+                    entry.updateMetadata({kw['kind']: kw['data']})
 
 
 class Hackery(axiomatic.AxiomaticSubCommand):
@@ -292,15 +296,15 @@ class Hackery(axiomatic.AxiomaticSubCommand):
         #installOn(scheduler, store)
 
         print 'Deleting old indexers...'
-        store.query(SQLiteIndexer).deleteFromStore()
-        print 'Creating new indexer...'
-        indexer = SQLiteIndexer(store=store)
-        store.powerUp(indexer, IFulltextIndexer)
-
-        entrySource = store.findOrCreate(linkdb.LinkEntrySource)
-        indexer.addSource(entrySource)
-        commentSource = store.findOrCreate(linkdb.LinkEntryCommentSource)
-        indexer.addSource(commentSource)
+        for indexer in store.query(SQLiteIndexer):
+            store.powerDown(indexer, IFulltextIndexer)
+            for source in indexer.getSources():
+                source.removeReliableListener(indexer)
+            indexer.deleteFromStore()
+        print 'Reindexing entries...'
+        index = linkdb.getLinkEntryIndex(store)
+        index.rebuild()
+        print 'Indexed %d entries.' % (index.indexCount,)
 
 
 class _LinkDBHelperMixin(object):
@@ -348,13 +352,94 @@ class LinkDBAdmin(Item, Plugin, _LinkDBHelperMixin):
         # XXX: mmm...
         return source.protocol.appStore
 
+    @usage(u'fetches')
+    def cmd_fetches(self, source):
+        """
+        Show the number of page fetches queued and in flight.
+        """
+        pool = linkdb.getFetchPool()
+        source.reply(u'%d queued, %d in flight: %s' % (
+            pool.queued,
+            pool.inFlight,
+            u', '.join(u'%s (%d)' % (host, count)
+                       for host, count in sorted(pool.inFlightByHost.items()))
+            or u'none'))
+
+    @usage(u'pagecache [ttl [size]]')
+    def cmd_pagecache(self, source, ttl=None, size=None):
+        """
+        Show page cache statistics, optionally setting the number of seconds
+        cached pages are fresh for and the maximum number of cached pages.
+        """
+        pageCache = linkdb.getPageCache(self.getLinkStore(source))
+        if ttl is not None:
+            pageCache.ttl = int(ttl)
+        if size is not None:
+            pageCache.maxEntries = int(size)
+            pageCache.prune()
+        source.reply(
+            u'%d pages cached (at most %d, fresh for %d seconds): '
+            u'%d hits, %d revalidated, %d fetched.' % (
+                pageCache.store.count(linkdb.PageCacheEntry),
+                pageCache.maxEntries,
+                pageCache.ttl,
+                pageCache.hits,
+                pageCache.revalidated,
+                pageCache.fetched))
+
+    @usage(u'charsets')
+    def cmd_charsets(self, source):
+        """
+        Show how many page encodings were detected by each means.
+        """
+        counts = charset.getEncodingDetector().counts
+        source.reply(u', '.join(
+            u'%s: %d' % (stage, counts[stage])
+            for stage in ['bom', 'contentType', 'meta', 'utf8', 'chardet',
+                          'unknown']))
+
+    @usage(u'parsers [size]')
+    def cmd_parsers(self, source, size=None):
+        """
+        Show the state of the HTML parser pool, optionally changing the
+        number of parser threads.
+        """
+        pool = getParserPool()
+        if size is not None:
+            pool.resize(int(size))
+        source.reply(
+            u'%d threads, %d jobs pending (at most %d), '
+            u'%d rejected, %d timed out.' % (
+                pool.size,
+                pool.pending,
+                pool.size + pool.maxQueued,
+                pool.rejected,
+                pool.timedOut))
+
+    @usage(u'rebuildstats [channel]')
+    def cmd_rebuildstats(self, source, channel=None):
+        """
+        Recount the statistics for <channel>, or the current channel, from
+        scratch.
+        """
+        if channel is None:
+            channel = source.channel
+        stats = linkdb.getChannelStats(self.getLinkStore(source), channel)
+        stats.rebuild()
+        source.reply(u'Rebuilt statistics for %s: %d entries, %d comments '
+                     u'and %d contributors.' % (
+                         channel,
+                         stats.entries,
+                         stats.comments,
+                         stats.contributors))
+
     @usage(u'discard <entryID>')
     def cmd_discard(self, source, entryID):
         """
         Discards entry <entryID>.
         """
         entry = self.getEntryByID(source, entryID)
-        entry.isDiscarded = True
+        entry.setDiscarded(True)
         source.reply(u'Discarded entry %s.' % (entry.canonical,))
 
     @usage(u'undiscard <entryID>')
@@ -363,7 +448,7 @@ class LinkDBAdmin(Item, Plugin, _LinkDBHelperMixin):
         Undiscard <entryID>.
         """
         entry = self.getEntryByID(source, entryID)
-        entry.isDiscarded = False
+        entry.setDiscarded(False)
         source.reply(u'Undiscarded entry %s.' % (entry.canonical,))
 
     @usage(u'delete <entryID>')
@@ -372,7 +457,7 @@ class LinkDBAdmin(Item, Plugin, _LinkDBHelperMixin):
         Deletes entry <entryID>.
         """
         entry = self.getEntryByID(source, entryID)
-        entry.isDeleted = True
+        entry.setDeleted(True)
         source.reply(u'Deleted entry %s.' % (entry.canonical,))
 
     @usage(u'undelete <entryID>')
@@ -381,7 +466,7 @@ class LinkDBAdmin(Item, Plugin, _LinkDBHelperMixin):
         Undelete <entryID>.
         """
         entry = self.getEntryByID(source, entryID, evenDeleted=True)
-        entry.isDeleted = False
+        entry.setDeleted(False)
         source.reply(u'Undeleted entry %s.' % (entry.canonical,))
 
 
@@ -433,7 +518,7 @@ class LinkDB(Item, Plugin, AmbientEventObserver, _LinkDBHelperMixin):
         Update C{entry}.
         """
         if title is not None:
-            entry.title = title
+            entry.setTitle(title)
 
         if comment:
             c = entry.addComment(source.user.nickname, comment)
@@ -454,36 +539,49 @@ class LinkDB(Item, Plugin, AmbientEventObserver, _LinkDBHelperMixin):
         return None, {}
 
 
-    def snarfURLs(self, source, text):
+    def getLinkEnricher(self, source):
         """
-        Extract URLs and create or update entries from C{text}.
+        Get the L{eridanusstd.linkdb.LinkEnricher} for C{source}, making sure
+        it can announce entries through C{source}'s link manager.
         """
-        def entryCreated(entry):
-            source.notice(entry.humanReadable)
+        enricher = linkdb.getLinkEnricher(self.getLinkStore(source))
+        if source.channel is not None:
+            protocol = source.protocol
+            channel = util.encode(source.channel)
+            enricher.announcers[protocol.serviceID, source.channel] = (
+                lambda entry: protocol.notice(
+                    channel, util.encode(entry.humanReadable), ambient=True))
+        return enricher
 
-        def entryUpdated((entry, comment)):
-            source.notice(entry.humanReadable)
-            if comment is not None:
-                source.notice(comment.humanReadable)
 
-        def fetch():
-            lm = self.getLinkManager(source)
+    def snarfURLs(self, source, urls):
+        """
+        Create or update entries for C{urls}.
 
-            for url, comment in linkdb.extractURLs(text):
-                entry = lm.entryByURL(url)
+        Entries are announced immediately, their titles and metadata are
+        fetched later by a L{eridanusstd.linkdb.LinkEnricher}, which announces
+        them again if their titles change.
 
-                # XXX: doesn't this mean we have to fetch in serial?
-                d = linkdb.fetchPageData(url).addErrback(self.fetchFailed, source, url)
-                if entry is None:
-                    d.addCallback(self.createEntry, source, url, comment
-                        ).addCallback(entryCreated)
-                else:
-                    d.addCallback(self.updateEntry, source, entry, comment
-                        ).addCallback(entryUpdated)
+        @type urls: C{iterable} of C{(unicode, unicode)}
+        @param urls: C{(url, comment)} pairs, as produced by
+            L{eridanusstd.linkdb.extractURLs}
+        """
+        lm = self.getLinkManager(source)
+        enricher = self.getLinkEnricher(source)
 
-                yield d
+        for url, comment in urls:
+            entry = lm.entryByURL(url)
+            if entry is None:
+                entry = self.createEntry((None, None), source, url, comment)
+                source.notice(entry.humanReadable, ambient=True)
+            else:
+                entry, c = self.updateEntry(
+                    (None, None), source, entry, comment)
+                source.notice(entry.humanReadable, ambient=True)
+                if c is not None:
+                    source.notice(c.humanReadable, ambient=True)
 
-        return gatherResults(list(fetch()))
+            enricher.enqueue(entry, lm)
 
 
     @usage(u'get <entryID>')
@@ -500,20 +598,28 @@ class LinkDB(Item, Plugin, AmbientEventObserver, _LinkDBHelperMixin):
         Search C{linkManager} for entries that match C{term}, up to a maximum
         of C{limit}.
         """
-        def processResults(entries):
-            entries = list(entries)
-            if not entries:
+        def processResults(results):
+            list(linkdb.prefetchEntries(r.entry for r in results))
+            if not results:
                 yield u'No results found for: %s' % (term,)
-            elif len(entries) <= 3:
-                for e in entries:
-                    yield e.completeHumanReadable
+            elif len(results) <= 3:
+                for r in results:
+                    if r.snippet is None:
+                        yield r.entry.completeHumanReadable
+                    else:
+                        yield u'%s Matched: %s' % (r.entry.completeHumanReadable, r.snippet)
             else:
-                msg = u'%d results. ' % (len(entries,))
-                msg += u'  '.join([u'\002#%d\002: \037%s\037' % (e.eid, util.truncate(e.displayTitle, 30)) for e in entries])
+                def describe(r):
+                    if r.snippet is None:
+                        return u'\037%s\037' % (util.truncate(r.entry.displayTitle, 30),)
+                    return r.snippet
+
+                msg = u'%d results. ' % (len(results,))
+                msg += u'  '.join([u'\002#%d\002: %s' % (r.entry.eid, describe(r)) for r in results])
                 yield msg
 
         # XXX: don't hardcode the limit
-        return linkManager.search(term, limit=limit
+        return linkManager.query(term, limit=limit
             ).addCallback(processResults)
 
 
@@ -523,7 +629,12 @@ class LinkDB(Item, Plugin, AmbientEventObserver, _LinkDBHelperMixin):
         """
         Search for entries whose title, URL or comment match <term>.
 
-        This search assumes the channel where the command was invoked, it can
+        Every word in <term> must match, "double quotes" match a phrase and a
+        trailing * matches a prefix.  Results can be filtered with
+        "nick:<nickname>", "site:<domain>", "after:<time>", "before:<time>",
+        "has:comment", "has:title" and "type:<type>", where <time> is a date
+        (YYYY, YYYY-MM or YYYY-MM-DD) or an age (e.g. 3d, 2w, 1m or 1y).  This
+        search assumes the channel where the command was invoked, it can
         also not be used in private.  See the "findfor" command.
         """
         self.cmd_findfor(source, source.channel, term)
@@ -546,6 +657,21 @@ class LinkDB(Item, Plugin, AmbientEventObserver, _LinkDBHelperMixin):
             ).addCallback(gotResults)
 
 
+    @rest
+    @usage(u'explain <term>')
+    def cmd_explain(self, source, term):
+        """
+        Show how the database will perform a "find" for <term>, including the
+        indexes it will use.
+        """
+        lm = self.getLinkManager(source)
+        steps = lm.explain(term)
+        if not steps:
+            source.reply(u'Nothing to search for.')
+        else:
+            source.reply(u'; '.join(steps))
+
+
     @usage(u'stats')
     def cmd_stats(self, source):
         """
@@ -568,7 +694,7 @@ class LinkDB(Item, Plugin, AmbientEventObserver, _LinkDBHelperMixin):
         """
         entry = self.getEntryByID(source, entryID)
         if entry.nick == source.user.nickname:
-            entry.isDiscarded = True
+            entry.setDiscarded(True)
             msg = u'Discarded entry %s.' % (entry.canonical,)
         else:
             msg = u'You did not post this entry, ask %s to discard it.' % (entry.nick,)
@@ -587,7 +713,7 @@ class LinkDB(Item, Plugin, AmbientEventObserver, _LinkDBHelperMixin):
         """
         entry = self.getEntryByID(source, entryID)
         if entry.nick == source.user.nickname:
-            entry.isDeleted = True
+            entry.setDeleted(True)
             msg = u'Deleted entry %s.' % (entry.canonical,)
         else:
             msg = u'You did not post this entry, ask %s to delete it.' % (entry.nick,)
@@ -604,7 +730,8 @@ class LinkDB(Item, Plugin, AmbientEventObserver, _LinkDBHelperMixin):
             source.notice(entry.humanReadable)
 
         entry = self.getEntryByID(source, entryID)
-        return linkdb.fetchPageData(entry.url
+        pageCache = linkdb.getPageCache(self.getLinkStore(source))
+        return pageCache.fetch(entry.url, source.channel, refresh=True
             ).addCallback(self.updateEntry, source, entry
             ).addErrback(self.fetchFailed, source, entry.url
             # XXX: it might be nice if self.fetchFailed could return the right thing for us
@@ -631,5 +758,11 @@ class LinkDB(Item, Plugin, AmbientEventObserver, _LinkDBHelperMixin):
 
     # IAmbientEventObserver
 
-    def publicMessageReceived(self, source, message):
-        return self.snarfURLs(source, message)
+    def joinedChannel(self, source):
+        # Resume any enrichment jobs left over from before a restart.
+        self.getLinkEnricher(source).pump()
+
+
+    @contextual
+    def publicMessageReceived(self, source, context):
+        return self.snarfURLs(source, context.urlsWithComments)
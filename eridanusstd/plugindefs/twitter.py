@@ -10,7 +10,7 @@ from axiom.item import Item
 
 from eridanus import iriparse
 from eridanus.ieridanus import IEridanusPluginProvider, IAmbientEventObserver
-from eridanus.plugin import Plugin, usage, rest, alias
+from eridanus.plugin import Plugin, usage, rest, alias, contextual
 from eridanus.util import truncate
 
 from eridanusstd import twitter
@@ -26,22 +26,33 @@ class Twitter(Item, Plugin):
         source.reply(u'; '.join(results))
 
 
-    def snarfStatusIDs(self, text):
+    def statusIDsFromURLs(self, urls):
         """
-        Find Twitter status URLs in a line of text extract the status IDs.
+        Extract the status IDs from any Twitter status URLs in C{urls}.
+
+        @type urls: C{iterable} of C{nevow.url.URL}
         """
-        for url in iriparse.parseURLs(text):
+        for url in urls:
             id = twitter.extractStatusIDFromURL(url)
             if id is not None:
                 yield id
 
 
-    def snarfURLs(self, source, text):
+    def snarfStatusIDs(self, text):
+        """
+        Find Twitter status URLs in a line of text extract the status IDs.
+        """
+        return self.statusIDsFromURLs(iriparse.parseURLs(text))
+
+
+    def snarfURLs(self, source, urls):
         """
-        Find Twitter status URLs in a line of text and display information
-        about the status.
+        Find Twitter status URLs in C{urls} and display information about the
+        status.
+
+        @type urls: C{iterable} of C{nevow.url.URL}
         """
-        for id in self.snarfStatusIDs(text):
+        for id in self.statusIDsFromURLs(urls):
             d = twitter.query('statuses/show', id)
             d.addCallback(self.formatStatus)
             d.addCallback(source.notice)
@@ -154,5 +165,6 @@ class Twitter(Item, Plugin):
 
     # IAmbientEventObserver
 
-    def publicMessageReceived(self, source, text):
-        return gatherResults(list(self.snarfURLs(source, text)))
+    @contextual
+    def publicMessageReceived(self, source, context):
+        return gatherResults(list(self.snarfURLs(source, context.urls)))
@@ -4,7 +4,7 @@ from nevow.url import URL
 
 from eridanus import util
 from eridanusstd import errors
-from eridanusstd.util import parseHTML
+from eridanusstd.util import parseHTML, deferToParser
 
 
 
@@ -30,7 +30,7 @@ def qdbUS(quoteID):
             yield line
 
     return util.PerseverantDownloader(url).go(
-        ).addCallback(lambda (data, headers): parseHTML(data)
+        ).addCallback(lambda (data, headers): deferToParser(parseHTML, data)
         ).addErrback(handleBadQuoteID, quoteID
         ).addCallback(extractQuote)
 
@@ -51,7 +51,7 @@ def bash(quoteID):
             yield line
 
     return util.PerseverantDownloader(url).go(
-        ).addCallback(lambda (data, headers): parseHTML(data)
+        ).addCallback(lambda (data, headers): deferToParser(parseHTML, data)
         ).addErrback(handleBadQuoteID, quoteID
         ).addCallback(extractQuote)
 
@@ -0,0 +1,115 @@
+import codecs
+
+from twisted.internet.defer import maybeDeferred
+from twisted.trial import unittest
+
+from eridanusstd import charset
+
+
+
+class EncodingDetectorTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.charset.EncodingDetector}.
+    """
+    def setUp(self):
+        self.threaded = []
+        def runInThread(f, *a):
+            self.threaded.append(a)
+            return maybeDeferred(f, *a)
+        self.detector = charset.EncodingDetector(runInThread)
+
+
+    def detect(self, data, contentType=None):
+        results = []
+        self.detector.detect(data, contentType).addCallback(results.append)
+        [encoding] = results
+        return encoding
+
+
+    def assertDetected(self, stage, encoding, data, contentType=None):
+        before = dict(self.detector.counts)
+        self.assertEqual(self.detect(data, contentType), encoding)
+        before[stage] += 1
+        self.assertEqual(self.detector.counts, before)
+
+
+    def test_bom(self):
+        """
+        A byte order mark takes precedence over everything else.
+        """
+        self.assertDetected(
+            'bom', 'utf-8-sig',
+            codecs.BOM_UTF8 + '<meta charset="koi8-r">',
+            'text/html; charset=iso-8859-2')
+        self.assertDetected(
+            'bom', 'utf-16', u'<p>'.encode('utf-16'), 'text/html')
+
+
+    def test_contentType(self):
+        """
+        The C{charset} parameter of the C{Content-Type} header takes
+        precedence over the page itself.
+        """
+        self.assertDetected(
+            'contentType', 'iso8859-2',
+            '<meta charset="koi8-r">', u'text/html; charset="ISO-8859-2"')
+
+
+    def test_unknownContentType(self):
+        """
+        Unknown encodings in the C{Content-Type} header are ignored.
+        """
+        self.assertDetected(
+            'meta', 'koi8-r',
+            '<meta charset="koi8-r">', 'text/html; charset=bogus')
+
+
+    def test_meta(self):
+        """
+        Encodings declared by C{meta} elements, in either form, are detected
+        within the first kilobyte of the page, except in comments.
+        """
+        self.assertDetected(
+            'meta', 'koi8-r',
+            '<html><head><META Charset=koi8-r>')
+        self.assertDetected(
+            'meta', 'shift_jis',
+            '<!-- <meta charset="koi8-r"> -->'
+            '<meta http-equiv="Content-Type" '
+            'content="text/html; charset=Shift_JIS">')
+        self.assertDetected(
+            'utf8', 'utf-8',
+            ' ' * 1024 + '<meta charset="koi8-r">')
+
+
+    def test_metaOverrides(self):
+        """
+        Pages declaring UTF-16 in a C{meta} element are UTF-8, and pages
+        declaring Latin-1 are Windows-1252.
+        """
+        self.assertDetected('meta', 'utf-8', '<meta charset="utf-16le">')
+        self.assertDetected('meta', 'cp1252', '<meta charset="iso-8859-1">')
+
+
+    def test_utf8(self):
+        """
+        Valid UTF-8 is detected, even if it was cut short in the middle of a
+        character.
+        """
+        data = u'<title>\N{SNOWMAN}</title>'.encode('utf-8')
+        self.assertDetected('utf8', 'utf-8', data)
+        self.assertDetected('utf8', 'utf-8', data[:8])
+        self.assertEqual(self.threaded, [])
+
+
+    def test_chardet(self):
+        """
+        C{chardet} is run, in a thread, on a bounded sample of pages whose
+        encoding was not otherwise detected.
+        """
+        self.detector.sampleBytes = 100
+        data = u'<title>\N{CYRILLIC CAPITAL LETTER ZHE}</title>'.encode(
+            'koi8-r') * 20
+        self.detect(data)
+        self.assertEqual(self.threaded, [(data[:100],)])
+        self.assertEqual(self.detector.counts['chardet'], 1)
@@ -1,7 +1,8 @@
 from twisted.trial.unittest import TestCase
 
 from eridanus.ieridanus import ICommand
-from eridanus.plugin import getAllPlugins
+from eridanus.plugin import LazyPlugin, getAllPlugins, loadPlugin
+from eridanus.plugins import std
 
 
 
@@ -15,6 +16,25 @@ class CommandTests(TestCase):
         to find broken commands.
         """
         for plg in getAllPlugins():
+            plg = loadPlugin(plg)
+            if plg is None:
+                # Broken plugins have no commands to check.
+                continue
             parent = ICommand(plg())
             for cmd in parent.getCommands():
                 pass
+
+
+    def test_lazyPluginNames(self):
+        """
+        The command names declared for the lazily imported standard plugins
+        match the names of the plugin classes they stand in for.
+        """
+        for lazy in vars(std).values():
+            if not isinstance(lazy, LazyPlugin):
+                continue
+            plg = lazy.load()
+            if plg is None:
+                continue
+            self.assertEquals(
+                (lazy.pluginpath, lazy.name), (lazy.pluginpath, plg.name))
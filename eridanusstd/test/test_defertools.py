@@ -0,0 +1,255 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from eridanusstd import defertools, errors
+
+
+
+class JobPoolTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.defertools.JobPool}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = defertools.JobPool(
+            maxConcurrent=2, maxPerHost=1, deadline=10, clock=self.clock)
+        self.started = []
+
+
+    def job(self, name):
+        """
+        A job that records that it started and only completes when its
+        Deferred is fired.
+        """
+        d = Deferred()
+        self.started.append((name, d))
+        return d
+
+
+    def submit(self, queue, host, name):
+        results = []
+        self.pool.submit(queue, host, self.job, name).addBoth(results.append)
+        return results
+
+
+    def finish(self, name):
+        for n, d in self.started:
+            if n == name:
+                d.callback(name)
+
+
+    def test_concurrencyLimits(self):
+        """
+        No more than C{maxConcurrent} jobs run at once, and no more than
+        C{maxPerHost} for a single host.  Queued jobs start as running jobs
+        complete.
+        """
+        a1 = self.submit('#a', 'a.com', 'a1')
+        self.submit('#a', 'a.com', 'a2')
+        self.submit('#a', 'b.com', 'b1')
+        self.submit('#a', 'c.com', 'c1')
+        self.assertEqual([n for n, d in self.started], ['a1', 'b1'])
+        self.assertEqual(self.pool.inFlight, 2)
+        self.assertEqual(self.pool.queued, 2)
+        self.assertEqual(self.pool.inFlightByHost, {'a.com': 1, 'b.com': 1})
+
+        self.finish('a1')
+        self.assertEqual(a1, ['a1'])
+        self.assertEqual([n for n, d in self.started], ['a1', 'b1', 'a2'])
+        self.finish('b1')
+        self.assertEqual(
+            [n for n, d in self.started], ['a1', 'b1', 'a2', 'c1'])
+        self.assertEqual(self.pool.queued, 0)
+
+
+    def test_fairness(self):
+        """
+        Queues take turns starting jobs.
+        """
+        self.pool.maxConcurrent = 1
+        self.pool.maxPerHost = 1
+        for i in xrange(3):
+            self.submit('#a', 'a%d' % (i,), 'a%d' % (i,))
+        self.submit('#b', 'b', 'b')
+        for name in ['a0', 'a1', 'b', 'a2']:
+            self.finish(name)
+        self.assertEqual(
+            [n for n, d in self.started], ['a0', 'a1', 'b', 'a2'])
+
+
+    def test_deadline(self):
+        """
+        Jobs that do not complete before their deadline, whether queued or
+        running, fail with L{errors.DeadlineExceeded}.  Running jobs are
+        cancelled.
+        """
+        self.pool.deadline = 20
+        running = self.submit('#a', 'a.com', 'a1')
+        self.pool.deadline = 10
+        queued = self.submit('#b', 'a.com', 'a2')
+        self.clock.advance(10)
+        queued[0].trap(errors.DeadlineExceeded)
+        self.assertEqual(self.pool.queued, 0)
+        self.assertEqual(self.pool.inFlight, 1)
+
+        self.clock.advance(10)
+        running[0].trap(errors.DeadlineExceeded)
+        self.assertEqual(self.pool.inFlight, 0)
+        self.assertEqual(self.pool.inFlightByHost, {})
+        self.assertEqual([n for n, d in self.started], ['a1'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_failure(self):
+        """
+        Failures are passed on to the submitter, and free the job's slot.
+        """
+        results = []
+        self.pool.submit('#a', 'a.com', lambda: 1 / 0).addErrback(
+            results.append)
+        results[0].trap(ZeroDivisionError)
+        self.assertEqual(self.pool.inFlight, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class SingleFlightTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.defertools.SingleFlight}.
+    """
+    def setUp(self):
+        self.calls = []
+        self.singleFlight = defertools.SingleFlight(list)
+
+
+    def call(self, key):
+        d = Deferred()
+        self.calls.append((key, d))
+        return d
+
+
+    def test_coalesce(self):
+        """
+        Calls for a key that is in flight wait for the in-flight call, and
+        receive a copy of its result.
+        """
+        results = []
+        for i in xrange(2):
+            self.singleFlight.call('a', self.call, 'a').addCallback(
+                results.append)
+        self.singleFlight.call('b', self.call, 'b')
+        self.assertIn('a', self.singleFlight)
+        self.assertEqual([key for key, d in self.calls], ['a', 'b'])
+
+        self.calls[0][1].callback([1, 2])
+        self.assertEqual(results, [[1, 2], [1, 2]])
+        self.assertNotIdentical(results[0], results[1])
+        self.assertNotIn('a', self.singleFlight)
+
+        self.singleFlight.call('a', self.call, 'a')
+        self.assertEqual([key for key, d in self.calls], ['a', 'b', 'a'])
+
+
+    def test_synchronous(self):
+        """
+        Calls that complete synchronously, successfully or not, are not left
+        in flight.
+        """
+        results = []
+        self.singleFlight.call('a', lambda: [1]).addCallback(results.append)
+        self.singleFlight.call('a', lambda: 1 / 0).addErrback(results.append)
+        self.assertEqual(results[0], [1])
+        results[1].trap(ZeroDivisionError)
+        self.assertNotIn('a', self.singleFlight)
+
+
+
+class WorkerPoolTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.defertools.WorkerPool}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = defertools.WorkerPool(
+            size=1, maxQueued=1, timeLimit=10, clock=self.clock)
+        self.running = []
+        def runInThread(f, *a, **kw):
+            d = Deferred()
+            self.running.append((f, a, kw, d))
+            return d
+        self.pool._runInThread = runInThread
+
+
+    def test_run(self):
+        """
+        Jobs are run in a thread and their results delivered.
+        """
+        results = []
+        self.pool.run(len, 'abc', key='value').addCallback(results.append)
+        [(f, a, kw, d)] = self.running
+        self.assertEqual((f, a, kw), (len, ('abc',), {'key': 'value'}))
+        self.assertEqual(self.pool.pending, 1)
+        d.callback(3)
+        self.assertEqual(results, [3])
+        self.assertEqual(self.pool.pending, 0)
+        self.assertFalse(self.clock.getDelayedCalls())
+
+
+    def test_failure(self):
+        """
+        Jobs that raise fail with the exception.
+        """
+        failures = []
+        self.pool.run(len, 'abc').addErrback(failures.append)
+        self.running[0][-1].errback(ZeroDivisionError())
+        [f] = failures
+        f.trap(ZeroDivisionError)
+
+
+    def test_full(self):
+        """
+        Once C{size} jobs are running and C{maxQueued} are waiting, further
+        jobs are rejected until one completes.
+        """
+        self.pool.run(len, 'a')
+        self.pool.run(len, 'b')
+        failures = []
+        self.pool.run(len, 'c').addErrback(failures.append)
+        [f] = failures
+        f.trap(errors.WorkerPoolFull)
+        self.assertEqual(len(self.running), 2)
+        self.assertEqual(self.pool.rejected, 1)
+
+        self.running[0][-1].callback(1)
+        self.pool.run(len, 'c')
+        self.assertEqual(len(self.running), 3)
+
+
+    def test_timeLimit(self):
+        """
+        Jobs that take too long fail with L{errors.DeadlineExceeded}, but
+        remain pending until their thread is done with them.
+        """
+        failures = []
+        self.pool.run(len, 'abc').addErrback(failures.append)
+        self.clock.advance(10)
+        [f] = failures
+        f.trap(errors.DeadlineExceeded)
+        self.assertEqual(self.pool.timedOut, 1)
+        self.assertEqual(self.pool.pending, 1)
+
+        self.running[0][-1].callback(3)
+        self.assertEqual(self.pool.pending, 0)
+
+
+    def test_thread(self):
+        """
+        By default, jobs are run in threads other than the reactor thread.
+        """
+        import thread
+        pool = defertools.WorkerPool()
+        self.addCleanup(pool.stop)
+        mainThread = thread.get_ident()
+        return pool.run(thread.get_ident
+            ).addCallback(self.assertNotEqual, mainThread)
@@ -34,7 +34,7 @@ class MockSource(record('channel')):
         self.calls = {}
 
 
-    def notice(self, msg):
+    def notice(self, msg, ambient=False):
         self.calls['notice'] = self.calls.setdefault('notice', 0) + 1
 
 
@@ -0,0 +1,108 @@
+import struct
+
+from twisted.trial import unittest
+
+from eridanusstd import imagesize
+
+
+
+class GetDimensionsTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.imagesize.getDimensions}.
+    """
+    def test_png(self):
+        data = ('\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR' +
+                struct.pack('>II', 317, 123))
+        self.assertEqual(imagesize.getDimensions(data), (317, 123))
+
+
+    def test_gif(self):
+        for version in ['GIF87a', 'GIF89a']:
+            data = version + struct.pack('<HH', 317, 123)
+            self.assertEqual(imagesize.getDimensions(data), (317, 123))
+
+
+    def test_jpeg(self):
+        """
+        JPEG dimensions are found in the start of frame segment, skipping any
+        segments before it.
+        """
+        app1 = '\xff\xe1' + struct.pack('>H', 1002) + 'x' * 1000
+        sof2 = '\xff\xc2\x00\x11\x08' + struct.pack('>HH', 123, 317)
+        data = '\xff\xd8' + app1 + '\xff' + sof2
+        self.assertEqual(imagesize.getDimensions(data), (317, 123))
+        self.assertIdentical(imagesize.getDimensions(data[:500]), None)
+
+
+    def test_webpLossy(self):
+        data = ('RIFF\x00\x00\x00\x00WEBPVP8 \x00\x00\x00\x00'
+                '\x00\x00\x00\x9d\x01\x2a' + struct.pack('<HH', 317, 123))
+        self.assertEqual(imagesize.getDimensions(data), (317, 123))
+
+
+    def test_webpLossless(self):
+        bits = (317 - 1) | ((123 - 1) << 14)
+        data = ('RIFF\x00\x00\x00\x00WEBPVP8L\x00\x00\x00\x00\x2f' +
+                struct.pack('<I', bits))
+        self.assertEqual(imagesize.getDimensions(data), (317, 123))
+
+
+    def test_webpExtended(self):
+        data = ('RIFF\x00\x00\x00\x00WEBPVP8X\x00\x00\x00\x00'
+                '\x00\x00\x00\x00' +
+                struct.pack('<I', 317 - 1)[:3] +
+                struct.pack('<I', 123 - 1)[:3])
+        self.assertEqual(imagesize.getDimensions(data), (317, 123))
+
+
+    def test_bmp(self):
+        """
+        Both Windows and OS/2 bitmap headers are supported, top-down bitmaps
+        have a negative height.
+        """
+        data = 'BM' + '\x00' * 12 + struct.pack('<Iii', 40, 317, -123)
+        self.assertEqual(imagesize.getDimensions(data), (317, 123))
+        data = 'BM' + '\x00' * 12 + struct.pack('<IHH', 12, 317, 123)
+        self.assertEqual(imagesize.getDimensions(data + '\x00' * 4),
+                         (317, 123))
+
+
+    def test_svg(self):
+        """
+        SVG dimensions come from the C{width} and C{height} attributes of the
+        root element, or its C{viewBox} attribute.
+        """
+        self.assertEqual(
+            imagesize.getDimensions(
+                '<?xml version="1.0"?>\n'
+                '<svg xmlns="http://www.w3.org/2000/svg" stroke-width="2" '
+                'width="317px" height="123">'),
+            (317, 123))
+        self.assertEqual(
+            imagesize.getDimensions(
+                '<svg width="100%" viewBox="0 0 317 123.2">'),
+            (317, 123))
+
+
+    def test_buffer(self):
+        """
+        Dimensions can be determined from a C{buffer}, such as one over a
+        C{bytearray} that the image is being received into.
+        """
+        app1 = '\xff\xe1' + struct.pack('>H', 1002) + 'x' * 1000
+        sof0 = '\xff\xc0\x00\x11\x08' + struct.pack('>HH', 123, 317)
+        for data in ['\xff\xd8' + app1 + sof0,
+                     '\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR' +
+                     struct.pack('>II', 317, 123),
+                     'BM' + '\x00' * 12 + struct.pack('<Iii', 40, 317, 123),
+                     '<svg width="317" height="123">']:
+            self.assertEqual(
+                imagesize.getDimensions(buffer(bytearray(data))), (317, 123))
+
+
+    def test_unknown(self):
+        """
+        Unrecognised or truncated data has no known dimensions.
+        """
+        for data in ['', 'boo', '\x89PNG\r\n\x1a\n', 'GIF89a\x01']:
+            self.assertIdentical(imagesize.getDimensions(data), None)
@@ -1,10 +1,19 @@
+import datetime, struct
+
 from StringIO import StringIO
 
+from epsilon.extime import Time
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
 from twisted.trial import unittest
 from twisted.python.filepath import FilePath
+from twisted.web.http_headers import Headers
 
-from eridanus import util
-from eridanusstd import linkdb
+from axiom.store import Store
+
+from eridanus import const, util
+from eridanusstd import defertools, errors, linkdb
 
 
 
@@ -35,37 +44,45 @@ class MetadataExtractionTests(unittest.TestCase):
 
     def test_extractImageMetadata(self):
         """
-        When the Python Imaging Library is available, image metadata is
-        extracted from a valid image stream.
+        Image dimensions are extracted from the image header.
         """
-        if linkdb.PIL is None:
-            raise unittest.SkipTest('PIL is not available')
-
-        info = dict(linkdb._extractImageMetadata(self.pngStream))
+        info = dict(linkdb._extractImageMetadata(self.pngStream.read(64)))
         self.assertEquals({
             u'dimensions': u'256x256'}, info)
 
 
     def test_extractBogusImageMetadata(self):
         """
-        Attempting to extract metadata from a bogus image stream results in no
+        Attempting to extract metadata from a bogus image results in no
         metadata being extracted.
         """
-        if linkdb.PIL is None:
-            raise unittest.SkipTest('PIL is not available')
-
-        info = dict(linkdb._extractImageMetadata(StringIO('boo')))
+        info = dict(linkdb._extractImageMetadata('boo'))
         self.assertEquals({}, info)
 
 
     def test_noPIL(self):
         """
-        If the Python Imaging Library is missing, no image metadata is
-        extracted.
+        The Python Imaging Library is not needed to extract the metadata of
+        recognised image formats.
         """
         self.patch(linkdb, 'PIL', None)
-        info = dict(linkdb._extractImageMetadata(self.pngStream))
-        self.assertEquals({}, info)
+        info = dict(linkdb._extractImageMetadata(self.pngStream.read()))
+        self.assertEquals({
+            u'dimensions': u'256x256'}, info)
+
+
+    def test_PILFallback(self):
+        """
+        When the Python Imaging Library is available, it is used to extract
+        the metadata of image formats that are not otherwise recognised.
+        """
+        if linkdb.PIL is None:
+            raise unittest.SkipTest('PIL is not available')
+
+        self.patch(linkdb.imagesize, 'getDimensions', lambda data: None)
+        info = dict(linkdb._extractImageMetadata(self.pngStream.read()))
+        self.assertEquals({
+            u'dimensions': u'256x256'}, info)
 
 
     def test_buildMetadata(self):
@@ -120,3 +137,1238 @@ class TitleExtractionTests(unittest.TestCase):
         self.assertEquals(
             linkdb._extractTitle(data),
             u'Google')
+
+
+
+class TitleEndTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb._TitleEnd}.
+    """
+    def test_titleEnd(self):
+        """
+        The end of the title element is detected, even when split across
+        chunks.
+        """
+        titleEnd = linkdb._TitleEnd()
+        self.assertFalse(titleEnd('<html><head><title>Foo</ti'))
+        self.assertTrue(titleEnd('TLE >'))
+
+
+    def test_noTitle(self):
+        """
+        Documents without a title end are never considered complete.
+        """
+        titleEnd = linkdb._TitleEnd()
+        self.assertFalse(titleEnd('<html><head><title>Foo'))
+        self.assertFalse(titleEnd('</head><body>'))
+
+
+
+class ReadPageBodyTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb._readPageBody}.
+    """
+    def readBody(self, contentType):
+        calls = []
+        def readBody(response, maxBytes, isComplete=None):
+            calls.append((response, maxBytes, isComplete))
+        self.patch(util, 'readBody', readBody)
+        class FakeResponse(object):
+            headers = Headers()
+        response = FakeResponse()
+        if contentType is not None:
+            response.headers.setRawHeaders('content-type', [contentType])
+        linkdb._readPageBody(response)
+        [(r, maxBytes, isComplete)] = calls
+        self.assertIdentical(r, response)
+        return maxBytes, isComplete
+
+
+    def test_html(self):
+        """
+        HTML pages are read until the end of their title.
+        """
+        maxBytes, isComplete = self.readBody('text/html; charset=utf-8')
+        self.assertEqual(maxBytes, linkdb.MAX_PAGE_BYTES)
+        self.assertIsInstance(isComplete, linkdb._TitleEnd)
+
+
+    def test_image(self):
+        """
+        Images are read until their dimensions are known.
+        """
+        maxBytes, isComplete = self.readBody('image/png')
+        self.assertEqual(maxBytes, linkdb.MAX_IMAGE_BYTES)
+        self.assertIsInstance(isComplete, linkdb._ImageHeaderEnd)
+        self.assertFalse(isComplete('\x89PNG\r\n\x1a\n'))
+        self.assertTrue(isComplete(
+            '\x00\x00\x00\x0dIHDR\x00\x00\x01\x00\x00\x00\x01\x00'))
+
+
+    def test_largeImageHeader(self):
+        """
+        Image headers are accumulated across chunks until the dimensions are
+        found, even past large JPEG segments.
+        """
+        imageHeaderEnd = linkdb._ImageHeaderEnd()
+        app1 = '\xff\xe1' + struct.pack('>H', 65002) + 'x' * 65000
+        self.assertFalse(imageHeaderEnd('\xff\xd8' + app1[:4096]))
+        self.assertFalse(imageHeaderEnd(app1[4096:]))
+        self.assertTrue(imageHeaderEnd(
+            '\xff\xc0\x00\x11\x08' + struct.pack('>HH', 123, 317)))
+
+
+    def test_other(self):
+        """
+        Other content is only read as far as is needed for its metadata.
+        """
+        for contentType in ['application/zip', None]:
+            maxBytes, isComplete = self.readBody(contentType)
+            self.assertEqual(maxBytes, linkdb.MAX_HEADER_BYTES)
+            self.assertIdentical(isComplete, None)
+
+
+
+class FetchPageDataTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb.fetchPageData}.
+    """
+    def setUp(self):
+        self.submitted = []
+        test = self
+        class FakePool(object):
+            def submit(self, queue, host, f, *a):
+                d = Deferred()
+                test.submitted.append((queue, host, f, a, d))
+                return d
+        self.patch(linkdb, '_fetchPool', FakePool())
+        self.patch(linkdb, '_pageFetches',
+                   defertools.SingleFlight(linkdb._copyPage))
+
+
+    def test_fetchPool(self):
+        """
+        Page fetches are submitted to the shared fetch pool, queued by
+        channel and limited by the URL's host.
+        """
+        results = []
+        linkdb.fetchPageData(u'http://Example.COM:8080/foo', u'#chan'
+            ).addCallback(results.append)
+        [(queue, host, f, a, d)] = self.submitted
+        self.assertEqual(
+            (queue, host, f, a),
+            (u'#chan', 'example.com', linkdb._fetchPageData,
+             (u'http://Example.COM:8080/foo', None, None)))
+        d.callback((u'Title', {u'size': u'1 KB'}, None, None))
+        self.assertEqual(results, [(u'Title', {u'size': u'1 KB'})])
+
+
+    def test_coalesced(self):
+        """
+        Concurrent fetches of the same page share a single fetch, each caller
+        gets its own copy of the result.  Once the fetch completes, the page
+        is fetched again.
+        """
+        results = []
+        for url in [u'http://example.com/foo#bar', u'HTTP://EXAMPLE.com/foo']:
+            linkdb.fetchPageData(url, u'#chan').addCallback(results.append)
+        linkdb.fetchPageData(u'http://example.com/Foo', u'#chan')
+        self.assertEqual(len(self.submitted), 2)
+
+        self.submitted[0][-1].callback(
+            (u'Title', {u'size': u'1 KB'}, None, None))
+        self.assertEqual(results, [(u'Title', {u'size': u'1 KB'})] * 2)
+        self.assertNotIdentical(results[0][1], results[1][1])
+
+        linkdb.fetchPageData(u'http://example.com/foo', u'#chan')
+        self.assertEqual(len(self.submitted), 3)
+
+
+    def test_coalescedFailure(self):
+        """
+        A failed fetch fails every caller waiting for it.
+        """
+        failures = []
+        for i in xrange(2):
+            linkdb.fetchPageData(u'http://example.com/', u'#chan'
+                ).addErrback(failures.append)
+        self.submitted[0][-1].errback(RuntimeError())
+        self.assertEqual([f.type for f in failures], [RuntimeError] * 2)
+
+
+    def test_range(self):
+        """
+        The requested range covers as much of the content as is read, so
+        that image headers with large segments are received in full.
+        """
+        requests = []
+        class FakeTreq(object):
+            def get(self, url, **kw):
+                requests.append(kw['headers'])
+                return Deferred()
+        self.patch(util, 'treq', FakeTreq())
+        self.patch(linkdb, '_fetchPool', defertools.JobPool(clock=Clock()))
+        linkdb._fetchPageData(u'http://example.com/')
+        [headers] = requests
+        self.assertEqual(
+            headers.getRawHeaders('range'),
+            ['bytes=0-%d' % (linkdb.MAX_PAGE_BYTES - 1,)])
+        self.assertTrue(linkdb.MAX_PAGE_BYTES >= linkdb.MAX_IMAGE_BYTES)
+
+
+    def test_deadline(self):
+        """
+        Requests are made with a timeout no longer than the fetch pool
+        deadline, and are cancelled once the deadline passes, so that the
+        pool's limits bound the number of open connections.
+        """
+        requests = []
+        cancelled = []
+        class FakeTreq(object):
+            def get(self, url, **kw):
+                requests.append(kw['timeout'])
+                return Deferred(lambda d: cancelled.append(url))
+        self.patch(util, 'treq', FakeTreq())
+        clock = Clock()
+        pool = defertools.JobPool(deadline=10, clock=clock)
+        self.patch(linkdb, '_fetchPool', pool)
+
+        d = linkdb.fetchPageData(u'http://example.com/', u'#chan')
+        self.assertEqual(requests, [10])
+        clock.advance(10)
+        self.assertEqual(cancelled, ['http://example.com/'])
+        self.assertEqual(pool.inFlight, 0)
+        return self.assertFailure(d, errors.DeadlineExceeded)
+
+
+
+class PageCacheTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb.PageCache}.
+    """
+    def setUp(self):
+        self.submitted = []
+        test = self
+        class FakePool(object):
+            def submit(self, queue, host, f, *a):
+                d = Deferred()
+                test.submitted.append((a, d))
+                return d
+        self.patch(linkdb, '_fetchPool', FakePool())
+        self.patch(linkdb, '_pageFetches',
+                   defertools.SingleFlight(linkdb._copyPage))
+        self.store = Store()
+        self.cache = linkdb.getPageCache(self.store)
+
+
+    def fetch(self, url, **kw):
+        results = []
+        self.cache.fetch(url, u'#chan', **kw).addCallback(results.append)
+        return results
+
+
+    def age(self, url, seconds):
+        entry = self.cache.getEntry(url)
+        entry.fetchedAt = Time.fromPOSIXTimestamp(
+            entry.fetchedAt.asPOSIXTimestamp() - seconds)
+
+
+    def test_miss(self):
+        """
+        Uncached pages are fetched unconditionally and cached, along with
+        their validators.
+        """
+        results = self.fetch(u'http://example.com/foo')
+        [(a, d)] = self.submitted
+        self.assertEqual(a, (u'http://example.com/foo', None, None))
+        d.callback((u'Title', {u'size': u'1 KB'}, '"abc"', None))
+        self.assertEqual(results, [(u'Title', {u'size': u'1 KB'})])
+
+        entry = self.cache.getEntry(u'http://EXAMPLE.com/foo#bar')
+        self.assertEqual(entry.pageData, (u'Title', {u'size': u'1 KB'}))
+        self.assertEqual(entry.etag, '"abc"')
+        self.assertEqual(self.cache.fetched, 1)
+
+
+    def test_hit(self):
+        """
+        Fresh pages are served from the cache without being fetched.
+        """
+        self.fetch(u'http://example.com/')
+        self.submitted[0][1].callback((u'Title', {}, None, None))
+        results = self.fetch(u'http://example.com/')
+        self.assertEqual(results, [(u'Title', {})])
+        self.assertEqual(len(self.submitted), 1)
+        self.assertEqual(self.cache.hits, 1)
+
+
+    def test_notModified(self):
+        """
+        Stale pages are revalidated with their validators, a page that has
+        not been modified is served from the cache and made fresh again.
+        """
+        self.fetch(u'http://example.com/')
+        self.submitted[0][1].callback(
+            (u'Title', {}, '"abc"', 'Mon, 01 Jan 2001 00:00:00 GMT'))
+        self.age(u'http://example.com/', self.cache.ttl + 1)
+
+        results = self.fetch(u'http://example.com/')
+        a, d = self.submitted[1]
+        self.assertEqual(
+            a,
+            (u'http://example.com/', '"abc"', 'Mon, 01 Jan 2001 00:00:00 GMT'))
+        d.callback(None)
+        self.assertEqual(results, [(u'Title', {})])
+        self.assertEqual(self.cache.revalidated, 1)
+        self.assertTrue(
+            self.cache.getEntry(u'http://example.com/').isFresh(
+                self.cache.ttl))
+
+
+    def test_modified(self):
+        """
+        Stale pages that have been modified are replaced in the cache.
+        """
+        self.fetch(u'http://example.com/')
+        self.submitted[0][1].callback((u'Old', {}, '"abc"', None))
+        self.age(u'http://example.com/', self.cache.ttl + 1)
+
+        results = self.fetch(u'http://example.com/')
+        self.submitted[1][1].callback((u'New', {}, '"def"', None))
+        self.assertEqual(results, [(u'New', {})])
+        self.assertEqual(
+            self.cache.getEntry(u'http://example.com/').etag, '"def"')
+
+
+    def test_refresh(self):
+        """
+        Refreshing a page fetches it unconditionally, even if it is fresh.
+        """
+        self.fetch(u'http://example.com/')
+        self.submitted[0][1].callback((u'Old', {}, '"abc"', None))
+        results = self.fetch(u'http://example.com/', refresh=True)
+        [a, d] = self.submitted[1]
+        self.assertEqual(a, (u'http://example.com/', None, None))
+        d.callback((u'New', {}, None, None))
+        self.assertEqual(results, [(u'New', {})])
+
+
+    def test_prune(self):
+        """
+        The least recently used pages are removed once there are more than
+        C{maxEntries} pages cached.
+        """
+        self.cache.maxEntries = 2
+        for path in [u'a', u'b']:
+            self.fetch(u'http://example.com/' + path)
+            self.submitted[-1][1].callback((path, {}, None, None))
+        entry = self.cache.getEntry(u'http://example.com/a')
+        entry.lastUsed = Time.fromPOSIXTimestamp(
+            entry.lastUsed.asPOSIXTimestamp() + 60)
+
+        self.fetch(u'http://example.com/c')
+        self.submitted[-1][1].callback((u'c', {}, None, None))
+        self.assertEqual(
+            sorted(e.url for e in self.store.query(linkdb.PageCacheEntry)),
+            [u'http://example.com/a', u'http://example.com/c'])
+
+
+
+class DecodeTextTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb._decodeText}.
+    """
+    def test_decodeText(self):
+        """
+        Text is decoded with the detected encoding.
+        """
+        results = []
+        linkdb._decodeText(
+            u'<title>\N{SNOWMAN}</title>'.encode('utf-8'), u'text/html'
+            ).addCallback(results.append)
+        self.assertEqual(results, [u'<title>\N{SNOWMAN}</title>'])
+
+
+    def test_extractDecodedTitle(self):
+        """
+        Titles are extracted from decoded text.
+        """
+        self.assertEqual(
+            linkdb._extractTitle(
+                u'<html><head><title>\N{SNOWMAN} man</title></head></html>'),
+            u'\N{SNOWMAN} man')
+
+
+
+class LinkEnricherTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb.LinkEnricher}.
+    """
+    def setUp(self):
+        self.submitted = []
+        test = self
+        class FakePool(object):
+            def submit(self, queue, host, f, *a):
+                d = Deferred()
+                test.submitted.append((a, d))
+                return d
+        self.patch(linkdb, '_fetchPool', FakePool())
+        self.patch(linkdb, '_pageFetches',
+                   defertools.SingleFlight(linkdb._copyPage))
+        self.store = Store()
+        linkdb.LinkEntrySource(store=self.store)
+        self.clock = Clock()
+        self.enricher = linkdb.LinkEnricher(self.store, self.clock)
+        self.manager = linkdb.LinkManager(store=self.store,
+                                          serviceID='service',
+                                          channel=u'#chan')
+        self.announced = []
+        self.enricher.announcers['service', u'#chan'] = self.announced.append
+
+
+    def createEntry(self, url):
+        return linkdb.LinkEntry(store=self.store,
+                                eid=self.store.count(linkdb.LinkEntry),
+                                channel=u'#chan',
+                                nick=u'nick',
+                                url=url)
+
+
+    def jobs(self):
+        return list(self.store.query(linkdb.LinkEnrichmentJob))
+
+
+    def test_enrich(self):
+        """
+        Queued entries have their title and metadata filled in, and are
+        announced, once the page is fetched.
+        """
+        entry = self.createEntry(u'http://example.com/')
+        self.enricher.enqueue(entry, self.manager)
+        [(a, d)] = self.submitted
+        self.assertEqual(a[0], u'http://example.com/')
+        self.assertEqual(len(self.jobs()), 1)
+
+        d.callback((u'Title', {u'size': u'1 KB'}, None, None))
+        self.assertEqual(entry.title, u'Title')
+        self.assertEqual(entry.getMetadata(), {u'size': u'1 KB'})
+        self.assertEqual(self.announced, [entry])
+        self.assertEqual(self.jobs(), [])
+
+
+    def test_unchanged(self):
+        """
+        Entries are not announced if their title does not change.
+        """
+        entry = self.createEntry(u'http://example.com/')
+        entry.title = u'Title'
+        self.enricher.enqueue(entry, self.manager)
+        self.submitted[0][1].callback((u'Title', {}, None, None))
+        self.assertEqual(self.announced, [])
+
+
+    def test_announceThroughManager(self):
+        """
+        Entries are announced through the manager they were queued with, not
+        through other managers for a channel of the same name.
+        """
+        other = linkdb.LinkManager(store=self.store,
+                                   serviceID='other',
+                                   channel=u'#chan')
+        otherAnnounced = []
+        self.enricher.announcers['other', u'#chan'] = otherAnnounced.append
+        entry = self.createEntry(u'http://example.com/')
+        self.enricher.enqueue(entry, other)
+        self.submitted[0][1].callback((u'Title', {}, None, None))
+        self.assertEqual(otherAnnounced, [entry])
+        self.assertEqual(self.announced, [])
+
+
+    def test_concurrency(self):
+        """
+        At most C{maxConcurrent} jobs run at once.
+        """
+        self.enricher.maxConcurrent = 2
+        for i in xrange(3):
+            self.enricher.enqueue(
+                self.createEntry(u'http://example.com/%d' % (i,)))
+        self.assertEqual(len(self.submitted), 2)
+        self.submitted[0][1].callback((None, {}, None, None))
+        self.assertEqual(len(self.submitted), 3)
+
+
+    def test_saturated(self):
+        """
+        Queueing jobs while C{maxConcurrent} jobs are running does not query
+        the queue.
+        """
+        self.enricher.maxConcurrent = 1
+        self.enricher.enqueue(self.createEntry(u'http://example.com/0'))
+        entry = self.createEntry(u'http://example.com/1')
+        self.patch(self.store, 'query', None)
+        self.enricher.enqueue(entry)
+        self.assertEqual(len(self.submitted), 1)
+
+
+    def test_retry(self):
+        """
+        Failed jobs are retried with exponential backoff, until they have
+        been tried C{maxTries} times.
+        """
+        self.enricher.maxTries = 3
+        entry = self.createEntry(u'http://example.com/')
+        self.enricher.enqueue(entry)
+        self.submitted[-1][1].errback(RuntimeError())
+        [job] = self.jobs()
+        self.assertEqual(job.tries, 1)
+
+        self.clock.advance(self.enricher.initialDelay - 1)
+        self.assertEqual(len(self.submitted), 1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.submitted), 2)
+        self.submitted[-1][1].errback(RuntimeError())
+
+        self.clock.advance(self.enricher.initialDelay * self.enricher.factor)
+        self.assertEqual(len(self.submitted), 3)
+        self.submitted[-1][1].errback(RuntimeError())
+        self.assertEqual(self.jobs(), [])
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        self.assertFalse(self.clock.getDelayedCalls())
+
+
+    def test_resume(self):
+        """
+        Jobs left in the store, for example by a restart, are run when the
+        queue is pumped.
+        """
+        entry = self.createEntry(u'http://example.com/')
+        linkdb.LinkEnrichmentJob(store=self.store,
+                                 entry=entry,
+                                 due=Time.fromPOSIXTimestamp(0))
+        self.enricher.pump()
+        self.submitted[0][1].callback((u'Title', {}, None, None))
+        self.assertEqual(entry.title, u'Title')
+        self.assertEqual(self.jobs(), [])
+
+
+    def test_deletedEntry(self):
+        """
+        Deleting an entry deletes its pending job.
+        """
+        entry = self.createEntry(u'http://example.com/')
+        self.enricher.enqueue(entry)
+        entry.deleteFromStore()
+        self.assertEqual(self.jobs(), [])
+        self.submitted[0][1].callback((u'Title', {}, None, None))
+
+
+
+class LinkManagerTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb.LinkManager}.
+    """
+    def setUp(self):
+        self.store = Store(self.mktemp())
+        linkdb.LinkEntrySource(store=self.store)
+        linkdb.LinkEntryCommentSource(store=self.store)
+        self.manager = linkdb.LinkManager(store=self.store,
+                                          serviceID='service',
+                                          channel=u'#chan')
+
+
+    def createEntries(self, manager, nicks):
+        return [manager.createEntry(nick, u'http://example.com/%d' % (i,))
+                for i, nick in enumerate(nicks)]
+
+
+    def test_topContributors(self):
+        """
+        Contributors are ordered by their number of entries, most first.
+        Discarded and deleted entries, and entries in other channels, are not
+        counted.
+        """
+        entries = self.createEntries(
+            self.manager, [u'a', u'b', u'b', u'c', u'c', u'c', u'd'])
+        entries[-1].isDeleted = True
+        entries[0].isDiscarded = True
+        other = linkdb.LinkManager(store=self.store,
+                                   serviceID='service',
+                                   channel=u'#other')
+        self.createEntries(other, [u'a'] * 5)
+
+        self.assertEqual(
+            list(self.manager.topContributors()),
+            [(u'c', 3), (u'b', 2)])
+        self.assertEqual(
+            list(self.manager.topContributors(limit=1)),
+            [(u'c', 3)])
+
+
+    def test_topContributorsTies(self):
+        """
+        Contributors with the same number of entries are ordered by
+        descending nickname.
+        """
+        self.createEntries(self.manager, [u'a', u'c', u'b'])
+        self.assertEqual(
+            list(self.manager.topContributors()),
+            [(u'c', 1), (u'b', 1), (u'a', 1)])
+
+
+    def assertStats(self, entries, comments, contributors):
+        """
+        Assert that the channel statistics match C{entries},
+        C{comments} and C{contributors}, before and after a rebuild.
+        """
+        stats = linkdb.getChannelStats(self.store, u'#chan')
+        expected = (entries, comments, contributors, stats.firstEntry)
+        self.assertEqual(
+            (stats.entries, stats.comments, stats.contributors,
+             stats.firstEntry),
+            expected)
+        stats.rebuild()
+        self.assertEqual(
+            (stats.entries, stats.comments, stats.contributors,
+             stats.firstEntry),
+            expected)
+
+
+    def test_stats(self):
+        """
+        Channel statistics are built from existing entries the first time
+        they are needed.
+        """
+        entries = self.createEntries(self.manager, [u'a', u'b', u'b'])
+        entries[0].addComment(u'b', u'comment')
+        numEntries, numComments, numContributors, age = self.manager.stats()
+        self.assertEqual(
+            (numEntries, numComments, numContributors), (3, 1, 2))
+        self.assertEqual(
+            linkdb.getChannelStats(self.store, u'#chan').firstEntry,
+            entries[0].created)
+
+
+    def test_statsMaintained(self):
+        """
+        Channel statistics are kept up to date as entries and comments are
+        created, and entries discarded, deleted and restored.
+        """
+        self.assertStats(0, 0, 0)
+        entries = self.createEntries(self.manager, [u'a', u'b', u'b'])
+        entries[0].addComment(u'b', u'comment')
+        entries[1].addComment(u'a', u'comment')
+        self.assertStats(3, 2, 2)
+
+        entries[0].setDiscarded(True)
+        self.assertStats(2, 1, 1)
+        self.assertEqual(
+            linkdb.getChannelStats(self.store, u'#chan').firstEntry,
+            entries[1].created)
+
+        entries[0].setDeleted(True)
+        entries[0].setDiscarded(False)
+        self.assertStats(2, 1, 1)
+
+        entries[1].setDeleted(True)
+        self.assertStats(1, 0, 1)
+
+        entries[0].setDeleted(False)
+        entries[1].setDeleted(False)
+        self.assertStats(3, 2, 2)
+
+
+    def test_statsIgnoreOtherChannels(self):
+        """
+        Entries in other channels do not affect a channel's statistics.
+        """
+        self.assertStats(0, 0, 0)
+        other = linkdb.LinkManager(store=self.store,
+                                   serviceID='service',
+                                   channel=u'#other')
+        self.createEntries(other, [u'a'])
+        self.assertStats(0, 0, 0)
+
+
+
+class BuildMatchQueryTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb._buildMatchQuery}.
+    """
+    def test_words(self):
+        """
+        Words are quoted as strings.
+        """
+        self.assertEqual(linkdb._buildMatchQuery(u'foo  b"ar OR'),
+                         u'"foo" "b" "ar OR"')
+
+
+    def test_phrase(self):
+        """
+        Double-quoted phrases are kept, with an unterminated quote extending
+        to the end.
+        """
+        self.assertEqual(linkdb._buildMatchQuery(u'"foo bar" "baz'),
+                         u'"foo bar" "baz"')
+
+
+    def test_prefix(self):
+        """
+        A trailing C{*} on a word or phrase makes it a prefix query.
+        """
+        self.assertEqual(linkdb._buildMatchQuery(u'foo* "bar baz"* qu*x'),
+                         u'"foo" * "bar baz" * "qu*x"')
+
+
+    def test_empty(self):
+        """
+        Terms with nothing to search for produce an empty query.
+        """
+        self.assertEqual(linkdb._buildMatchQuery(u' "" * "*'), u'')
+
+
+
+class LinkEntryIndexTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb.LinkEntryIndex}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.index = linkdb.getLinkEntryIndex(self.store)
+        self.manager = linkdb.LinkManager(store=self.store,
+                                          serviceID='service',
+                                          channel=u'#chan')
+
+
+    def createEntry(self, url, title=None, manager=None):
+        if manager is None:
+            manager = self.manager
+        entry = manager.createEntry(u'nick', url, title)
+        self.index.index(entry)
+        return entry
+
+
+    def search(self, term, limit=None):
+        results = []
+        self.manager.search(term, limit).addCallback(results.extend)
+        return results
+
+
+    def test_sources(self):
+        """
+        A new index listens to both the entry and comment batch processors.
+        """
+        for source in [linkdb.LinkEntrySource, linkdb.LinkEntryCommentSource]:
+            processor = self.store.findUnique(source)
+            self.assertEqual(list(processor.getReliableListeners()),
+                             [self.index])
+
+
+    def test_search(self):
+        """
+        Entries are found by terms in their URL or title.
+        """
+        foo = self.createEntry(u'http://example.com/foo', u'A title')
+        bar = self.createEntry(u'http://example.com/bar', u'Another title')
+        self.assertEqual(self.search(u'foo'), [foo])
+        self.assertEqual(self.search(u'another'), [bar])
+        self.assertEqual(self.search(u'quux'), [])
+
+
+    def test_comments(self):
+        """
+        Entries are found by terms in their comments, once a comment is
+        processed.
+        """
+        entry = self.createEntry(u'http://example.com/foo')
+        comment = entry.addComment(u'nick', u'something interesting')
+        self.assertEqual(self.search(u'interesting'), [])
+        self.index.processItem(comment)
+        self.assertEqual(self.search(u'interesting'), [entry])
+
+
+    def test_reindex(self):
+        """
+        Setting an entry's title reindexes it, replacing the previous
+        document.
+        """
+        entry = self.createEntry(u'http://example.com/foo', u'Old')
+        entry.setTitle(u'New')
+        self.assertEqual(self.search(u'old'), [])
+        self.assertEqual(self.search(u'new'), [entry])
+        self.assertEqual(self.search(u'foo'), [entry])
+
+
+    def test_channel(self):
+        """
+        Entries in other channels are not found.
+        """
+        other = linkdb.LinkManager(store=self.store,
+                                   serviceID='service',
+                                   channel=u'#other')
+        entry = self.createEntry(u'http://example.com/foo')
+        self.createEntry(u'http://example.com/foo', manager=other)
+        self.assertEqual(self.search(u'foo'), [entry])
+
+
+    def test_visibility(self):
+        """
+        Discarded and deleted entries are not found.
+        """
+        discarded = self.createEntry(u'http://example.com/foo/1')
+        deleted = self.createEntry(u'http://example.com/foo/2')
+        entry = self.createEntry(u'http://example.com/foo/3')
+        discarded.setDiscarded(True)
+        deleted.setDeleted(True)
+        self.assertEqual(self.search(u'foo'), [entry])
+
+
+    def test_orderAndLimit(self):
+        """
+        Of equally relevant entries, the most recently modified are found
+        first, up to the limit and after the offset.
+        """
+        entries = [self.createEntry(u'http://example.com/foo/%d' % (i,))
+                   for i in range(4)]
+        for i, entry in enumerate(entries):
+            entry.modified = Time.fromPOSIXTimestamp(i)
+        entries.reverse()
+        self.assertEqual(self.search(u'foo'), entries)
+        self.assertEqual(self.search(u'foo', limit=2), entries[:2])
+        results = []
+        self.manager.searchResults(u'foo', limit=2, offset=1).addCallback(
+            results.extend)
+        self.assertEqual([r.entry for r in results], entries[1:3])
+
+
+    def test_relevance(self):
+        """
+        Entries are ranked by relevance, matches in titles counting for more
+        than matches in URLs.
+        """
+        url = self.createEntry(u'http://example.com/python', u'Snakes')
+        title = self.createEntry(u'http://example.com/', u'Python')
+        url.modified = Time.fromPOSIXTimestamp(1)
+        title.modified = Time.fromPOSIXTimestamp(0)
+        self.assertEqual(self.search(u'python'), [title, url])
+
+
+    def test_allTerms(self):
+        """
+        Every term must match.
+        """
+        entry = self.createEntry(u'http://example.com/', u'Monty Python')
+        self.createEntry(u'http://example.com/', u'Python')
+        self.assertEqual(self.search(u'python monty'), [entry])
+
+
+    def test_phrase(self):
+        """
+        Double-quoted terms match a phrase.
+        """
+        entry = self.createEntry(u'http://example.com/', u'Monty Python')
+        self.createEntry(u'http://example.com/', u'Python Monty')
+        self.assertEqual(self.search(u'"monty python"'), [entry])
+
+
+    def test_prefix(self):
+        """
+        A trailing C{*} matches a prefix.
+        """
+        entry = self.createEntry(u'http://example.com/', u'Monty Python')
+        self.assertEqual(self.search(u'pyth'), [])
+        self.assertEqual(self.search(u'pyth*'), [entry])
+        self.assertEqual(self.search(u'"monty pyth"*'), [entry])
+
+
+    def test_syntax(self):
+        """
+        Search terms are matched literally rather than as query syntax.
+        """
+        entry = self.createEntry(u'http://example.com/foo-bar', u'A (title)')
+        self.assertEqual(self.search(u'example.com/foo-bar'), [entry])
+        self.assertEqual(self.search(u'(title) NOT'), [])
+        self.assertEqual(self.search(u'"'), [])
+        self.assertEqual(self.search(u'*'), [])
+
+
+    def test_snippet(self):
+        """
+        Results include a snippet of the matching text, with the matching
+        terms in bold.
+        """
+        entry = self.createEntry(u'http://example.com/', u'Monty Python')
+        results = []
+        self.manager.searchResults(u'python').addCallback(results.extend)
+        self.assertEqual([(r.entry, r.snippet) for r in results],
+                         [(entry, u'Monty \002Python\002')])
+
+
+    def test_rebuild(self):
+        """
+        Rebuilding the index indexes every entry immediately.
+        """
+        entry = self.manager.createEntry(u'nick', u'http://example.com/foo')
+        entry.addComment(u'nick', u'interesting')
+        self.assertEqual(self.search(u'interesting'), [])
+        self.index.rebuild()
+        self.assertEqual(self.index.indexCount, 1)
+        self.assertEqual(self.search(u'interesting'), [entry])
+
+
+    def test_reset(self):
+        """
+        Resetting the index empties it.
+        """
+        self.createEntry(u'http://example.com/foo')
+        self.index.reset()
+        self.assertEqual(self.index.indexCount, 0)
+        self.assertEqual(self.search(u'foo'), [])
+
+
+
+class HostKeyTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb._hostKey}.
+    """
+    def test_hostKey(self):
+        """
+        The host's labels are reversed, lowercased and stripped of any port or
+        trailing dot.
+        """
+        self.assertEqual(
+            linkdb._hostKey(u'http://user@www.Example.com.:8080/foo'),
+            u'com.example.www')
+
+
+    def test_noHost(self):
+        """
+        URLs without a host have no host key.
+        """
+        self.assertIdentical(linkdb._hostKey(u'mailto:foo@example.com'), None)
+
+
+
+class ParseQueryTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb.parseQuery}.
+    """
+    def setUp(self):
+        self.now = Time.fromPOSIXTimestamp(1000000)
+
+
+    def parse(self, query):
+        return linkdb.parseQuery(query, now=self.now)
+
+
+    def test_text(self):
+        """
+        Anything that is not a filter is free text, including words that
+        merely look like filters.
+        """
+        query = self.parse(u'foo "bar baz"* http://example.com/ x:y')
+        self.assertEqual(query.text, u'foo "bar baz"* http://example.com/ x:y')
+        self.assertEqual(query.filters, [])
+
+
+    def test_filters(self):
+        """
+        Filters are parsed, in order, from anywhere in the query.
+        """
+        query = self.parse(
+            u'nick:"foo" bar Site:www.Example.com has:Comment type:IMAGE')
+        self.assertEqual(query.text, u'bar')
+        self.assertEqual(query.filters, [
+            (u'nick', u'foo'),
+            (u'site', u'com.example.www'),
+            (u'has', u'comment'),
+            (u'type', u'image')])
+
+
+    def test_relativeTime(self):
+        """
+        Relative times are relative to now.
+        """
+        query = self.parse(u'after:2d before:3h')
+        self.assertEqual(query.getValues(u'after'),
+                         [self.now - datetime.timedelta(days=2)])
+        self.assertEqual(query.getValues(u'before'),
+                         [self.now - datetime.timedelta(hours=3)])
+
+
+    def test_absoluteTime(self):
+        """
+        Dates, of varying precision, are the start of that period in the bot's
+        timezone.
+        """
+        self.assertEqual(
+            [self.parse(u'after:' + d).getValues(u'after')[0].asDatetime()
+             for d in [u'2009', u'2009-03', u'2009-03-04']],
+            [datetime.datetime(2009, 1, 1, tzinfo=const.timezone),
+             datetime.datetime(2009, 3, 1, tzinfo=const.timezone),
+             datetime.datetime(2009, 3, 4, tzinfo=const.timezone)])
+
+
+    def test_invalid(self):
+        """
+        Invalid filter values raise L{errors.InvalidQuery}.
+        """
+        for query in [u'after:soon', u'before:2009-13', u'has:wings']:
+            self.assertRaises(errors.InvalidQuery, self.parse, query)
+
+
+
+class LinkQueryTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb.LinkManager.query}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.index = linkdb.getLinkEntryIndex(self.store)
+        self.manager = linkdb.LinkManager(store=self.store,
+                                          serviceID='service',
+                                          channel=u'#chan')
+
+
+    def createEntry(self, nick, url, title=None, created=0):
+        entry = self.manager.createEntry(nick, url, title)
+        entry.created = Time.fromPOSIXTimestamp(created)
+        self.index.index(entry)
+        return entry
+
+
+    def query(self, query):
+        results = []
+        self.manager.query(query).addCallback(results.extend)
+        return [r.entry for r in results]
+
+
+    def test_nick(self):
+        """
+        Entries can be filtered by one or more nicknames, most recent first.
+        """
+        a = self.createEntry(u'a', u'http://example.com/', created=1)
+        b = self.createEntry(u'b', u'http://example.com/', created=2)
+        self.createEntry(u'c', u'http://example.com/')
+        self.assertEqual(self.query(u'nick:a'), [a])
+        self.assertEqual(self.query(u'nick:a nick:b'), [b, a])
+
+
+    def test_site(self):
+        """
+        Entries can be filtered by a domain, including its subdomains.
+        """
+        bare = self.createEntry(u'a', u'http://example.com/', created=1)
+        www = self.createEntry(u'a', u'http://www.example.com/', created=2)
+        self.createEntry(u'a', u'http://notexample.com/')
+        self.createEntry(u'a', u'http://example.com.au/')
+        self.assertEqual(self.query(u'site:example.com'), [www, bare])
+        self.assertEqual(self.query(u'site:www.example.com'), [www])
+
+
+    def test_time(self):
+        """
+        Entries can be filtered by when they were created.
+        """
+        entries = [self.createEntry(u'a', u'http://example.com/', created=t)
+                   for t in [0, 100, 200]]
+        self.assertEqual(self.query(u'after:1970-01-01 before:1970-01-02'),
+                         list(reversed(entries)))
+        self.assertEqual(self.query(u'after:1971'), [])
+
+
+    def test_has(self):
+        """
+        Entries can be filtered by whether they have comments or a title.
+        """
+        comment = self.createEntry(u'a', u'http://example.com/', created=1)
+        comment.addComment(u'a', u'comment')
+        title = self.createEntry(u'a', u'http://example.com/', u'Title')
+        self.assertEqual(self.query(u'has:comment'), [comment])
+        self.assertEqual(self.query(u'has:title'), [title])
+        self.assertEqual(self.query(u'has:title has:comment'), [])
+
+
+    def test_type(self):
+        """
+        Entries can be filtered by content type, or major type.
+        """
+        png = self.createEntry(u'a', u'http://example.com/', created=1)
+        png.updateMetadata({u'contentType': u'image/png'})
+        html = self.createEntry(u'a', u'http://example.com/')
+        html.updateMetadata({u'contentType': u'text/html; charset=utf-8'})
+        self.assertEqual(self.query(u'type:image'), [png])
+        self.assertEqual(self.query(u'type:text/html'), [html])
+        self.assertEqual(self.query(u'type:text/plain'), [])
+
+
+    def test_text(self):
+        """
+        Free text is searched for in the full-text index, combined with any
+        filters.
+        """
+        a = self.createEntry(u'a', u'http://example.com/', u'Python')
+        self.createEntry(u'b', u'http://example.com/', u'Python')
+        self.createEntry(u'a', u'http://example.com/', u'Ruby')
+        self.assertEqual(self.query(u'python nick:a'), [a])
+
+
+    def test_empty(self):
+        """
+        An empty query finds nothing.
+        """
+        self.createEntry(u'a', u'http://example.com/')
+        self.assertEqual(self.query(u''), [])
+        self.assertEqual(self.manager.explain(u''), [])
+
+
+    def test_explain(self):
+        """
+        Explaining a query names the indexes it uses.
+        """
+        plan = u' '.join(self.manager.explain(u'nick:a'))
+        self.assertIn(
+            u'USING INDEX axiomidx_eridanus_plugins_linkdb_linkentry_', plan)
+        plan = u' '.join(self.manager.explain(u'python'))
+        self.assertIn(u'eridanus_linkdb_fts5', plan)
+
+
+
+class LinkEntryTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb.LinkEntry}.
+    """
+    def setUp(self):
+        self.store = Store()
+        linkdb.LinkEntrySource(store=self.store)
+        linkdb.LinkEntryCommentSource(store=self.store)
+        self.manager = linkdb.LinkManager(store=self.store,
+                                          serviceID='service',
+                                          channel=u'#chan')
+        self.entry = self.manager.createEntry(u'nick', u'http://example.com/')
+
+
+    def test_initialComment(self):
+        """
+        The first comment by the entry's author is stored on the entry as the
+        initial comment.
+        """
+        self.entry.addComment(u'other', u'first')
+        self.assertIdentical(self.entry.initialCommentText, None)
+        initial = self.entry.addComment(u'nick', u'second')
+        self.entry.addComment(u'nick', u'third')
+        self.assertEqual(
+            (self.entry.initialCommentText, self.entry.initialCommentNick),
+            (u'second', u'nick'))
+        self.assertEqual(self.entry.getInitialComment(), initial)
+
+
+    def test_importedInitialComment(self):
+        """
+        Initial comments created directly, as when importing entries, are
+        also stored on the entry.
+        """
+        linkdb.LinkEntryComment(store=self.store,
+                                parent=self.entry,
+                                nick=u'nick',
+                                comment=u'comment',
+                                initial=True)
+        self.assertEqual(self.entry.initialCommentText, u'comment')
+
+
+    def test_metadata(self):
+        """
+        Updating metadata merges it into the entry's existing metadata, and
+        keeps a copy of the content type for filtering.
+        """
+        self.assertEqual(self.entry.getMetadata(), {})
+        self.entry.updateMetadata({u'contentType': u'image/png',
+                                   u'size': u'1 KB'})
+        self.entry.updateMetadata({u'size': u'2 KB'})
+        self.assertEqual(self.entry.getMetadata(),
+                         {u'contentType': u'image/png', u'size': u'2 KB'})
+        self.assertEqual(self.entry.contentType, u'image/png')
+        self.assertEqual(self.store.count(linkdb.LinkEntryMetadata), 0)
+
+
+
+class PrefetchEntriesTests(unittest.TestCase):
+    """
+    Tests for L{eridanusstd.linkdb.prefetchEntries}.
+    """
+    def setUp(self):
+        self.store = Store()
+        linkdb.LinkEntrySource(store=self.store)
+        linkdb.LinkEntryCommentSource(store=self.store)
+        self.manager = linkdb.LinkManager(store=self.store,
+                                          serviceID='service',
+                                          channel=u'#chan')
+        self.entries = []
+        for i in range(5):
+            entry = self.manager.createEntry(
+                u'nick', u'http://example.com/%d' % (i,))
+            if i % 2:
+                entry.addComment(u'nick', u'initial %d' % (i,))
+                entry.addComment(u'other', u'comment %d' % (i,))
+                entry.updateMetadata({u'contentType': u'image/png',
+                                      u'size': u'%d bytes' % (i,)})
+            self.entries.append(entry)
+
+
+    def render(self, entry):
+        return (entry.displayCompleteHumanReadable(),
+                list(entry.getComments()),
+                list(entry.getComments(initial=False)),
+                entry.getMetadata())
+
+
+    def noQueries(self, *a, **kw):
+        self.fail('Unexpected query')
+
+
+    def test_prefetch(self):
+        """
+        Prefetched entries display the same as they would otherwise, without
+        querying the store, whatever the batch size.
+        """
+        expected = map(self.render, self.entries)
+        for batchSize in [1, 2, 10]:
+            for entry in self.entries:
+                entry.activate()
+            entries = list(linkdb.prefetchEntries(self.entries, batchSize))
+            self.assertEqual(entries, self.entries)
+            patch = self.patch(self.store, 'query', self.noQueries)
+            self.assertEqual(map(self.render, entries), expected)
+            patch.restore()
+
+
+    def test_invalidate(self):
+        """
+        Adding a comment to a prefetched entry discards its prefetched
+        comments.
+        """
+        entry, = linkdb.prefetchEntries(self.entries[:1])
+        comment = entry.addComment(u'nick', u'initial')
+        self.assertEqual(list(entry.getComments()), [comment])
+
+
+    def test_display(self):
+        """
+        Displaying an entry, with an initial comment and metadata, does not
+        query the store.
+        """
+        entry = self.entries[1]
+        self.patch(self.store, 'query', self.noQueries)
+        self.assertEqual(entry.displayTitle,
+                         u'initial 1 [image/png 1 bytes]')
+        self.assertEqual(entry.displayComment, u' [initial 1]')
+
+
+    def test_getEntries(self):
+        """
+        L{LinkManager.getEntries} prefetches entries when asked to.
+        """
+        entries = list(self.manager.getEntries(prefetch=True))
+        self.assertEqual(len(entries), 5)
+        self.patch(self.store, 'query', self.noQueries)
+        for entry in entries:
+            entry.displayCompleteHumanReadable()
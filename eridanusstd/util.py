@@ -1,6 +1,34 @@
 import html5lib
 
+from eridanusstd import defertools
+
 
 
 def parseHTML(data):
     return html5lib.parse(data, treebuilder='lxml')
+
+
+
+_parserPool = None
+
+def getParserPool():
+    """
+    Get the L{eridanusstd.defertools.WorkerPool} that HTML is parsed in,
+    creating it if need be.
+    """
+    global _parserPool
+    if _parserPool is None:
+        _parserPool = defertools.WorkerPool()
+    return _parserPool
+
+
+
+def deferToParser(f, *a, **kw):
+    """
+    Call C{f}, which parses HTML, with the remaining arguments in the parser
+    pool.
+
+    @rtype: C{Deferred}
+    @return: A Deferred that fires with the result of the call
+    """
+    return getParserPool().run(f, *a, **kw)